@@ -5,6 +5,8 @@ from logging import (
 
 from securitybot import loader
 from securitybot.bot import SecurityBot
+from securitybot.async_bot import AsyncSecurityBot
+from securitybot.shard import run_sharded
 from securitybot.exceptions import ConfigException
 
 def main():
@@ -22,8 +24,20 @@ def main():
     getLogger('usllib3').setLevel(level)
 
     # Try and create a bot instance
+    mode = config['bot'].get('mode', 'event')
+    if mode not in ['event', 'async', 'sharded']:
+        raise ConfigException('Invalid bot mode - {}'.format(mode))
+
+    if mode == 'sharded':
+        # Runs until killed, with a bot per worker process
+        run_sharded(config)
+        return
+
     try:
-        sb = SecurityBot(config=config)
+        if mode == 'async':
+            sb = AsyncSecurityBot(config=config)
+        else:
+            sb = SecurityBot(config=config)
 
     except KeyError:
         logging.error('Configuration missing')
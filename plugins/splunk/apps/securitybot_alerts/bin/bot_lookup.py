@@ -1,35 +1,107 @@
-#!/usr/local/env python
+#!/usr/bin/env python3
 '''
-Performs a MySQL query to return any events that have a SHA-256 hash matching
-an event handled by the bot.
+A Splunk external lookup returning the user's response to any events whose
+SHA-256 hash matches an event handled by the bot. Rows are read a chunk at a
+time and their hashes resolved with one query per chunk.
 '''
 __author__ = 'Alex Bertsch'
 __email__ = 'abertsch@dropbox.com'
 
+import os
 import sys
 import csv
 import logging
 
-from securitybot.sql import SQLEngine, init_sql
+from itertools import islice
 
-from typing import Any, Sequence
+from securitybot import loader
+from securitybot.cache import TTLCache
+
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+# Rows read and resolved together
+CHUNK_SIZE = 1000
+
+# Hashes remembered between chunks, and for how long in seconds
+CACHE_SIZE = 10000
+CACHE_TTL = 300
+
+CONFIG_PATH = os.environ.get('SECURITYBOT_CONFIG', 'config/bot.yaml')
+
+# Cached for hashes with no response, so they aren't queried again
+NO_RESPONSE = ()
+
+
+def build_db_client(config):
+    '''Connects to the bot's database as configured.'''
+    secrets_provider = config['secretsmgmt']['provider']
+    secretsclient = loader.build_secrets_client(
+        secrets_provider=secrets_provider,
+        connection_config=config['secretsmgmt'][secrets_provider]
+    )
+    loader.add_secrets_to_config(
+        smclient=secretsclient,
+        secrets=config['secretsmgmt']['secrets'],
+        config=config
+    )
+
+    db_provider = config['database']['provider']
+    return loader.build_db_client(
+        db_provider=db_provider,
+        connection_config=config['database'][db_provider],
+        tables=config['database']['tables']
+    )
+
+
+def to_bool(value):
+    # type: (Any) -> bool
+    # SimpleDB hands back strings
+    if isinstance(value, str):
+        return value.lower() in ('1', 'true')
+    return bool(value)
+
+
+def find_on_hashes(dbclient, hashes, cache):
+    # type: (Any, Iterable[str], TTLCache) -> Dict[str, Tuple[str, bool, bool]]
+    '''
+    Looks up the responses to a set of hashes, asking the database only for
+    those not cached.
+
+    Returns:
+        Dict[str, Tuple[str, bool, bool]]: The comment, performed and
+            authenticated fields for each hash with a response.
+    '''
+    found = {}
+    missing = []
+    for hsh in set(hashes):
+        response = cache.get(hsh, None)
+        if response is None:
+            missing.append(hsh)
+        elif response is not NO_RESPONSE:
+            found[hsh] = response
+
+    if missing:
+        for hsh, comment, performed, authenticated in dbclient.execute(
+            'get_responses', (missing,)
+        ):
+            found[hsh.lower()] = (
+                comment, to_bool(performed), to_bool(authenticated)
+            )
+        for hsh in missing:
+            cache.set(hsh, found.get(hsh, NO_RESPONSE))
+
+    return found
 
-def find_on_hash(hash):
-    # type: (str) -> Sequence[Any]
-    match = SQLEngine.execute('SELECT comment, performed, authenticated FROM user_responses WHERE hash=UNHEX(%s)', (hash,))
-    if len(match) != 1:
-        # This catches collisions too, which is probably (hopefully) overkill
-        return None
-    item = match[0]
-    return item[0], bool(item[1]), bool(item[2])
 
 def main():
     # type: () -> None
     if len(sys.argv) != 5:
-        print 'Usage: python bot_lookup.py [hash] [comment] [performed] [authenticated]'
+        print('Usage: python bot_lookup.py '
+              '[hash] [comment] [performed] [authenticated]')
+        sys.exit(1)
 
-    # Initialize SQL
-    init_sql()
+    dbclient = build_db_client(loader.load_yaml(CONFIG_PATH))
+    cache = TTLCache(maxsize=CACHE_SIZE, ttl=CACHE_TTL)
 
     hash_field = sys.argv[1]
     comment_field = sys.argv[2]
@@ -47,21 +119,43 @@ def main():
     outbound = csv.DictWriter(outfile, fieldnames=header)
     outbound.writeheader()
 
-    for entry in inbound:
-        hash = entry[hash_field]
+    while True:
+        chunk = list(islice(inbound, CHUNK_SIZE))
+        if not chunk:
+            break
 
         try:
-            res = find_on_hash(hash)
+            found = find_on_hashes(
+                dbclient,
+                [
+                    entry[hash_field].lower()
+                    for entry in chunk if entry[hash_field]
+                ],
+                cache
+            )
+        except Exception as e:
+            logging.warning(
+                'An exception was encountered making a DB call: {0}'.format(e)
+            )
+            found = {}
+
+        for entry in chunk:
+            res = found.get(
+                (entry[hash_field] or '').lower(), None
+            )  # type: Optional[Tuple]
             if res is not None:
                 comment, performed, authenticated = res
 
                 entry[comment_field] = comment
                 entry[performed_field] = performed
                 entry[authenticated_field] = authenticated
-        except Exception as e:
-            logging.warn('An exception was encountered making a DB call: {0}'.format(e))
 
-        outbound.writerow(entry)
+        outbound.writerows(chunk)
+        # Let Splunk start on this chunk while the next is looked up
+        outfile.flush()
+
+    logging.info('Lookup cache: {}'.format(cache.stats()))
+
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
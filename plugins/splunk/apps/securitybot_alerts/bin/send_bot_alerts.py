@@ -1,44 +1,73 @@
-#!/usr/local/env python
-
+#!/usr/bin/env python3
+'''
+Creates securitybot alerts from the results of a Splunk search, streaming the
+results file a chunk at a time: one collision query and one bulk insert per
+chunk rather than per row.
+'''
+
+import os
 import sys
 import csv
 import gzip
-import logging
-
 import json
+import logging
+import time
 
-from securitybot.sql import SQLEngine, init_sql
-from securitybot.util import create_new_alert
+from itertools import islice
 
-def create_securitybot_task(search_name, hash, username, description, reason, url):
-    '''
-    Creates a new Maniphest task with the securitybot tag so that the bot can
-    reach out to the relevant people.
-    '''
-    logging.info('Creating new task about {} for {}'.format(description,
-                                                            username))
+from securitybot import intake
+from securitybot import loader
+from securitybot.ingest import AlertIngester, CREATED, DUPLICATE
 
-    # Check for collision
-    rows = SQLEngine.execute('SELECT title FROM alerts WHERE hash=UNHEX(%s)', (hash,))
-    if rows:
-        raise CollisionException(
-'''We found a collision with {0} for {1}.
-Most likely the Splunk alert with configured incorrectly.
-However, if this is a geniune collision, then you have a paper to write. Good luck.
-'''.format(rows, hash))
+# Rows read, checked for collisions and inserted together
+CHUNK_SIZE = 1000
 
-    # Insert that into the database as a new alert
-    create_new_alert(search_name, username, description, reason, url, hash)
+CONFIG_PATH = os.environ.get('SECURITYBOT_CONFIG', 'config/bot.yaml')
 
-class CollisionException(Exception):
-    pass
 
-def send_bot_alerts(payload):
+def build_ingester(config):
+    '''
+    Connects to the bot's database as configured and returns an ingester
+    writing to it.
+    '''
+    secrets_provider = config['secretsmgmt']['provider']
+    secretsclient = loader.build_secrets_client(
+        secrets_provider=secrets_provider,
+        connection_config=config['secretsmgmt'][secrets_provider]
+    )
+    loader.add_secrets_to_config(
+        smclient=secretsclient,
+        secrets=config['secretsmgmt']['secrets'],
+        config=config
+    )
+
+    db_provider = config['database']['provider']
+    dbclient = loader.build_db_client(
+        db_provider=db_provider,
+        connection_config=config['database'][db_provider],
+        tables=config['database']['tables']
+    )
+
+    intake_config = config['bot'].get('intake', None) or {}
+    notify_path = None
+    if intake_config.get('enabled', True):
+        notify_path = intake_config.get('path', intake.DEFAULT_PATH)
+
+    return AlertIngester(
+        dbclient, batch_size=CHUNK_SIZE, notify_path=notify_path
+    )
+
+
+def send_bot_alerts(payload, ingester):
     '''
     Creates alerts for securitybot using data provided by Splunk.
 
     Args:
         payload (Dict[str, str]): A dictionary of parameters provided by Splunk.
+        ingester (AlertIngester): Writes the alerts.
+    Returns:
+        Dict[str, int]: How many rows were read, and how many alerts were
+                        created, skipped as collisions, or rejected.
     '''
     # Generic things
     results_file = payload['results_file']
@@ -48,22 +77,46 @@ def send_bot_alerts(payload):
     # Action specific things
     title = payload['configuration']['title']
 
-    try:
-        with gzip.open(results_file, 'rb') as alert_file:
-            reader = csv.DictReader(alert_file)
-            for row in reader:
-                # TODO: eventually group by username and concat event_info
-                create_securitybot_task(alert_name,
-                                        row['hash'],
-                                        row['ldap'],
-                                        title,
-                                        row['event_info'],
-                                        splunk_url
-                )
-
-    except Exception:
-        # Can't fix anything, so just re-raise and move on
-        raise
+    counts = {'rows': 0, CREATED: 0, DUPLICATE: 0, 'rejected': 0}
+    with gzip.open(results_file, 'rt', newline='') as alert_file:
+        reader = csv.DictReader(alert_file)
+        while True:
+            chunk = list(islice(reader, CHUNK_SIZE))
+            if not chunk:
+                break
+
+            # TODO: eventually group by username and concat event_info
+            results = ingester.ingest([
+                {
+                    'hash': row.get('hash', None),
+                    'ldap': row.get('ldap', None),
+                    'title': alert_name,
+                    'description': title,
+                    'reason': row.get('event_info', None),
+                    'url': splunk_url,
+                }
+                for row in chunk
+            ])
+
+            counts['rows'] += len(chunk)
+            for result in results:
+                if result['status'] == CREATED:
+                    counts[CREATED] += 1
+                elif result['status'] == DUPLICATE:
+                    # Most likely the Splunk alert was configured incorrectly
+                    counts[DUPLICATE] += 1
+                    logging.warning('Collision on hash {}: {}'.format(
+                        result['hash'], result['error'])
+                    )
+                else:
+                    counts['rejected'] += 1
+                    logging.error('Row {} not sent: {}'.format(
+                        counts['rows'] - len(chunk) + result['index'] + 1,
+                        result['error'])
+                    )
+
+    return counts
+
 
 def main():
     logging.basicConfig(level=logging.INFO,
@@ -74,15 +127,24 @@ def main():
         payload = json.loads(sys.stdin.read())
         logging.info('Sending bot alert: {0}'.format(payload['search_name']))
 
-        # initialize SQL
-        init_sql()
+        ingester = build_ingester(loader.load_yaml(CONFIG_PATH))
 
-        send_bot_alerts(payload)
+        start = time.monotonic()
+        counts = send_bot_alerts(payload, ingester)
+        elapsed = time.monotonic() - start
 
-        logging.info('Alert {} fired successfully.\n'.format(payload['search_name']))
+        logging.info(
+            'Alert {} fired: {} rows in {:.2f}s ({:.0f} rows/s), {} created, '
+            '{} collisions, {} rejected.'.format(
+                payload['search_name'], counts['rows'], elapsed,
+                counts['rows'] / elapsed if elapsed else 0,
+                counts[CREATED], counts[DUPLICATE], counts['rejected']
+            )
+        )
     except Exception as e:
         logging.error('Failure: {}'.format(e))
     logging.info('Exiting')
 
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,203 @@
+'''
+An asyncio flavour of SecurityBot. Each active user gets their own task, so a
+slow chat, database or MFA call for one user no longer holds up everyone else.
+'''
+__author__ = 'Alex Bertsch, Antoine Cardon'
+__email__ = 'abertsch@dropbox.com, antoine.cardon@algolia.com'
+
+import asyncio
+import logging
+import pytz
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+
+from securitybot.bot import SecurityBot
+
+from securitybot.util import run_blocking
+
+
+def _noop():
+    pass
+
+
+class AsyncSecurityBot(SecurityBot):
+    '''
+    A SecurityBot which runs every active user's state machine as its own
+    asyncio task. All providers are blocking, so their calls are made from
+    a bounded thread pool; work for a single user is always run in order,
+    while work for different users runs concurrently.
+    '''
+
+    def __init__(self, config, shard=None):
+        '''
+        Args:
+            config (dict): The bot configuration, see SecurityBot.
+            shard (Shard): The users this bot owns, see SecurityBot.
+        '''
+        workers = int(config['bot'].get('workers', 32))
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        # Every pool thread may hold a database connection at once, so
+        # unless sized explicitly the connection pool gets one for each
+        db_provider = config['database']['provider']
+        db_config = config['database'].get(db_provider, None)
+        if db_config is not None:
+            db_config.setdefault('pool_size', workers)
+        # Per user queues of pending jobs, and the tasks draining them
+        self._jobs = {}
+        self._workers = {}
+        super().__init__(config, shard=shard)
+
+    def run(self):
+        # type: () -> None
+        '''
+        Main loop for the bot.
+        '''
+        asyncio.run(self.run_async())
+
+    async def run_async(self):
+        # type: () -> None
+        '''
+        Polls for tasks and messages, handing each off to the task owning
+        the relevant user.
+        '''
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._chatclient.set_wakeup(self.wake)
+        self._mfa_poller.start()
+        self.ignored.start()
+        if self._intake is not None:
+            self._intake.start()
+
+        # Pick up users with tasks recovered from a previous run
+        for user_id in self.active_user_ids():
+            self._ensure_worker(user_id)
+
+        while True:
+            if self._tasks_due():
+                await self.handle_new_tasks_async()
+
+            self.handle_user_updates()
+            messages = await run_blocking(
+                self._executor, self._chatclient.get_messages
+            )
+            for message in messages:
+                self._submit(
+                    message['user'], partial(self.handle_message, message)
+                )
+            self.log_stats()
+
+            timeout = (
+                self._last_task_poll + self._task_poll_time -
+                datetime.now(tz=pytz.utc)
+            ).total_seconds()
+            try:
+                await asyncio.wait_for(
+                    self._wakeup.wait(), timeout=max(0, timeout)
+                )
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def handle_new_tasks_async(self):
+        # type: () -> None
+        '''
+        Fetches new tasks and queues each on the task for its user.
+        '''
+        tasks = await run_blocking(
+            self._executor,
+            lambda: self.claim_tasks(self.tasker.get_new_tasks())
+        )
+        for task in tasks:
+            logging.info('Handling new task for {0}'.format(task.username))
+            # Unknown users still get a queue, keyed on the username, so
+            # escalating their task doesn't block the loop
+            self._submit(self.task_key(task), partial(self._add_task, task))
+
+    def wake(self):
+        # type: () -> None
+        '''
+        Wakes the main loop. Safe to call from any thread.
+        '''
+        self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def wake_user(self, user):
+        # type: (User) -> None
+        '''
+        Every user's task steps them after each job, so there is nothing to
+        flag here.
+        '''
+        pass
+
+    def notify_user(self, user):
+        # type: (User) -> None
+        '''
+        Wakes a user's task from another thread, e.g. the MFA poller.
+        '''
+        self._loop.call_soon_threadsafe(self._submit, user['id'], _noop)
+
+    def _submit(self, key, job):
+        '''
+        Queues a blocking job on the task owning `key`, starting the task if
+        needed.
+
+        Args:
+            key (str): Usually a user ID.
+            job (function): A blocking callable to run in the thread pool.
+        '''
+        self._ensure_worker(key)
+        self._jobs[key].put_nowait(job)
+
+    def _ensure_worker(self, key):
+        if key not in self._workers:
+            self._jobs[key] = asyncio.Queue()
+            self._workers[key] = asyncio.ensure_future(
+                self._user_worker(key)
+            )
+
+    async def _user_worker(self, key):
+        '''
+        Runs queued jobs for one user, then steps them until they settle.
+        Sleeps until the next job or the user's next deadline, and finishes
+        once the user has no tasks and nothing is queued.
+        '''
+        queue = self._jobs[key]
+        try:
+            while True:
+                user = self.get_active_user(key)
+                if user is None and queue.empty():
+                    break
+
+                timeout = None
+                if user is not None:
+                    wakeup = user.next_wakeup()
+                    if wakeup is not None:
+                        timeout = max(0, (
+                            wakeup - datetime.now(tz=pytz.utc)
+                        ).total_seconds())
+
+                try:
+                    job = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    job = None
+
+                try:
+                    if job is not None:
+                        await run_blocking(self._executor, job)
+                    user = self.get_active_user(key)
+                    if user is not None:
+                        await run_blocking(
+                            self._executor, self._settle_user, user
+                        )
+                    await run_blocking(
+                        self._executor, self.flush_finished_tasks
+                    )
+                    await run_blocking(
+                        self._executor, self.flush_messages, key
+                    )
+                except Exception:
+                    logging.exception('Failed handling user {}'.format(key))
+        finally:
+            del self._workers[key]
+            del self._jobs[key]
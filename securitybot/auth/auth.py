@@ -53,6 +53,9 @@ class BaseAuthClient(object, metaclass=ABCMeta):
         '''
         Returns:
             (bool) Whether 2FA is available.
+        Raises:
+            AuthException: If it couldn't be checked, so the answer isn't
+                           remembered as False.
         '''
         raise NotImplementedError()
 
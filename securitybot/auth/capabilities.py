@@ -0,0 +1,151 @@
+'''
+Tracks which users are able to perform MFA.
+'''
+__author__ = 'Alex Bertsch, Antoine Cardon'
+__email__ = 'abertsch@dropbox.com, antoine.cardon@algolia.com'
+
+import json
+import logging
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class CapabilityStore(object):
+    '''
+    Looks up and remembers each user's MFA capability, i.e. the result of
+    `can_auth`, so it is only fetched for users who actually get an alert.
+    Lookups for many users can be run in the background through a bounded
+    thread pool, and results are saved to disk so they survive restarts.
+    '''
+
+    def __init__(self, authclient, path=None, ttl=86400, workers=4,
+                 save_interval=60):
+        '''
+        Args:
+            authclient (AuthClient): The auth provider to query.
+            path (str): A JSON file to persist results to, or None.
+            ttl (int): Seconds before a result is looked up again.
+            workers (int): Max simultaneous background lookups.
+            save_interval (int): Min seconds between writes to `path`.
+        '''
+        self._authclient = authclient
+        self._path = path
+        self._ttl = ttl
+        self._workers = workers
+        self._save_interval = save_interval
+        self._executor = None
+
+        # User ID -> [can_auth result, time looked up]
+        self._known = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._last_save = 0
+        self._load()
+
+    def get(self, user):
+        '''
+        Returns the result of `can_auth` for a user, looking it up now if it
+        is unknown or stale, or None if the lookup failed.
+        '''
+        with self._lock:
+            entry = self._known.get(user['id'], None)
+        if entry is not None and time.time() - entry[1] < self._ttl:
+            return entry[0]
+        return self._resolve(user)
+
+    def prefetch(self, users):
+        # type: (Iterable[User]) -> None
+        '''
+        Looks up the capability of every given user in the background,
+        skipping any with a fresh result.
+        '''
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._workers)
+        now = time.time()
+        with self._lock:
+            stale = [
+                user for user in users
+                if user['id'] not in self._known or
+                now - self._known[user['id']][1] >= self._ttl
+            ]
+        logging.info(
+            'Looking up MFA capabilities for {} users'.format(len(stale))
+        )
+        for user in stale:
+            self._executor.submit(self._resolve, user)
+        self._executor.submit(self.save, True)
+
+    def invalidate(self, user):
+        # type: (User) -> None
+        '''Forgets a user's capability, so it is looked up on next use.'''
+        with self._lock:
+            if self._known.pop(user['id'], None) is not None:
+                self._dirty = True
+
+    def save(self, force=False):
+        # type: (bool) -> None
+        '''
+        Writes results to disk if anything changed, at most once every
+        `save_interval` seconds unless forced.
+        '''
+        if self._path is None:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            if not force and time.time() - self._last_save < \
+                    self._save_interval:
+                return
+            data = json.dumps(self._known)
+            self._dirty = False
+            self._last_save = time.time()
+
+        tmp_path = '{}.tmp'.format(self._path)
+        try:
+            with open(tmp_path, 'w') as tmp_file:
+                tmp_file.write(data)
+            os.replace(tmp_path, self._path)
+        except OSError as error:
+            logging.warning(
+                'Unable to save MFA capabilities to {}: {}'.format(
+                    self._path, error
+                )
+            )
+
+    def _resolve(self, user):
+        # Auth clients raise when a lookup fails, so only answers they are
+        # sure of, a factor or no push factor, are remembered
+        try:
+            result = self._authclient.can_auth(user)
+        except Exception as error:
+            logging.warning(
+                'Unable to check MFA capability for {}: {}'.format(
+                    user['name'], error
+                )
+            )
+            return None
+
+        with self._lock:
+            self._known[user['id']] = [result, time.time()]
+            self._dirty = True
+        self.save()
+        return result
+
+    def _load(self):
+        if self._path is None or not os.path.exists(self._path):
+            return
+        try:
+            with open(self._path) as cache_file:
+                self._known = json.load(cache_file)
+            logging.info('Loaded MFA capabilities for {} users'.format(
+                len(self._known))
+            )
+        except (OSError, ValueError) as error:
+            logging.warning(
+                'Ignoring unreadable MFA capability cache {}: {}'.format(
+                    self._path, error
+                )
+            )
@@ -8,16 +8,24 @@ __email__ = 'chandler.newby@gmail.com, paranoid@none.xyz'
 
 import logging
 import json
+import requests
 
 from datetime import datetime
 
+from requests.adapters import HTTPAdapter
+
 from securitybot.auth.auth import BaseAuthClient, AuthStates
 
+from securitybot.cache import TTLCache
+
 from securitybot.exceptions import AuthException
 
 from okta import UsersClient, FactorsClient
 from okta.framework.ApiClient import ApiClient
 
+# Seconds to wait on a single poll of a push before trying again next round
+POLL_TIMEOUT = 10
+
 
 class AuthClient(BaseAuthClient):
 
@@ -33,6 +41,9 @@ class AuthClient(BaseAuthClient):
                 authenticate them.
         '''
         super().__init__(reauth_time, auth_attrib)
+        pool_size = int(connection_config.pop('pool_size', 10))
+        cache_size = int(connection_config.pop('cache_size', 10000))
+        cache_ttl = int(connection_config.pop('cache_ttl', 3600))
         connection_config['pathname'] = '/api/v1/users'
 
         self.usersclient = UsersClient(**connection_config)
@@ -42,27 +53,73 @@ class AuthClient(BaseAuthClient):
         # Maintain a per user lookup for poll URL
         self.poll_url = {}
 
+        # Okta user IDs and factor lists, keyed by auth attribute and
+        # Okta user ID respectively
+        self._user_ids = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self._factors = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+
+        # Keep-alive connections shared by concurrent push status polls
+        self._session = requests.Session()
+        self._session.headers.update(self.apiclient.headers)
+        self._session.mount(
+            'https://',
+            HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        )
+
     def _get_okta_userid(self, username):
-        user = self.usersclient.get_users(query=username, limit=1)
+        return self._user_ids.get_or_load(username, self._fetch_okta_userid)
 
+    def _fetch_okta_userid(self, username):
         try:
-            return user[0].id
+            users = self.usersclient.get_users(query=username, limit=1)
         except Exception as error:
-            logging.error('Error getting username {}'.format(error))
+            raise AuthException(
+                'Error getting Okta user {}: {}'.format(username, error)
+            )
+        if not users:
+            logging.warning('No Okta user found for {}'.format(username))
             return None
+        return users[0].id
 
     def _get_factors(self, userid):
+        if userid is None:
+            return None
+        return self._factors.get_or_load(userid, self._fetch_factors)
+
+    def _fetch_factors(self, userid):
         try:
             return self.factorsclient.get_lifecycle_factors(userid)
         except Exception as error:
-            logging.error('Error getting factors {}'.format(error))
-            return None
+            raise AuthException('Error getting factors {}'.format(error))
+
+    def invalidate(self, user=None):
+        '''
+        Drops cached Okta details for a user, or for everyone if no user
+        is given, e.g. after a user re-enrolls their push factor.
+        '''
+        if user is None:
+            self._user_ids.clear()
+            self._factors.clear()
+            return
+        username = self._auth_attribute(user)
+        okta_user_id = self._user_ids.get(username)
+        self._user_ids.invalidate(username)
+        if okta_user_id is not None:
+            self._factors.invalidate(okta_user_id)
+
+    def cache_stats(self):
+        '''Returns hit and miss counters for the user ID and factor caches.'''
+        return {
+            'user_ids': self._user_ids.stats(),
+            'factors': self._factors.stats(),
+        }
 
     def can_auth(self, user):
         # type: () -> bool
         # Check Okta user for a push factor.
         # Returns false is not available
         # Returns factor Id if it is
+        # Raises AuthException if Okta couldn't be asked
         # TODO: Add support for other types of auth (TOTP, etc).
         username = self._auth_attribute(user)
         if username is not False:
@@ -93,15 +150,17 @@ class AuthClient(BaseAuthClient):
         # )
         # Implement our own call which actually works
         okta_user_id = self._get_okta_userid(self._auth_attribute(user))
-        res = self.apiclient.post_path(
-            '/{0}/factors/{1}/verify'.format(
-                okta_user_id,
-                user._factor_id
-            )
-        )
         try:
+            res = self.apiclient.post_path(
+                '/{0}/factors/{1}/verify'.format(
+                    okta_user_id,
+                    user._factor_id
+                )
+            )
             res_obj = json.loads(res.text)
         except Exception as error:
+            # Cached IDs may be stale, so look them up afresh next time
+            self.invalidate(user)
             raise AuthException(error)
 
         self.poll_url[okta_user_id] = res_obj['_links']['poll']['href']
@@ -114,7 +173,14 @@ class AuthClient(BaseAuthClient):
         )
 
         if user._last_auth_state == AuthStates.PENDING:
-            response = self.apiclient.get(self.poll_url[okta_user_id])
+            response = self._session.get(
+                self.poll_url[okta_user_id], timeout=POLL_TIMEOUT
+            )
+            if response.status_code == 429:
+                # Rate limited, the poller will ask again next round
+                logging.warning('Okta rate limit hit polling for push status')
+                return user._last_auth_state
+            response.raise_for_status()
             response_obj = json.loads(response.text)
             res = response_obj['factorResult']
             if res != 'WAITING':
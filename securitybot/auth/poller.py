@@ -0,0 +1,110 @@
+'''
+Coordinates polling of outstanding MFA requests.
+'''
+__author__ = 'Alex Bertsch, Antoine Cardon'
+__email__ = 'abertsch@dropbox.com, antoine.cardon@algolia.com'
+
+import logging
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from securitybot.auth.auth import AuthStates
+
+
+class MfaPoller(object):
+    '''
+    Polls every pending MFA request together at a fixed rate from a
+    background thread, rather than each waiting user polling the auth
+    provider on every step. At most `concurrency` requests are in flight to
+    the provider at once. Finished requests are handed back through a
+    callback.
+    '''
+
+    def __init__(self, authclient, poll_time, concurrency, on_result):
+        '''
+        Args:
+            authclient (AuthClient): The auth provider to poll.
+            poll_time (Timedelta): How often to poll pending requests.
+            concurrency (int): Max number of simultaneous status requests.
+            on_result (function): Called as on_result(user, state) from the
+                                  polling thread once a request completes.
+        '''
+        self._authclient = authclient
+        self._poll_time = poll_time.total_seconds()
+        self._on_result = on_result
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+
+        # Users with an outstanding request, keyed by user ID
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._added = threading.Event()
+        self._thread = None
+
+    def start(self):
+        # type: () -> None
+        '''Starts the polling thread.'''
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def add(self, user):
+        # type: (User) -> None
+        '''
+        Starts polling for a user who has just been sent an MFA request.
+        '''
+        with self._lock:
+            self._pending[user['id']] = user
+        self._added.set()
+
+    def remove(self, user):
+        # type: (User) -> None
+        '''Stops polling for a user.'''
+        with self._lock:
+            self._pending.pop(user['id'], None)
+
+    def pending(self):
+        # type: () -> int
+        '''Returns the number of requests being polled.'''
+        return len(self._pending)
+
+    def poll(self):
+        # type: () -> None
+        '''
+        Polls all pending requests once, reporting any which have finished.
+        '''
+        with self._lock:
+            users = list(self._pending.values())
+        if not users:
+            return
+
+        logging.debug('Polling {} pending MFA requests'.format(len(users)))
+        for user, state in zip(users,
+                               self._executor.map(self._poll_user, users)):
+            if state in (AuthStates.AUTHORIZED, AuthStates.DENIED):
+                self.remove(user)
+                self._on_result(user, state)
+
+    def _poll_user(self, user):
+        try:
+            return self._authclient.auth_status(user)
+        except Exception as error:
+            # Leave it pending and try again next round
+            logging.warning(
+                'Failed to poll MFA status for {}: {}'.format(
+                    user['name'], error
+                )
+            )
+            return AuthStates.PENDING
+
+    def _run(self):
+        while True:
+            # Sleep until there is something to poll, then poll at a fixed
+            # rate for as long as anything is pending
+            self._added.wait()
+            self._added.clear()
+            time.sleep(self._poll_time)
+            self.poll()
+            if self._pending:
+                self._added.set()
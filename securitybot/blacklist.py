@@ -4,19 +4,39 @@ A generic blacklist class.
 __author__ = 'Alex Bertsch, Antoine Cardon'
 __email__ = 'abertsch@dropbox.com, antoine.cardon@algolia.com'
 
+import logging
+import threading
+import time
+
 
 class Blacklist(object):
+    '''
+    A cached copy of the "blacklist" table. At most every `refresh_time`
+    seconds a cheap fingerprint of the table is read, and the names are only
+    reloaded when it has changed, so changes made by other bot instances or
+    directly in the database are seen without a query per lookup.
+    '''
 
-    def __init__(self, dbclient):
-        # type: () -> None
+    def __init__(self, dbclient, refresh_time=60, timer=time.monotonic):
+        # type: (BaseDbClient, float, Callable[[], float]) -> None
         '''
         Creates a new blacklist tied to a table named "blacklist".
+
+        Args:
+            dbclient (BaseDbClient): The database holding the table.
+            refresh_time (float): Seconds between fingerprint checks.
+            timer (function): Returns the current time in seconds.
         '''
-        # Load from table
         self._dbclient = dbclient
-        names = self._dbclient.execute('blacklist_list')
-        # Break tuples into names
-        self._blacklist = {name[0] for name in names}
+        self._refresh_time = refresh_time
+        self._timer = timer
+        self._lock = threading.Lock()
+
+        # Load from table
+        self._version = None
+        self._blacklist = set()
+        self._checked = self._timer()
+        self._load(self._fingerprint())
 
     def is_present(self, name):
         # type: (str) -> bool
@@ -26,8 +46,29 @@ class Blacklist(object):
         Args:
             name (str): The name to check.
         '''
+        self.refresh()
         return name in self._blacklist
 
+    def refresh(self, force=False):
+        # type: (bool) -> bool
+        '''
+        Reloads the blacklist if its fingerprint changed, checking at most
+        every `refresh_time` seconds unless forced.
+
+        Returns:
+            bool: Whether the blacklist was reloaded.
+        '''
+        with self._lock:
+            now = self._timer()
+            if not force and now - self._checked < self._refresh_time:
+                return False
+            self._checked = now
+            version = self._fingerprint()
+            if version is not None and version == self._version:
+                return False
+            self._load(version)
+            return True
+
     def add(self, name):
         # type: (str) -> None
         '''
@@ -36,8 +77,12 @@ class Blacklist(object):
         Args:
             name (str): The name to add to the blacklist.
         '''
-        self._blacklist.add(name)
-        self._dbclient.execute('blacklist_add', (name,))
+        # The write changes the table's fingerprint, so the next lookup
+        # checks it at once
+        with self._lock:
+            self._dbclient.execute('blacklist_add', (name,))
+            self._blacklist.add(name)
+            self._checked = float('-inf')
 
     def remove(self, name):
         # type: (str) -> None
@@ -47,5 +92,27 @@ class Blacklist(object):
         Args:
             name (str): The name to remove from the blacklist.
         '''
-        self._blacklist.remove(name)
-        self._dbclient.execute('blacklist_remove', (name,))
+        with self._lock:
+            self._dbclient.execute('blacklist_remove', (name,))
+            self._blacklist.discard(name)
+            self._checked = float('-inf')
+
+    def _fingerprint(self):
+        '''
+        Returns a value which changes whenever the table does, or None if it
+        couldn't be read, in which case the table is reloaded.
+        '''
+        try:
+            rows = self._dbclient.execute('blacklist_version')
+        except Exception as error:
+            logging.warning(
+                'Failed to read blacklist version: {}'.format(error)
+            )
+            return None
+        return tuple(rows[0]) if rows else ()
+
+    def _load(self, version):
+        names = self._dbclient.execute('blacklist_list')
+        # Break tuples into names
+        self._blacklist = {name[0] for name in names}
+        self._version = version
@@ -8,17 +8,37 @@ __email__ = 'abertsch@dropbox.com, antoine.cardon@algolia.com'
 import logging
 import pytz
 import shlex
+import threading
 import time
 
+from collections import deque
+
 from datetime import datetime, timedelta
 from re import sub
+from typing import Any, Dict, List
 
 from securitybot import loader
 
 from securitybot.user import User
 
+from securitybot.chat.chat import CoalescingChatClient
+
+from securitybot.scheduler import Scheduler, DeadlineHeap
+
+from securitybot.directory import UserDirectory
+
+from securitybot.auth.poller import MfaPoller
+
+from securitybot.auth.capabilities import CapabilityStore
+
+from securitybot.intake import IntakeListener, DEFAULT_PATH
+
+from securitybot.shard import ShardChatClient
+
 from securitybot.blacklist import Blacklist
 
+from securitybot.ignored_alerts import IgnoredAlerts
+
 from securitybot.exceptions import SecretsException
 
 import securitybot.commands as bot_commands
@@ -55,6 +75,10 @@ def clean_input(text):
 
 PUNCTUATION = r'[.,!?\'"`]'
 
+# Upper bound on transitions taken for a user in one go, as a guard against
+# a state machine that never settles
+MAX_USER_STEPS = 10
+
 
 def clean_command(command):
     # type: (str) -> str
@@ -71,7 +95,7 @@ class SecurityBot(object):
     It's always dangerous naming classes the same name as the project...
     '''
 
-    def __init__(self, config):
+    def __init__(self, config, shard=None):
         '''
         Args:
             chat (ChatClient):
@@ -84,13 +108,25 @@ class SecurityBot(object):
                 Channel ID to report alerts in need of verification to.
             config_path (str):
                 Path to configuration file
+            shard (Shard):
+                When run as one of several workers, which users this bot
+                owns, see securitybot/shard.py.
         '''
         logging.info('Creating securitybot.')
+        self._shard = shard
+        self._shard_chat = None
         self._last_task_poll = datetime.min.replace(tzinfo=pytz.utc)
         self._last_report = datetime.min.replace(tzinfo=pytz.utc)
         self._task_poll_time = timedelta(
             seconds=int(config['bot']['timers']['task_poll_time'])
         )
+        self._mfa_poll_time = timedelta(
+            seconds=int(config['bot']['timers'].get('mfa_poll_time', 2))
+        )
+        self._last_stats_log = datetime.min.replace(tzinfo=pytz.utc)
+        self._stats_log_time = timedelta(
+            seconds=int(config['bot']['timers'].get('stats_log_time', 300))
+        )
         self._opening_time = config['bot']['time']['opening_hour']
         self._closing_time = config['bot']['time']['closing_hour']
         self._local_tz = pytz.timezone(config['bot']['time']['local_tz'])
@@ -107,7 +143,21 @@ class SecurityBot(object):
         # Connect to the chosen auth/db/chat providers
         self._init_providers()
 
-        self.tasker = loader.build_tasker(self._dbclient)
+        # Remembers which users can do MFA, looked up on demand
+        capabilities = config['auth'].get('capabilities', None) or {}
+        self._capabilities = CapabilityStore(
+            authclient=self._authclient,
+            path=capabilities.get('cache_path', None),
+            ttl=int(capabilities.get('cache_ttl', 86400)),
+            workers=int(capabilities.get('prefetch_workers', 4))
+        )
+
+        self.tasker = loader.build_tasker(
+            self._dbclient,
+            reconcile_time=int(
+                config['bot']['timers'].get('task_reconcile_time', 600)
+            )
+        )
 
         self._import_commands(
             config=loader.load_yaml(
@@ -119,15 +169,71 @@ class SecurityBot(object):
         )
 
         # Load blacklist from DB
-        self.blacklist = Blacklist(self._dbclient)
+        self.blacklist = Blacklist(
+            self._dbclient,
+            refresh_time=int(
+                config['bot']['timers'].get('blacklist_refresh_time', 60)
+            )
+        )
+
+        # Alerts users asked to ignore for a while, kept in memory
+        self.ignored = IgnoredAlerts(
+            self._dbclient,
+            refresh_time=int(
+                config['bot']['timers'].get('ignored_refresh_time', 300)
+            )
+        )
 
-        # A dictionary to be populated with all members of the team
+        # All members of the team live in an on-disk directory. User
+        # objects are only built for members the bot deals with.
+        directory = config['bot'].get('directory', None) or {}
+        self._directory = UserDirectory(directory.get('path', None))
+        self._directory_refresh_time = int(
+            directory.get('refresh_time', 86400)
+        )
         self.users = {}
-        self.users_by_name = {}
+        self._users_lock = threading.Lock()
         self._populate_users()
 
-        # Dictionary of users who have outstanding tasks
+        # Dictionary of users who have outstanding tasks. It and the
+        # deadlines below are shared with executor threads when running
+        # under asyncio, so both are only touched under this lock
         self.active_users = {}
+        self._active_lock = threading.RLock()
+
+        # Sleeps the main loop until there is work to do, the IDs of
+        # active users who need stepping on the next pass, and the next
+        # escalation or MFA poll deadline of each active user
+        self._scheduler = Scheduler()
+        self._woken_users = set()
+        self._deadlines = DeadlineHeap()
+        # IDs of users woken from other threads, drained by the main loop
+        self._notified_users = deque()
+        # Completed tasks waiting to be removed from the database together
+        self._finished_tasks = deque()
+
+        # Set when an alert writer announces new alerts, so they are
+        # picked up at once rather than on the next timed poll
+        intake_config = config['bot'].get('intake', None) or {}
+        self._intake_path = None
+        self._intake = None
+        if intake_config.get('enabled', True):
+            self._intake_path = intake_config.get('path', DEFAULT_PATH)
+            self._intake = IntakeListener(
+                path=self._intake_path,
+                on_notify=self._alerts_announced
+            )
+        self._new_alerts = threading.Event()
+        if self._shard_chat is not None:
+            self._shard_chat.set_new_alerts_callback(self._alerts_announced)
+
+        # Polls all outstanding MFA requests together
+        self._mfa_poller = MfaPoller(
+            authclient=self._authclient,
+            poll_time=self._mfa_poll_time,
+            concurrency=int(config['auth'].get('poll_concurrency', 10)),
+            on_result=self._auth_polled
+        )
 
         # Recover tasks
         self.recover_in_progress_tasks()
@@ -169,10 +275,22 @@ class SecurityBot(object):
             reauth_time=self._config['auth']['reauth_time'],
             auth_attrib=self._config['auth']['auth_attrib']
         )
-        self._chatclient = loader.build_chat_client(
+        # Messages are held and merged per recipient until the end of
+        # each step, see `flush_messages`
+        chatclient = loader.build_chat_client(
             chat_provider=chat_provider,
             connection_config=self._config['chat'][chat_provider]
         )
+        if self._shard is not None:
+            # Events come from the ingress rather than the chat system
+            chatclient = self._shard_chat = ShardChatClient(
+                chatclient,
+                self._shard.events,
+                inbox_size=self._config['chat'][chat_provider].get(
+                    'inbox_size', 1000
+                )
+            )
+        self._chatclient = CoalescingChatClient(chatclient)
 
     def _import_commands(self, config) -> None:
         '''
@@ -197,17 +315,142 @@ class SecurityBot(object):
         # type: () -> None
         '''
         Main loop for the bot.
-        '''
+        Sleeps until a message arrives or until the next timer (task polling,
+        escalation or MFA polling) is due, then handles whatever woke it.
+        '''
+        self._chatclient.set_wakeup(self.wake)
+        self._mfa_poller.start()
+        self.ignored.start()
+        if self._intake is not None:
+            self._intake.start()
         while True:
-            now = datetime.now(tz=pytz.utc)
-            if now - self._last_task_poll > self._task_poll_time:
-                self._last_task_poll = now
+            if self._tasks_due():
                 self.handle_new_tasks()
                 self.handle_in_progress_tasks()
                 self.handle_verifying_tasks()
+            self.handle_user_updates()
             self.handle_messages()
             self.handle_users()
-            time.sleep(.1)
+            # Finished tasks first, so a crash in between can lose a
+            # farewell message but never re-alert a user
+            self.flush_finished_tasks()
+            self.flush_messages()
+            self.log_stats()
+            self._scheduler.wait(until=self._next_wakeup())
+
+    def wake(self):
+        # type: () -> None
+        '''
+        Wakes the main loop. Safe to call from any thread.
+        '''
+        self._scheduler.wake()
+
+    def _alerts_announced(self):
+        # type: () -> None
+        self._new_alerts.set()
+        self.wake()
+
+    def _tasks_due(self):
+        # type: () -> bool
+        '''
+        Returns whether to poll for tasks now, because new alerts were
+        announced or the fallback poll timer is up, and resets both.
+        '''
+        now = datetime.now(tz=pytz.utc)
+        if not self._new_alerts.is_set() and \
+                now - self._last_task_poll <= self._task_poll_time:
+            return False
+        self._new_alerts.clear()
+        self._last_task_poll = now
+        return True
+
+    def log_stats(self):
+        # type: () -> None
+        '''
+        Logs the chat client's counters for outgoing and received messages,
+        at most every `stats_log_time` seconds. Zero turns this off.
+        '''
+        now = datetime.now(tz=pytz.utc)
+        if not self._stats_log_time or \
+                now - self._last_stats_log < self._stats_log_time:
+            return
+        self._last_stats_log = now
+        logging.info('Chat outbox: {}, inbox: {}'.format(
+            self._chatclient.outbox_stats(), self._chatclient.inbox_stats())
+        )
+
+    def flush_messages(self, user_id=None):
+        # type: (str) -> None
+        '''
+        Sends all messages held since the last flush, merging those to the
+        same recipient.
+
+        Args:
+            user_id (str): Only send messages for this user, and to channels.
+        '''
+        self._chatclient.flush(user_id)
+
+    def finish_task(self, task):
+        # type: (Task) -> None
+        '''
+        Queues a completed task to be removed from the database with the
+        rest finished in the same step, see `flush_finished_tasks`. Should
+        the bot stop before then, the task is still open when it restarts
+        and the user is asked about it again, so completion is at least
+        once.
+        '''
+        self._finished_tasks.append(task)
+
+    def flush_finished_tasks(self):
+        # type: () -> None
+        '''
+        Removes every task completed since the last flush from the
+        database together.
+        '''
+        tasks = []
+        while self._finished_tasks:
+            tasks.append(self._finished_tasks.popleft())
+        if tasks:
+            self.tasker.finalise_many(tasks)
+
+    def _next_wakeup(self):
+        # type: () -> datetime
+        '''
+        Returns the earliest time at which the main loop has work to do.
+        '''
+        wakeup = self._last_task_poll + self._task_poll_time
+        with self._active_lock:
+            user_wakeup = self._deadlines.peek()
+        if user_wakeup is not None and user_wakeup < wakeup:
+            wakeup = user_wakeup
+        return wakeup
+
+    def notify_user(self, user):
+        # type: (User) -> None
+        '''
+        Thread safe version of `wake_user`, for use by background threads.
+        '''
+        self._notified_users.append(user['id'])
+        self._scheduler.wake()
+
+    def _auth_polled(self, user, state):
+        # type: (User, int) -> None
+        '''
+        Called by the MFA poller once a user's request has completed.
+        '''
+        user.auth_polled(state)
+        self.notify_user(user)
+
+    def wake_user(self, user):
+        # type: (User) -> None
+        '''
+        Flags an active user as needing to be stepped on the next pass
+        of the main loop.
+        '''
+        with self._active_lock:
+            active = user['id'] in self.active_users
+        if active:
+            self._woken_users.add(user['id'])
 
     def handle_messages(self):
         # type: () -> None
@@ -218,19 +461,27 @@ class SecurityBot(object):
         '''
         messages = self._chatclient.get_messages()
         for message in messages:
-            user_id = message['user']
-            text = message['text']
-            user = self.user_lookup(user_id)
-
-            # Parse each received line as a command, otherwise
-            # send an error message
-            if self.is_command(text):
-                self.handle_command(user, text)
-            else:
-                self._chatclient.message_user(
-                    user,
-                    self.messages['bad_command']
-                )
+            self.handle_message(message)
+
+    def handle_message(self, message):
+        # type: (Dict[str, Any]) -> None
+        '''
+        Handles a single message sent to securitybot.
+        '''
+        user_id = message['user']
+        text = message['text']
+        user = self.user_lookup(user_id)
+
+        # Parse each received line as a command, otherwise
+        # send an error message
+        if self.is_command(text):
+            self.handle_command(user, text)
+            self.wake_user(user)
+        else:
+            self._chatclient.message_user(
+                user,
+                self.messages['bad_command']
+            )
 
     def handle_command(self, user, command):
         # type: (User, str) -> None
@@ -280,12 +531,16 @@ class SecurityBot(object):
             else:
                 user = self.user_lookup_by_name(username)
                 user_id = user['id']
-                if user_id not in self.active_users:
-                    logging.debug('Adding {} to active users'.format(username))
-                    self.active_users[user_id] = user
+                with self._active_lock:
+                    if user_id not in self.active_users:
+                        logging.debug(
+                            'Adding {} to active users'.format(username)
+                        )
+                        self.active_users[user_id] = user
 
                 user.add_task(task)
                 task.set_in_progress()
+                self.wake_user(user)
         else:
             # Escalate if no valid user is found
             logging.warn('Invalid user: {0}'.format(username))
@@ -297,12 +552,55 @@ class SecurityBot(object):
         '''
         Handles all new tasks.
         '''
-        for task in self.tasker.get_new_tasks():
+        for task in self.claim_tasks(self.tasker.get_new_tasks()):
             # Log new task
             logging.info('Handling new task for {0}'.format(task.username))
 
             self._add_task(task)
 
+    def task_key(self, task):
+        # type: (Task) -> str
+        '''
+        Returns the chat ID of the user a task is for, or the task's
+        username if there is no such user.
+        '''
+        member = self._directory.by_name(task.username)
+        return member['id'] if member is not None else task.username
+
+    def claim_tasks(self, tasks):
+        # type: (List[Task]) -> List[Task]
+        '''
+        When sharded, keeps only the tasks for users this worker owns and
+        which it could claim in the database, renewing its claims on the
+        tasks it is handling on the way. Otherwise every task is kept.
+        '''
+        if self._shard is None:
+            return list(tasks)
+        self.tasker.renew_leases(
+            self.held_tasks(), self._shard.owner, self._shard.lease_time
+        )
+        owned = [
+            task for task in tasks if self._shard.owns(self.task_key(task))
+        ]
+        return self.tasker.claim(
+            owned, self._shard.owner, self._shard.lease_time,
+            self._shard.peers
+        )
+
+    def held_tasks(self):
+        # type: () -> List[Task]
+        '''
+        Returns the tasks the active users are being asked about.
+        '''
+        tasks = []
+        with self._active_lock:
+            users = list(self.active_users.values())
+        for user in users:
+            tasks.extend(user.tasks)
+            if user.pending_task is not None:
+                tasks.append(user.pending_task)
+        return tasks
+
     def handle_in_progress_tasks(self):
         # type: () -> None
         '''
@@ -315,7 +613,7 @@ class SecurityBot(object):
         '''
         Recovers in progress tasks from a previous run.
         '''
-        for task in self.tasker.get_active_tasks():
+        for task in self.claim_tasks(self.tasker.get_active_tasks()):
             # Log new task
             logging.info('Recovering task for {0}'.format(task.username))
 
@@ -331,11 +629,57 @@ class SecurityBot(object):
     def handle_users(self):
         # type: () -> None
         '''
-        Handles all users.
+        Handles all users which have been woken by a message or new task,
+        or whose escalation or MFA timers have come due.
         '''
-        for user_id in self.active_users.copy().keys():
-            user = self.active_users[user_id]
-            user.step()
+        due = self._woken_users
+        self._woken_users = set()
+        while self._notified_users:
+            due.add(self._notified_users.popleft())
+        with self._active_lock:
+            due.update(self._deadlines.pop_due(datetime.now(tz=pytz.utc)))
+
+        for user_id in due:
+            user = self.get_active_user(user_id)
+            if user is not None:
+                self._step_user(user)
+
+    def _step_user(self, user):
+        # type: (User) -> None
+        '''
+        Steps a user and reschedules their next deadline.
+        '''
+        self._settle_user(user)
+        with self._active_lock:
+            if user['id'] in self.active_users:
+                self._deadlines.schedule(user['id'], user.next_wakeup())
+
+    def get_active_user(self, user_id):
+        # type: (str) -> User
+        '''
+        Returns the active user with the given ID, or None if they have no
+        outstanding tasks.
+        '''
+        with self._active_lock:
+            return self.active_users.get(user_id, None)
+
+    def active_user_ids(self):
+        # type: () -> List[str]
+        '''
+        Returns the IDs of all users with outstanding tasks.
+        '''
+        with self._active_lock:
+            return list(self.active_users.keys())
+
+    def _settle_user(self, user):
+        # type: (User) -> None
+        '''
+        Steps a user until their state machine settles, so chained
+        transitions happen now rather than on later wakeups.
+        '''
+        for _ in range(MAX_USER_STEPS):
+            if not user.step():
+                break
 
     def cleanup_user(self, user):
         # type: (User) -> None
@@ -344,8 +688,12 @@ class SecurityBot(object):
         tasks.
         '''
         logging.debug('Removing {} from active users'.format(user['name']))
-        self.active_users.pop(user['id'], None)
-        logging.debug('Current active users: {}'.format(self.active_users))
+        with self._active_lock:
+            self.active_users.pop(user['id'], None)
+            self._deadlines.cancel(user['id'])
+            logging.debug(
+                'Current active users: {}'.format(self.active_users)
+            )
 
 
     def alert_user(self, user, task):
@@ -372,21 +720,73 @@ class SecurityBot(object):
     def _populate_users(self):
         # type: () -> None
         '''
-        Populates the members dictionary mapping user IDs to username, avatar,
-        etc.
+        Populates the member directory mapping user IDs to username, avatar,
+        etc. A recent directory from a previous run is used as is, and kept
+        up to date by join and profile change events; a stale one is
+        refreshed in the background.
+        '''
+        age = time.time() - self._directory.last_refresh()
+        if len(self._directory) == 0:
+            self._refresh_directory()
+        elif age > self._directory_refresh_time:
+            threading.Thread(
+                target=self._refresh_directory, daemon=True
+            ).start()
+        else:
+            logging.info('Using cached directory of {} users.'.format(
+                len(self._directory))
+            )
+
+        capabilities = self._config['auth'].get('capabilities', None) or {}
+        if capabilities.get('prefetch', False):
+            self._capabilities.prefetch(
+                self._build_user(member)
+                for member in self._directory.members()
+            )
+
+    def _refresh_directory(self):
+        # type: () -> None
+        '''
+        Streams every team member from chat into the directory.
         '''
         logging.info('Gathering information about all team members...')
-        members = self._chatclient.get_users()
-        for member in members:
-            user = User(
-                user=member,
-                auth=self._authclient,
-                dbclient=self._dbclient,
-                parent=self
-            )
-            self.users[member['id']] = user
-            self.users_by_name[member['name']] = user
-        logging.info('Gathered info on {} users.'.format(len(self.users)))
+        count = self._directory.refresh(self._chatclient.get_users())
+        logging.info('Gathered info on {} users.'.format(count))
+
+    def handle_user_updates(self):
+        # type: () -> None
+        '''
+        Applies joins and profile changes reported by the chat system.
+        '''
+        for member in self._chatclient.get_user_updates():
+            logging.debug('Updating directory for {}'.format(member['id']))
+            self._directory.upsert(member)
+            with self._users_lock:
+                user = self.users.get(member['id'], None)
+                if user is not None:
+                    user.update_info(member)
+
+    def _build_user(self, member):
+        # type: (Dict[str, Any]) -> User
+        return User(
+            user=member,
+            auth=self._authclient,
+            dbclient=self._dbclient,
+            parent=self
+        )
+
+    def _get_user(self, member):
+        # type: (Dict[str, Any]) -> User
+        '''
+        Returns the one User object for a directory member, building it on
+        first use.
+        '''
+        with self._users_lock:
+            user = self.users.get(member['id'], None)
+            if user is None:
+                user = self._build_user(member)
+                self.users[member['id']] = user
+            return user
 
     def user_lookup(self, id):
         # type: (str) -> User
@@ -398,9 +798,13 @@ class SecurityBot(object):
         Returns:
             (dict): All known information about that user.
         '''
-        if id not in self.users:
+        user = self.users.get(id, None)
+        if user is not None:
+            return user
+        member = self._directory.by_id(id)
+        if member is None:
             raise SecurityBotException('User {} not found'.format(id))
-        return self.users[id]
+        return self._get_user(member)
 
     def user_lookup_by_name(self, username):
         # type: (str) -> User
@@ -412,9 +816,10 @@ class SecurityBot(object):
         Resturns:
             (dict): All known information about that user.
         '''
-        if username not in self.users_by_name:
+        member = self._directory.by_name(username)
+        if member is None:
             raise SecurityBotException('User {} not found'.format(username))
-        return self.users_by_name[username]
+        return self._get_user(member)
 
     # Chat methods
 
@@ -0,0 +1,111 @@
+'''
+A small in-memory cache with time based expiry and LRU eviction, used to
+avoid repeating expensive lookups against external services.
+'''
+__author__ = 'Alex Bertsch, Antoine Cardon'
+__email__ = 'abertsch@dropbox.com, antoine.cardon@algolia.com'
+
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    '''
+    A thread safe mapping whose entries expire `ttl` seconds after being
+    set. Once `maxsize` entries are held, the least recently used entry is
+    evicted to make room. Hits and misses are counted for monitoring.
+    '''
+
+    def __init__(self, maxsize, ttl=None, timer=time.monotonic):
+        '''
+        Args:
+            maxsize (int): Maximum number of entries to hold.
+            ttl (float): Seconds an entry lives for, or None to never expire.
+            timer (function): Returns the current time in seconds.
+        '''
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._timer = timer
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        # type: () -> int
+        return len(self._data)
+
+    def __contains__(self, key):
+        # type: (Any) -> bool
+        return self._lookup(key) is not None
+
+    def get(self, key, default=None):
+        '''
+        Returns the value cached for a key, or `default` if it is missing
+        or has expired.
+        '''
+        entry = self._lookup(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        # type: (Any, Any) -> None
+        '''Caches a value, evicting the least recently used if full.'''
+        expires = None
+        if self.ttl is not None:
+            expires = self._timer() + self.ttl
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_load(self, key, loader):
+        '''
+        Returns the cached value for a key, calling `loader(key)` and caching
+        its result on a miss. Results of None are not cached.
+        '''
+        entry = self._lookup(key)
+        with self._lock:
+            if entry is not None:
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        value = loader(key)
+        if value is not None:
+            self.set(key, value)
+        return value
+
+    def invalidate(self, key):
+        # type: (Any) -> None
+        '''Drops a single key from the cache.'''
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        # type: () -> None
+        '''Drops every entry from the cache.'''
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        # type: () -> Dict[str, int]
+        '''Returns hit, miss and size counters.'''
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self)}
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._data.get(key, None)
+            if entry is None:
+                return None
+            if entry[1] is not None and entry[1] <= self._timer():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return entry
@@ -5,16 +5,25 @@ like Slack.
 __author__ = 'Alex Bertsch, Antoine Cardon'
 __email__ = 'abertsch@dropbox.com, antoine.cardon@algolia.com'
 
+import logging
+import threading
+
 from abc import ABCMeta, abstractmethod
-from typing import List, Dict, Any
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List
 
 from securitybot.user import User
 
+# Longest message built by merging, to stay well inside chat size limits
+MAX_COALESCED_LENGTH = 4000
+
 
 class BaseChatClient(object, metaclass=ABCMeta):
     '''
     A wrapper over various chat frameworks, like Slack.
     '''
+    # Callback used to tell the bot that new messages are waiting
+    _wakeup = None
 
     @abstractmethod
     def connect(self) -> None:
@@ -22,12 +31,13 @@ class BaseChatClient(object, metaclass=ABCMeta):
         pass
 
     @abstractmethod
-    def get_users(self) -> List[Dict[str, Any]]:
+    def get_users(self) -> Iterable[Dict[str, Any]]:
         '''
-        Returns a list of all users in the chat system.
+        Returns all users in the chat system. Implementations should stream
+        users page by page rather than building one big list.
 
         Returns:
-            A list of dictionaries, each dictionary representing a user.
+            An iterable of dictionaries, each dictionary representing a user.
             The rest of the bot expects the following minimal format:
             {
                 "name": The username of a user,
@@ -71,3 +81,157 @@ class BaseChatClient(object, metaclass=ABCMeta):
         object and a string message.
         '''
         pass
+
+    def report(self, user: User, message: str) -> None:
+        '''
+        Posts a message about a user, such as an escalation, to the
+        reporting channel.
+        '''
+        self.send_message(self.reporting_channel, message)
+
+    def outbox_stats(self) -> Dict[str, Any]:
+        '''
+        Returns counters about outgoing messages. Chat systems which don't
+        keep any can leave this as is.
+        '''
+        return {}
+
+    def inbox_stats(self) -> Dict[str, Any]:
+        '''
+        Returns counters about received messages. Chat systems which don't
+        keep any can leave this as is.
+        '''
+        return {}
+
+    def get_user_updates(self) -> List[Dict[str, Any]]:
+        '''
+        Returns users who have joined or changed their details since the
+        last call, in the same format as `get_users`. Chat systems which
+        don't push such events can leave this as is.
+        '''
+        return []
+
+    def set_wakeup(self, callback: Callable[[], None]) -> None:
+        '''
+        Registers a function to call whenever new messages arrive, so the
+        bot can sleep rather than polling `get_messages`. The callback may
+        be invoked from any thread.
+        '''
+        self._wakeup = callback
+
+    def _notify_wakeup(self) -> None:
+        '''Signals the registered wakeup callback, if any.'''
+        if self._wakeup is not None:
+            self._wakeup()
+
+
+class CoalescingChatClient(BaseChatClient):
+    '''
+    Wraps a chat client, holding back outgoing messages until `flush` is
+    called and then merging consecutive messages to the same user or
+    channel into one. The bot flushes once per step, so a greeting, alert
+    and prompt go out as a single message. Reports are merged per user
+    they are about, so each escalation stays a post of its own.
+    '''
+
+    def __init__(self, client: BaseChatClient) -> None:
+        '''
+        Args:
+            client (BaseChatClient): The client to send messages through.
+        '''
+        self._client = client
+        self.reporting_channel = client.reporting_channel
+        # Map of (kind, ID) to [recipient, [messages]], in first-send order
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        # Merged messages the wrapped client failed to send
+        self.failed = 0
+
+    def connect(self) -> None:
+        self._client.connect()
+
+    def get_users(self) -> Iterable[Dict[str, Any]]:
+        return self._client.get_users()
+
+    def get_messages(self) -> List[Dict[str, Any]]:
+        return self._client.get_messages()
+
+    def get_user_updates(self) -> List[Dict[str, Any]]:
+        return self._client.get_user_updates()
+
+    def set_wakeup(self, callback: Callable[[], None]) -> None:
+        self._client.set_wakeup(callback)
+
+    def outbox_stats(self) -> Dict[str, Any]:
+        stats = dict(self._client.outbox_stats())
+        stats['coalesced_failed'] = self.failed
+        return stats
+
+    def inbox_stats(self) -> Dict[str, Any]:
+        return self._client.inbox_stats()
+
+    def send_message(self, channel: Any, message: str) -> None:
+        self._queue(('channel', channel), channel, message)
+
+    def message_user(self, user: User, message: str) -> None:
+        self._queue(('user', user['id']), user, message)
+
+    def report(self, user: User, message: str) -> None:
+        self._queue(('report', user['id']), self.reporting_channel, message)
+
+    def flush(self, user_id: str = None) -> None:
+        '''
+        Sends all held messages, merged per recipient. Messages the wrapped
+        client fails to send are logged and counted in `failed`.
+
+        Args:
+            user_id (str): If given, only send messages for and reports
+                           about this user, and messages for channels,
+                           leaving other users' held.
+        '''
+        with self._lock:
+            if user_id is None:
+                keys = list(self._pending.keys())
+            else:
+                keys = [
+                    key for key in self._pending
+                    if key[0] == 'channel' or key[1] == user_id
+                ]
+            batches = [(key, self._pending.pop(key)) for key in keys]
+
+        for key, (recipient, messages) in batches:
+            for text in _merge(messages):
+                try:
+                    if key[0] == 'user':
+                        self._client.message_user(recipient, text)
+                    else:
+                        self._client.send_message(recipient, text)
+                except Exception as error:
+                    self.failed += 1
+                    logging.error(
+                        'Failed to send message to {} ({} so far): {}'.format(
+                            key[1], self.failed, error
+                        )
+                    )
+
+    def _queue(self, key, recipient, message):
+        with self._lock:
+            if key not in self._pending:
+                self._pending[key] = [recipient, []]
+            self._pending[key][1].append(message)
+
+
+def _merge(messages: List[str]) -> List[str]:
+    '''
+    Joins messages into as few as possible, each at most
+    MAX_COALESCED_LENGTH long unless a single message is longer.
+    '''
+    merged = []
+    for message in messages:
+        if merged and \
+                len(merged[-1]) + len(message) + 1 <= MAX_COALESCED_LENGTH:
+            merged[-1] = '{}\n{}'.format(merged[-1], message)
+        else:
+            merged.append(message)
+    return merged
+
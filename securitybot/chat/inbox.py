@@ -0,0 +1,120 @@
+'''
+A bounded queue for handing incoming chat events from the chat client's
+receiving thread to the bot's main loop.
+'''
+__author__ = 'Alex Bertsch, Antoine Cardon'
+__email__ = 'abertsch@dropbox.com, antoine.cardon@algolia.com'
+
+import logging
+import queue
+import threading
+import time
+
+from typing import Any, Callable, Dict, List
+
+
+class Inbox(object):
+    '''
+    A thread safe, bounded FIFO of received events. Adding never blocks
+    the receiving thread: once full, new events are dropped and counted.
+    Each event's time in the inbox is measured as it is taken, so slow
+    handling shows up as lag.
+    '''
+
+    def __init__(self, maxsize=1000, on_put=None, timer=time.monotonic):
+        '''
+        Args:
+            maxsize (int): Max events held before new ones are dropped.
+            on_put (function): Called after each event is added, e.g. to
+                               wake the main loop.
+            timer (function): Returns the current time in seconds.
+        '''
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._on_put = on_put
+        self._timer = timer
+        self._lock = threading.Lock()
+
+        self.received = 0
+        self.dropped = 0
+        self._lag_total = 0.0
+        self._lag_max = 0.0
+        self._taken = 0
+
+    def __len__(self):
+        # type: () -> int
+        return self._queue.qsize()
+
+    def put(self, event: Any) -> bool:
+        '''
+        Adds an event, without blocking.
+
+        Returns:
+            bool: False if the inbox was full and the event was dropped.
+        '''
+        try:
+            self._queue.put_nowait((self._timer(), event))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+                dropped = self.dropped
+            logging.warning('Inbox full, dropped event ({} so far)'.format(
+                dropped)
+            )
+            return False
+
+        with self._lock:
+            self.received += 1
+        if self._on_put is not None:
+            self._on_put()
+        return True
+
+    def get_all(self) -> List[Any]:
+        '''
+        Takes every event currently queued, oldest first, without waiting.
+        Events arriving meanwhile are left for the next call.
+        '''
+        events = []
+        now = self._timer()
+        for _ in range(self._queue.qsize()):
+            try:
+                received, event = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            events.append(event)
+            self._record_lag(now - received)
+        return events
+
+    def get(self, timeout: float = None) -> Any:
+        '''
+        Waits for and takes the next event.
+
+        Returns:
+            The event, or None if the timeout passed first.
+        '''
+        try:
+            received, event = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        self._record_lag(self._timer() - received)
+        return event
+
+    def stats(self) -> Dict[str, Any]:
+        '''
+        Returns the depth, received and dropped counters, and the average
+        and worst seconds an event waited to be taken.
+        '''
+        with self._lock:
+            return {
+                'depth': len(self),
+                'received': self.received,
+                'dropped': self.dropped,
+                'lag_avg': self._lag_total / self._taken
+                if self._taken else 0.0,
+                'lag_max': self._lag_max,
+            }
+
+    def _record_lag(self, lag):
+        with self._lock:
+            self._taken += 1
+            self._lag_total += lag
+            self._lag_max = max(self._lag_max, lag)
@@ -0,0 +1,306 @@
+'''
+A rate limited, prioritised queue of outgoing chat API calls, sent from a
+background thread so a slow or throttled chat system never blocks the bot.
+'''
+__author__ = 'Alex Bertsch, Antoine Cardon'
+__email__ = 'abertsch@dropbox.com, antoine.cardon@algolia.com'
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from typing import Any, Callable, Dict
+
+# Priorities, lowest first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+
+# Per key buckets held before full (i.e. idle) ones are discarded
+MAX_IDLE_KEYS = 1000
+
+
+class TokenBucket(object):
+    '''
+    Allows `rate` operations per second on average, in bursts of up to
+    `burst`.
+    '''
+
+    def __init__(self, rate, burst, timer=time.monotonic):
+        '''
+        Args:
+            rate (float): Tokens added per second.
+            burst (float): Max tokens held.
+            timer (function): Returns the current time in seconds.
+        '''
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._timer = timer
+        self._tokens = self.burst
+        self._updated = timer()
+
+    def wait_time(self) -> float:
+        '''Returns the seconds until a token is available, 0 if now.'''
+        self._refill()
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    def full(self) -> bool:
+        '''Returns whether the bucket has refilled completely.'''
+        self._refill()
+        return self._tokens >= self.burst
+
+    def consume(self) -> None:
+        '''Takes a token, which may leave the bucket in debt.'''
+        self._refill()
+        self._tokens -= 1
+
+    def _refill(self):
+        now = self._timer()
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+
+class _Outgoing(object):
+    '''A queued call and its bookkeeping.'''
+
+    def __init__(self, seq, key, job, priority, enqueued):
+        self.seq = seq
+        self.key = key
+        self.job = job
+        self.priority = priority
+        self.enqueued = enqueued
+        self.attempts = 0
+
+
+class Outbox(object):
+    '''
+    Runs queued calls one at a time, highest priority first and in order
+    for any one key (e.g. a channel). Calls are limited by a token bucket
+    for the API method as a whole and one per key. Failed calls are
+    retried with exponential backoff, or after the delay the API asks for
+    when rate limited, during which later calls for the key are held so
+    they stay in order.
+    '''
+
+    def __init__(self, rate=20, burst=20, key_rate=1, key_burst=3,
+                 max_retries=5, backoff=1, max_backoff=60,
+                 retry_after=None, retryable=None, timer=time.monotonic):
+        '''
+        Args:
+            rate (float): Calls per second across all keys.
+            burst (float): Calls allowed at once across all keys.
+            key_rate (float): Calls per second for a single key.
+            key_burst (float): Calls allowed at once for a single key.
+            max_retries (int): Retries of a failing call before dropping it.
+            backoff (float): Seconds before the first retry, doubling after.
+            max_backoff (float): Longest wait between retries.
+            retry_after (function): Given an error, returns the seconds the
+                                    API asked to wait, or None if it was not
+                                    a rate limit.
+            retryable (function): Given an error, returns whether retrying
+                                  could help.
+            timer (function): Returns the current time in seconds.
+        '''
+        self._bucket = TokenBucket(rate, burst, timer)
+        self._key_rate = key_rate
+        self._key_burst = key_burst
+        self._key_buckets = {}  # type: Dict[Any, TokenBucket]
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._retry_after = retry_after or (lambda error: None)
+        self._retryable = retryable or (lambda error: True)
+        self._timer = timer
+
+        # Heaps of (priority, seq, call) ready to send and of
+        # (not before, seq, call) held back by a limit or a retry
+        self._ready = []
+        self._delayed = []
+        self._paused_until = 0
+        self._key_paused_until = {}
+        self._in_flight = 0
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+        self.sent = 0
+        self.retried = 0
+        self.dropped = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+    def start(self) -> None:
+        '''Starts sending from a background thread.'''
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def put(self, key: Any, job: Callable[[], Any],
+            priority: int = PRIORITY_NORMAL) -> None:
+        '''
+        Queues a call.
+
+        Args:
+            key (Any): What the call is limited and ordered by, e.g. a
+                       channel.
+            job (function): Makes the API call, raising on failure.
+            priority (int): PRIORITY_HIGH or PRIORITY_NORMAL.
+        '''
+        with self._cond:
+            call = _Outgoing(
+                next(self._seq), key, job, priority, self._timer()
+            )
+            heapq.heappush(self._ready, (priority, call.seq, call))
+            self._cond.notify_all()
+
+    def depth(self) -> int:
+        '''Returns the number of calls waiting to be sent.'''
+        with self._cond:
+            return len(self._ready) + len(self._delayed)
+
+    def join(self, timeout: float = None) -> bool:
+        '''
+        Waits until everything queued has been sent or dropped.
+
+        Returns:
+            bool: False if the timeout passed first.
+        '''
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not (self._ready or self._delayed or self._in_flight),
+                timeout
+            )
+
+    def stats(self) -> Dict[str, Any]:
+        '''
+        Returns queue depth, send counters, and the average and worst time
+        in seconds from queueing a call to it succeeding.
+        '''
+        with self._cond:
+            return {
+                'depth': len(self._ready) + len(self._delayed),
+                'sent': self.sent,
+                'retried': self.retried,
+                'dropped': self.dropped,
+                'latency_avg': self._latency_total / self.sent
+                if self.sent else 0.0,
+                'latency_max': self._latency_max,
+            }
+
+    def _run(self):
+        while True:
+            with self._cond:
+                call = self._next()
+                self._in_flight += 1
+
+            error = None
+            try:
+                call.job()
+            except Exception as e:
+                error = e
+
+            with self._cond:
+                self._in_flight -= 1
+                if error is None:
+                    self._record_sent(call)
+                else:
+                    self._failed(call, error)
+                self._cond.notify_all()
+
+    def _next(self):
+        '''
+        Waits for the next call allowed to be sent and takes tokens for it.
+        Must be called holding the lock.
+        '''
+        while True:
+            now = self._timer()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, seq, call = heapq.heappop(self._delayed)
+                heapq.heappush(self._ready, (call.priority, seq, call))
+
+            if not self._ready:
+                timeout = None
+                if self._delayed:
+                    timeout = self._delayed[0][0] - now
+                self._cond.wait(timeout)
+                continue
+
+            _, seq, call = self._ready[0]
+            key_bucket = self._key_bucket(call.key)
+            paused_until = self._key_paused_until.get(call.key, 0)
+            if paused_until and paused_until <= now:
+                del self._key_paused_until[call.key]
+            wait = max(key_bucket.wait_time(), paused_until - now)
+            if wait > 0:
+                # Only this key is held up, so let other calls go first
+                heapq.heappop(self._ready)
+                heapq.heappush(self._delayed, (now + wait, seq, call))
+                continue
+
+            wait = max(self._bucket.wait_time(), self._paused_until - now)
+            if wait > 0:
+                self._cond.wait(wait)
+                continue
+
+            heapq.heappop(self._ready)
+            self._bucket.consume()
+            key_bucket.consume()
+            return call
+
+    def _key_bucket(self, key):
+        bucket = self._key_buckets.get(key, None)
+        if bucket is None:
+            if len(self._key_buckets) >= MAX_IDLE_KEYS:
+                # Forget keys with nothing outstanding, so there isn't a
+                # bucket kept for every channel ever messaged
+                self._key_buckets = {
+                    k: b for k, b in self._key_buckets.items()
+                    if not b.full()
+                }
+            bucket = TokenBucket(self._key_rate, self._key_burst, self._timer)
+            self._key_buckets[key] = bucket
+        return bucket
+
+    def _record_sent(self, call):
+        latency = self._timer() - call.enqueued
+        self.sent += 1
+        self._latency_total += latency
+        self._latency_max = max(self._latency_max, latency)
+
+    def _failed(self, call, error):
+        now = self._timer()
+        retry_after = self._retry_after(error)
+        if retry_after is not None:
+            # Rate limits apply to the whole method, so pause everything
+            logging.warning(
+                'Rate limited sending to {}, pausing {}s'.format(
+                    call.key, retry_after
+                )
+            )
+            self._paused_until = max(self._paused_until, now + retry_after)
+            delay = retry_after
+        else:
+            call.attempts += 1
+            if call.attempts > self._max_retries or \
+                    not self._retryable(error):
+                logging.error('Dropping message to {}: {}'.format(
+                    call.key, error)
+                )
+                self.dropped += 1
+                return
+            delay = min(
+                self._max_backoff, self._backoff * 2 ** (call.attempts - 1)
+            )
+            logging.warning('Failed sending to {}, retrying in {}s: {}'.format(
+                call.key, delay, error)
+            )
+
+        self.retried += 1
+        # Hold the key's later calls too, keeping them in order
+        self._key_paused_until[call.key] = now + delay
+        heapq.heappush(self._delayed, (now + delay, call.seq, call))
@@ -6,21 +6,53 @@ __email__ = 'abertsch@dropbox.com, antoine.cardon@algolia.com'
 
 import logging
 import asyncio
+import json
+import os
 import ssl as ssl_lib
 import certifi
+import tempfile
 import threading
+import time
+
+from functools import partial
 
 from slack import WebClient
 from slack import RTMClient
+from slack.errors import SlackApiError
 
-from typing import Any, Dict, List
+from typing import Any, Dict, Iterator
 
 from securitybot.user import User
 
 from securitybot.chat.chat import BaseChatClient
 
+from securitybot.chat.inbox import Inbox
+
+from securitybot.chat.outbox import Outbox, PRIORITY_HIGH, PRIORITY_NORMAL
+
 from securitybot.exceptions import ChatException
 
+# Members fetched per users.list call
+USERS_PAGE_SIZE = 200
+
+# Errors meaning a cached DM channel can no longer be posted to
+STALE_CHANNEL_ERRORS = ('channel_not_found', 'is_archived', 'not_in_channel')
+
+
+def _retry_after(error):
+    '''Returns the wait Slack asked for if an error is a rate limit.'''
+    if isinstance(error, SlackApiError) and \
+            getattr(error.response, 'status_code', None) == 429:
+        return float(error.response.headers.get('Retry-After', 1))
+    return None
+
+
+def _retryable(error):
+    '''Slack errors other than server side ones will fail again.'''
+    if isinstance(error, SlackApiError):
+        return getattr(error.response, 'status_code', 500) >= 500
+    return True
+
 
 class ChatClient(BaseChatClient):
     '''
@@ -35,15 +67,48 @@ class ChatClient(BaseChatClient):
         self._username = connection_config['username']
         self._icon_url = connection_config['icon_url']
         self.reporting_channel = connection_config['reporting_channel']
-        self.messages = []
+        # Events received on the RTM thread, waiting for the main loop
+        inbox_size = connection_config.get('inbox_size', 1000)
+        self._messages = Inbox(maxsize=inbox_size, on_put=self._notify_wakeup)
+        self._user_updates = Inbox(
+            maxsize=inbox_size, on_put=self._notify_wakeup
+        )
         self._token = connection_config['token']
 
+        # Map of user ID to DM channel ID, so a DM needs no conversations.open
+        self._dm_channels = {}
+        self._dm_lock = threading.Lock()
+        self._dm_cache_path = connection_config.get('dm_cache_path', None)
+        # Min seconds between writes of the cache, which may cover many users
+        self._dm_save_interval = connection_config.get(
+            'dm_cache_save_interval', 60
+        )
+        self._dm_dirty = False
+        self._dm_last_save = 0
+        self._load_dm_channels()
+
         self._slack_web = WebClient(self._token)
         self._validate()
 
-        loop = asyncio.new_event_loop()
-        thread = threading.Thread(target=self.connect, args=(loop,))
-        thread.start()
+        # Messages are posted from a background thread, within Slack's
+        # rate limits, with escalations to the reporting channel first
+        outbox_config = connection_config.get('outbox', None) or {}
+        self._outbox = Outbox(
+            rate=outbox_config.get('rate', 20),
+            burst=outbox_config.get('burst', 20),
+            key_rate=outbox_config.get('channel_rate', 1),
+            key_burst=outbox_config.get('channel_burst', 3),
+            max_retries=outbox_config.get('max_retries', 5),
+            retry_after=_retry_after,
+            retryable=_retryable
+        )
+        self._outbox.start()
+
+        # Sharded workers only send, events reach them through the ingress
+        if connection_config.get('rtm', True):
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=self.connect, args=(loop,))
+            thread.start()
 
     def _validate(self) -> None:
         '''Validates Slack API connection.'''
@@ -83,16 +148,22 @@ class ChatClient(BaseChatClient):
             loop=loop
         )
         self._slack_rtm.run_on(event="message")(self.get_message)
+        self._slack_rtm.run_on(event="user_change")(self.get_user_update)
+        self._slack_rtm.run_on(event="team_join")(self.get_user_update)
+        self._slack_rtm.run_on(event="im_created")(self.get_dm_opened)
+        self._slack_rtm.run_on(event="im_open")(self.get_dm_opened)
+        self._slack_rtm.run_on(event="im_close")(self.get_dm_closed)
         loop.run_until_complete(
             self._slack_rtm.start()
         )
 
-    def get_users(self) -> List[Dict[str, Any]]:
+    def get_users(self) -> Iterator[Dict[str, Any]]:
         '''
-        Returns a list of all users in the chat system.
+        Streams all users in the chat system, following Slack's pagination
+        cursor one page at a time.
 
         Returns:
-            A list of dictionaries, each dictionary representing a user.
+            An iterator of dictionaries, each dictionary representing a user.
             The rest of the bot expects the following minimal format:
             {
                 "name": The username of a user,
@@ -103,13 +174,37 @@ class ChatClient(BaseChatClient):
                     }
             }
         '''
-        return self._slack_web.users_list()['members']
+        cursor = None
+        while True:
+            response = self._slack_web.users_list(
+                cursor=cursor,
+                limit=USERS_PAGE_SIZE
+            )
+            for member in response['members']:
+                yield member
+
+            metadata = response.get('response_metadata', None) or {}
+            cursor = metadata.get('next_cursor', None)
+            if not cursor:
+                break
 
     def get_messages(self):
-        messages = self.messages
-        self.messages = []
+        return self._messages.get_all()
+
+    def get_user_updates(self):
+        return self._user_updates.get_all()
+
+    def inbox_stats(self) -> Dict[str, Any]:
+        '''Returns depth, drop and lag counters for received messages.'''
+        return self._messages.stats()
 
-        return messages
+    async def get_user_update(self, **payload):
+        '''
+        Records users who joined the workspace or changed their profile.
+        '''
+        user = payload['data'].get('user', None)
+        if isinstance(user, dict):
+            self._user_updates.put(user)
 
     async def get_message(self, **payload):
         '''
@@ -125,17 +220,39 @@ class ChatClient(BaseChatClient):
         '''
         data = payload["data"]
         if 'user' in data and data['channel'].startswith('D'):
+            self._remember_dm(data['user'], data['channel'])
             message = {}
             message['user'] = data['user']
             message['text'] = data['text']
-            self.messages.append(message)
+            self._messages.put(message)
 
     def send_message(self, channel: Any, message: str) -> None:
         '''
-        Sends some message to a desired channel.
+        Queues some message to a desired channel.
         As channels are possibly chat-system specific, this
         function has a horrible type signature.
         '''
+        priority = PRIORITY_NORMAL
+        if channel == self.reporting_channel:
+            priority = PRIORITY_HIGH
+        self._outbox.put(
+            channel, partial(self._post_message, channel, message), priority
+        )
+
+    def message_user(self, user: User, message: str = None):
+        '''
+        Queues some message to a desired user, using a
+        User object and a string message.
+        '''
+        self._outbox.put(
+            user['id'], partial(self._post_dm, user['id'], message)
+        )
+
+    def outbox_stats(self) -> Dict[str, Any]:
+        '''Returns outgoing queue depth, counters and send latency.'''
+        return self._outbox.stats()
+
+    def _post_message(self, channel: Any, message: str) -> None:
         self._slack_web.chat_postMessage(
             channel=channel,
             text=message,
@@ -144,11 +261,103 @@ class ChatClient(BaseChatClient):
             icon_url=self._icon_url
         )
 
-    def message_user(self, user: User, message: str = None):
+    def _post_dm(self, user_id: str, message: str) -> None:
+        channel = self._dm_channel(user_id)
+        try:
+            self._post_message(channel, message)
+        except SlackApiError as error:
+            if error.response.get('error', None) not in STALE_CHANNEL_ERRORS:
+                raise
+            # The DM was closed or archived under us, so open a fresh one
+            self._forget_dm(user_id)
+            self._post_message(self._dm_channel(user_id), message)
+
+    def _dm_channel(self, user_id: str) -> str:
         '''
-        Sends some message to a desired user, using a
-        User object and a string message.
+        Returns the DM channel for a user, opening one if not known.
         '''
-        channel = self._slack_web.conversations_open(users=[user['id']])['channel']['id']
-        self.send_message(channel, message)
-        
+        with self._dm_lock:
+            channel = self._dm_channels.get(user_id, None)
+        if channel is None:
+            channel = self._slack_web.conversations_open(
+                users=[user_id]
+            )['channel']['id']
+            self._remember_dm(user_id, channel)
+        return channel
+
+    async def get_dm_opened(self, **payload):
+        '''Caches DM channels reported by im_created and im_open events.'''
+        data = payload['data']
+        channel = data.get('channel', None)
+        if isinstance(channel, dict):
+            channel = channel.get('id', None)
+        if 'user' in data and channel:
+            self._remember_dm(data['user'], channel)
+
+    async def get_dm_closed(self, **payload):
+        '''Forgets DM channels reported closed by im_close events.'''
+        data = payload['data']
+        if 'user' in data:
+            self._forget_dm(data['user'])
+
+    def _remember_dm(self, user_id: str, channel: str) -> None:
+        with self._dm_lock:
+            if self._dm_channels.get(user_id, None) == channel:
+                return
+            self._dm_channels[user_id] = channel
+            self._dm_dirty = True
+        self._save_dm_channels()
+
+    def _forget_dm(self, user_id: str) -> None:
+        with self._dm_lock:
+            if self._dm_channels.pop(user_id, None) is None:
+                return
+            self._dm_dirty = True
+        self._save_dm_channels()
+
+    def _load_dm_channels(self) -> None:
+        if self._dm_cache_path is None or \
+                not os.path.exists(self._dm_cache_path):
+            return
+        try:
+            with open(self._dm_cache_path) as cache_file:
+                self._dm_channels = json.load(cache_file)
+        except (OSError, ValueError) as error:
+            logging.warning('Ignoring unreadable DM channel cache: {}'.format(
+                error)
+            )
+
+    def _save_dm_channels(self, force: bool = False) -> None:
+        '''
+        Writes the DM channel cache if it changed, at most once every
+        `dm_cache_save_interval` seconds unless forced.
+        '''
+        if self._dm_cache_path is None:
+            return
+        with self._dm_lock:
+            if not self._dm_dirty:
+                return
+            if not force and time.time() - self._dm_last_save < \
+                    self._dm_save_interval:
+                return
+            data = json.dumps(self._dm_channels)
+            self._dm_dirty = False
+            self._dm_last_save = time.time()
+
+        # Writers on other threads each get their own temporary file
+        tmp_path = None
+        try:
+            with tempfile.NamedTemporaryFile(
+                'w', dir=os.path.dirname(self._dm_cache_path) or '.',
+                delete=False
+            ) as cache_file:
+                tmp_path = cache_file.name
+                cache_file.write(data)
+            os.replace(tmp_path, self._dm_cache_path)
+        except OSError as error:
+            logging.warning('Unable to save DM channel cache: {}'.format(
+                error)
+            )
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
@@ -12,7 +12,6 @@ __email__ = 'abertsch@dropbox.com, antoine.cardon@algolia.com'
 import re
 from datetime import timedelta
 
-import securitybot.ignored_alerts as ignored_alerts
 from securitybot.util import create_new_alert
 
 
@@ -105,8 +104,7 @@ def ignore(bot, user, args):
         bot.chat.message_user(user, bot.messages['ignore_no_time'])
         return False
 
-    ignored_alerts.ignore_task(
-        dbclient=bot._dbclient,
+    bot.ignored.ignore(
         username=user['name'],
         title=task.title,
         reason='ignored',
@@ -122,7 +120,8 @@ def test(bot, user, args):
         title='testing_alert',
         ldap=user['name'],
         description='Testing alert',
-        reason='Testing Securitybot'
+        reason='Testing Securitybot',
+        notify_path=bot._intake_path
     )
 
     return True
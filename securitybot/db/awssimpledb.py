@@ -5,7 +5,9 @@ __author__ = 'Bill Mahony'
 
 import pytz
 import logging
+import threading
 
+from contextlib import contextmanager
 from datetime import datetime
 
 from securitybot.db.database import BaseDbClient
@@ -13,9 +15,21 @@ from securitybot.db.database import BaseDbClient
 from securitybot.exceptions import DbException
 
 from boto3 import client
+from botocore.exceptions import ClientError
 
 TIME_FORMAT = '%Y-%m-%dT%H:%M:%S%z'
 
+# Item names compared in a single `itemName() in (...)` select, SimpleDB
+# allows at most 20 comparisons per expression
+SELECT_BATCH_SIZE = 20
+
+# Items written or deleted per BatchPutAttributes/BatchDeleteAttributes call
+BATCH_WRITE_SIZE = 25
+
+# The domains the `alert` table is stored over: SimpleDB updates attributes
+# in place, so each part of an alert which changes on its own lives apart
+ALERT_DOMAINS = ['alert_status', 'alerts', 'user_responses']
+
 
 class DbClient(BaseDbClient):
 
@@ -29,6 +43,8 @@ class DbClient(BaseDbClient):
         self.queries = ''
 
         self._client = client('sdb')
+        # Writes buffered by each thread's open transaction, if any
+        self._local = threading.local()
         self._create_tables()
 
     def execute(self, query, params=None):
@@ -55,49 +71,126 @@ class DbClient(BaseDbClient):
         logging.debug('Result: ' + str(rows))
         return rows
 
+    def execute_many(self, query, params_list):
+        '''
+        Executes a query for each set of params, sending the writes as
+        batch calls.
+        '''
+        with self.transaction():
+            for params in params_list:
+                self.execute(query, params)
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Buffers the writes and deletes made in the with block, then sends
+        them as batch calls when it exits, or drops them if it raises.
+        SimpleDB has no transactions, so a failed flush may be partial, and
+        selects in the block don't see buffered writes.
+        '''
+        if getattr(self._local, 'pending', None) is not None:
+            yield self
+            return
+
+        self._local.pending = []
+        try:
+            yield self
+            pending = self._local.pending
+            self._local.pending = None
+            try:
+                self._flush(pending)
+            except Exception as error:
+                raise DbException(error)
+        finally:
+            self._local.pending = None
+
+    def _flush(self, pending):
+        '''
+        Sends buffered operations. Each run of puts, or of deletes, is sent
+        as batch calls per domain, in the order the domains were first
+        written, so interleaved writes to several domains still batch.
+        '''
+        start = 0
+        while start < len(pending):
+            op = pending[start][0]
+            end = start
+            # Items per domain, in the order they were first touched
+            tables = {}
+            while end < len(pending) and pending[end][0] == op:
+                _, table, item, attribs = pending[end]
+                merged = tables.setdefault(table, {})
+                if op == 'put':
+                    # One batch can't name an item twice, so merge its
+                    # attributes, later values winning
+                    current = merged.setdefault(item, {})
+                    for attrib in attribs:
+                        current[attrib['Name']] = attrib
+                elif attribs is None or \
+                        (item in merged and merged[item] is None):
+                    merged[item] = None
+                else:
+                    merged[item] = merged.get(item, []) + list(attribs)
+                end += 1
+
+            for table, merged in tables.items():
+                items = list(merged.keys())
+                if op == 'put':
+                    self._insert(
+                        items, [list(merged[i].values()) for i in items],
+                        table
+                    )
+                else:
+                    self._delete(items, [merged[i] for i in items], table)
+            start = end
+
     def _create_tables(self):
         '''
         Create all tables (domains) in list, if they don't already exist
         '''
-        for table in self._tables:
-            self._client.create_domain(
-                DomainName='{}.{}'.format(self._domain_prefix, table)
-            )
+        for table in self._tables or []:
+            for domain in self._domains(table):
+                self._client.create_domain(DomainName=self._domain(domain))
 
     def delete_table(self, table):
         '''
-        Deletes a table (domain in SDB)
+        Deletes a table (domains in SDB)
         '''
-        try:
-            domain = '{}.{}'.format(
-                self._domain_prefix,
-                table
-            )
-            result = self._client.delete_domain(
-                DomainName=domain
-            )
-        except Exception as e:
-            logging.error("Domain '{}' deletion failed! ({})".format(domain, e))
-            return False, e
-        
+        for domain in self._domains(table):
+            try:
+                self._client.delete_domain(DomainName=self._domain(domain))
+            except Exception as e:
+                logging.error("Domain '{}' deletion failed! ({})".format(
+                    self._domain(domain), e)
+                )
+                return False, e
+
         return True, 'ok'
 
     def dump_table(self, table):
         '''
-        Dumps a table (domain in SDB)
+        Dumps a table (domains in SDB)
         '''
+        if table == 'alert':
+            return {
+                domain: self._select(fields='*', table=domain)
+                for domain in ALERT_DOMAINS
+            }
         rows = self._select(
             fields='*',
             table=table
         )
         return rows
 
+    def _domains(self, table):
+        '''Returns the domains a table is stored in.'''
+        return ALERT_DOMAINS if table == 'alert' else [table]
+
     #
     # Conversion Helper Functions
     #
 
     def _format_response(self, dictofdict, fields,
-                         timefields=[], boolfields=[]):
+                         timefields=[], boolfields=[], intfields=[]):
         # first value is the primary key
         response = []
         for k, v in dictofdict.items():
@@ -110,6 +203,8 @@ class DbClient(BaseDbClient):
                     )
                 elif field in boolfields:
                     line.append(bool(dictofdict[k][field]))
+                elif field in intfields:
+                    line.append(int(dictofdict[k][field]))
                 else:
                     line.append(dictofdict[k][field])
 
@@ -193,43 +288,134 @@ class DbClient(BaseDbClient):
     # SQL Like Helper Functions
     #
 
+    def _domain(self, table):
+        return '{}.{}'.format(self._domain_prefix, table)
+
+    def _quote(self, value):
+        '''Quotes a value for use in a select expression.'''
+        return "'{}'".format(str(value).replace("'", "''"))
+
     def _select(self, fields, table, where=""):
+        return dict(self._select_iter(fields, table, where))
+
+    def _select_iter(self, fields, table, where=""):
+        '''
+        Streams (item name, attributes) pairs matching a select, following
+        NextToken so results beyond a single page aren't lost.
+        '''
         if where != '':
             append = ' where {}'.format(where)
         else:
             append = ''
 
-        rows = self._client.select(
-            SelectExpression="select {} from `{}.{}` {}".format(
+        kwargs = {
+            'SelectExpression': "select {} from `{}` {}".format(
                 fields,
-                self._domain_prefix,
-                table,
+                self._domain(table),
                 append
             ),
-            ConsistentRead=True
-        )
-        return self._items_to_dict(rows)
+            'ConsistentRead': True,
+        }
+        while True:
+            rows = self._client.select(**kwargs)
+            for item in self._items_to_dict(rows).items():
+                yield item
+            if 'NextToken' not in rows:
+                break
+            kwargs['NextToken'] = rows['NextToken']
+
+    def _select_by_name(self, fields, table, names):
+        '''
+        Selects the items with the given names, SELECT_BATCH_SIZE names
+        per select.
+        '''
+        names = list(names)
+        found = {}
+        for start in range(0, len(names), SELECT_BATCH_SIZE):
+            found.update(self._select_iter(
+                fields=fields,
+                table=table,
+                where='itemName() in ({})'.format(', '.join(
+                    self._quote(name)
+                    for name in names[start:start + SELECT_BATCH_SIZE]
+                ))
+            ))
+        return found
 
     def _delete(self, items, attribs, table):
-        for idx, item in enumerate(items):
-            self._client.delete_attributes(
-                ItemName=item,
-                Attributes=attribs[idx],
-                DomainName='{}.{}'.format(self._domain_prefix, table)
+        '''
+        Deletes attributes from items, BATCH_WRITE_SIZE items per call.
+        If `attribs`, or an item's entry in it, is None, the items are
+        deleted entirely.
+        '''
+        if self._buffer('delete', items, attribs, table):
+            return True
+
+        for start in range(0, len(items), BATCH_WRITE_SIZE):
+            batch = []
+            for idx in range(start, min(start + BATCH_WRITE_SIZE, len(items))):
+                entry = {'Name': items[idx]}
+                if attribs is not None and attribs[idx] is not None:
+                    entry['Attributes'] = attribs[idx]
+                batch.append(entry)
+            self._client.batch_delete_attributes(
+                DomainName=self._domain(table),
+                Items=batch
             )
 
         return True
 
     def _insert(self, items, attribs, table):
-        for idx, item in enumerate(items):
-            self._client.put_attributes(
-                ItemName=item,
-                Attributes=attribs[idx],
-                DomainName='{}.{}'.format(self._domain_prefix, table)
+        '''Writes items, BATCH_WRITE_SIZE per call.'''
+        if self._buffer('put', items, attribs, table):
+            return True
+
+        for start in range(0, len(items), BATCH_WRITE_SIZE):
+            self._client.batch_put_attributes(
+                DomainName=self._domain(table),
+                Items=[
+                    {'Name': items[idx], 'Attributes': attribs[idx]}
+                    for idx in range(
+                        start, min(start + BATCH_WRITE_SIZE, len(items))
+                    )
+                ]
             )
 
         return True
 
+    def _buffer(self, op, items, attribs, table):
+        '''
+        Holds an operation for the current transaction, if there is one.
+
+        Returns:
+            bool: Whether the operation was buffered.
+        '''
+        pending = getattr(self._local, 'pending', None)
+        if pending is None:
+            return False
+        for idx, item in enumerate(items):
+            pending.append((
+                op, table, item, None if attribs is None else attribs[idx]
+            ))
+        return True
+
+    def _delete_items(self, items, table):
+        '''
+        Deletes whole items by name, as the item name is the primary key
+        there is no need to select them first.
+        '''
+        items = list(items)
+        if self._delete(items=items, attribs=None, table=table) is True:
+            logging.debug('Removed {} items from {}.'.format(
+                len(items), table)
+            )
+            return True
+        else:
+            logging.error('Could not remove {} items from {}.'.format(
+                len(items), table)
+            )
+            return False
+
     #
     # Query replacements
     #
@@ -241,59 +427,103 @@ class DbClient(BaseDbClient):
         now = datetime.now(tz=pytz.utc).strftime(TIME_FORMAT)
 
         ignored = self._select(
-            fields='*',
+            fields='itemName()',
             table='ignored',
             where="until <= '{}'".format(now)
         )
-        ignored_items, item_attribs = self._dict_to_items(ignored)
 
-        if self._delete(
-            items=ignored_items,
-            attribs=item_attribs,
-            table='ignored'
-        ) is True:
-            logging.debug('Removed {} items from ignored list.'.format(
-                len(ignored_items)
-                )
-            )
-            return True
-        else:
-            logging.error('Could not remove {} items from ignored list.'.format(
-                len(ignored_items))
-            )
-            return False
+        return self._delete_items(ignored.keys(), table='ignored')
+
+    def _ignored_name(self, ldap, title):
+        '''
+        Ignored alerts are keyed on (ldap, title), so a user can ignore
+        several alerts at once.
+        '''
+        return '{}/{}'.format(ldap, title)
 
     def _get_ignored(self, params):
         '''
         SELECT title, reason FROM ignored WHERE ldap = %s
         '''
+        now = datetime.now(tz=pytz.utc).strftime(TIME_FORMAT)
         ignored = self._select(
             fields='*',
             table='ignored',
-            where="ldap = '{}'".format(params[0])
+            where='ldap = {} and until > {}'.format(
+                self._quote(params[0]), self._quote(now)
+            )
         )
 
-        ignored_list = self._format_response(
-            dictofdict=ignored,
-            fields=['ldap', 'title', 'reason'],
-        )
+        ignored_list = [
+            [item['title'], item['reason']] for item in ignored.values()
+        ]
 
         if len(ignored_list) > 0:
             logging.debug('Got ignored alerts for user {}'.format(params[0]))
 
         return ignored_list
 
+    def _get_all_ignored(self, params=None):
+        '''
+        SELECT ldap, title, reason, until FROM ignored WHERE until > NOW()
+        '''
+        now = datetime.now(tz=pytz.utc).strftime(TIME_FORMAT)
+        return [
+            [
+                item['ldap'], item['title'], item['reason'],
+                datetime.strptime(item['until'], TIME_FORMAT)
+            ]
+            for _, item in self._select_iter(
+                fields='*',
+                table='ignored',
+                where='until > {}'.format(self._quote(now))
+            )
+        ]
+
+    def _delete_ignored(self, params):
+        '''
+        DELETE FROM ignored WHERE ldap = %s AND title = %s AND until <= %s
+
+        Batch deletes can't be conditional, so the row is deleted on its
+        own, only if it still expires at `until`. A row ignored again since
+        then is left alone.
+        '''
+        ldap, title, until = params
+        if isinstance(until, datetime):
+            until = until.strftime(TIME_FORMAT)
+        try:
+            self._client.delete_attributes(
+                DomainName=self._domain('ignored'),
+                ItemName=self._ignored_name(ldap, title),
+                Expected={'Name': 'until', 'Value': until, 'Exists': True}
+            )
+        except ClientError as error:
+            if error.response['Error']['Code'] not in (
+                    'ConditionalCheckFailed', 'AttributeDoesNotExist'):
+                raise
+            logging.debug('Kept ignored alert {}'.format(
+                self._ignored_name(ldap, title))
+            )
+        return True
+
     def _ignore_task(self, params):
         '''
         INSERT INTO ignored (ldap, title, reason, until)
         VALUES (%s, %s, %s, %s)
         ON DUPLICATE KEY UPDATE reason=VALUES(reason), until=VALUES(until)
         '''
-        fields = ['ldap', 'title', 'reason', 'until']
-        ignored_items, item_attribs = self._params_to_items(
-            fieldnames=fields,
-            values=params,
-            timefields=['until'],
+        ldap, title, reason, until = params
+        if isinstance(until, datetime):
+            until = until.strftime(TIME_FORMAT)
+        ignored_items, item_attribs = self._dict_to_items(
+            attribdict={
+                self._ignored_name(ldap, title): {
+                    'ldap': ldap,
+                    'title': title,
+                    'reason': reason,
+                    'until': until,
+                }
+            },
             replace=True
         )
 
@@ -302,9 +532,7 @@ class DbClient(BaseDbClient):
             attribs=item_attribs,
             table='ignored'
         ) is True:
-            logging.debug('Added {} items to the ignored list.'.format(
-                len(ignored_items))
-            )
+            logging.debug('Ignored alert {} for user {}'.format(title, ldap))
             return True
         else:
             logging.error('Could not add {} items to the ignored list.'.format(
@@ -312,10 +540,6 @@ class DbClient(BaseDbClient):
             )
             return False
 
-        logging.debug('Ignored alert {} for user {}'.format(
-            params[1], params[0])
-        )
-
     def _blacklist_list(self, params=None):
         '''
         SELECT * FROM blacklist
@@ -331,6 +555,33 @@ class DbClient(BaseDbClient):
             fields=['ldap']
         )
 
+    def _blacklist_version(self, params=None):
+        '''
+        SELECT COUNT(*), COALESCE(BIT_XOR(CRC32(ldap)), 0) FROM blacklist
+
+        Here the item count and latest blacklist_time, as every add stamps
+        the time and every remove changes the count.
+        '''
+        domain = self._domain('blacklist')
+        # Large domains may be counted over several pages
+        count = 0
+        for _, item in self._select_iter(fields='count(*)', table='blacklist'):
+            count += int(item.get('Count', 0))
+        # A single page, following NextToken would defeat the limit
+        latest = self._items_to_dict(self._client.select(
+            SelectExpression='select blacklist_time from `{}` where '
+                             'blacklist_time is not null order by '
+                             'blacklist_time desc limit 1'.format(domain),
+            ConsistentRead=True
+        ))
+        return [(
+            count,
+            max(
+                (item['blacklist_time'] for item in latest.values()),
+                default=''
+            )
+        )]
+
     def _blacklist_add(self, params):
         '''
         INSERT INTO blacklist (ldap) VALUES (%s)
@@ -363,32 +614,13 @@ class DbClient(BaseDbClient):
         '''
         DELETE FROM blacklist WHERE ldap = %s
         '''
-        entries = self._select(
-            fields='*',
-            table='blacklist',
-            where="ldap = '{}'".format(params[0])
-        )
-        items, attribs = self._dict_to_items(entries)
+        # Entries are keyed on ldap
+        return self._delete_items([params[0]], table='blacklist')
 
-        if self._delete(
-            items=items,
-            attribs=attribs,
-            table='blacklist'
-        ) is True:
-            logging.debug('Removed {} items from blacklist.'.format(
-                len(items)
-                )
-            )
-            return True
-        else:
-            logging.error('Could not remove {} items from blacklist.'.format(
-                len(items))
-            )
-            return False
-
-    def _new_alert_status(self, params):
+    def _put_status(self, params):
         '''
-        INSERT INTO alert_status (hash, status) VALUES (UNHEX(%s), %s)
+        Writes the status of an alert, given its hash and status, to the
+        alert_status domain.
         '''
         fields = ['hash', 'status']
         items, attribs = self._params_to_items(
@@ -412,11 +644,10 @@ class DbClient(BaseDbClient):
             )
             return False
 
-    def _new_alert_alerts(self, params):
+    def _put_details(self, params):
         '''
-        INSERT INTO alerts
-            (hash, ldap, title, description, reason, url, event_time)
-        VALUES (UNHEX(%s), %s, %s, %s, %s, %s, NOW())
+        Writes the details of a new alert, given its hash, ldap, title,
+        description, reason and url, to the alerts domain, timestamped now.
         '''
         fields = [
             'hash', 'ldap', 'title', 'description',
@@ -438,20 +669,20 @@ class DbClient(BaseDbClient):
             attribs=attribs,
             table='alerts'
         ) is True:
-            logging.debug('Added {} items to the alert status list.'.format(
+            logging.debug('Added {} items to the alert details.'.format(
                 len(items))
             )
             return True
         else:
-            logging.error('Could not add {} items to alert status.'.format(
+            logging.error('Could not add {} items to alert details.'.format(
                 len(items))
             )
             return False
 
-    def _new_alert_user_response(self, params):
+    def _put_response(self, params):
         '''
-        INSERT INTO user_responses (hash, comment, performed, authenticated)
-        VALUES (UNHEX(%s), '', false, false)
+        Writes the user's response to an alert, given its hash, comment,
+        performed and authenticated, to the user_responses domain.
         '''
         fields = ['hash', 'comment', 'performed', 'authenticated']
         items, attribs = self._params_to_items(
@@ -493,27 +724,57 @@ class DbClient(BaseDbClient):
         JOIN alert_status ON alerts.hash = alert_status.hash
         WHERE status = %s
         '''
-        # Only grab new alerts
-        alert_status = self._select(
+        # Stream the alerts with the wanted status, then fetch only the
+        # matching rows of the other tables a batch at a time
+        rows = []
+        batch = {}
+        for hsh, status in self._select_iter(
             fields='*',
             table='alert_status',
-            where="status = '{}'".format(params[0])
+            where='status = {}'.format(self._quote(params[0]))
+        ):
+            batch[hsh] = status
+            if len(batch) >= SELECT_BATCH_SIZE:
+                rows.extend(self._join_alerts(batch))
+                batch = {}
+        rows.extend(self._join_alerts(batch))
+
+        return rows
+
+    def _join_alerts(self, alert_status=None, alerts=None):
+        '''
+        Joins a batch of alert_status or alerts items with the matching
+        items of the other domains, skipping any not in all three.
+        '''
+        batch = alert_status if alert_status is not None else alerts
+        if not batch:
+            return []
+
+        where = 'itemName() in ({})'.format(
+            ', '.join(self._quote(hsh) for hsh in batch)
+        )
+        if alert_status is None:
+            alert_status = self._select(
+                fields='*', table='alert_status', where=where
+            )
+        if alerts is None:
+            alerts = self._select(fields='*', table='alerts', where=where)
+        user_responses = self._select(
+            fields='*', table='user_responses', where=where
         )
-        alerts = self._select(fields='*', table='alerts')
-        user_responses = self._select(fields='*', table='user_responses')
-
-        # Join responses and status to alerts that are new
-        for k, v in user_responses.items():
-            if k in alert_status:
-                for attrib, value in v.items():
-                    alert_status[k][attrib] = value
-        for k, v in alerts.items():
-            if k in alert_status:
-                for attrib, value in v.items():
-                    alert_status[k][attrib] = value
+
+        joined = {}
+        for hsh, status in alert_status.items():
+            if hsh not in batch or hsh not in alerts or \
+                    hsh not in user_responses:
+                logging.warning('Skipping incomplete alert {}'.format(hsh))
+                continue
+            joined[hsh] = dict(status)
+            joined[hsh].update(user_responses[hsh])
+            joined[hsh].update(alerts[hsh])
 
         return self._format_response(
-            dictofdict=alert_status,
+            dictofdict=joined,
             fields=[
                 'hash', 'title',
                 'ldap', 'reason',
@@ -522,14 +783,48 @@ class DbClient(BaseDbClient):
                 'comment', 'authenticated',
                 'status'],
             timefields=['event_time'],
-            boolfields=['status']
+            intfields=['status']
         )
 
+    def _get_alerts_since(self, params):
+        '''
+        SELECT ... FROM alert
+        WHERE status = %s
+          AND (event_time > %s OR (event_time = %s AND hash > %s))
+        ORDER BY event_time, hash
+        LIMIT %s
+
+        SimpleDB can only order on one attribute, so every alert after the
+        cursor is returned, ignoring the limit.
+        '''
+        status, since, _, after_hash, _ = params
+        if isinstance(since, datetime):
+            since = since.strftime(TIME_FORMAT)
+
+        rows = []
+        batch = {}
+        for hsh, alert in self._select_iter(
+            fields='*',
+            table='alerts',
+            where='event_time >= {}'.format(self._quote(since))
+        ):
+            if alert.get('event_time', None) == since and hsh <= after_hash:
+                continue
+            batch[hsh] = alert
+            if len(batch) >= SELECT_BATCH_SIZE:
+                rows.extend(self._join_alerts(alerts=batch))
+                batch = {}
+        rows.extend(self._join_alerts(alerts=batch))
+
+        rows = [row for row in rows if row[-1] == int(status)]
+        rows.sort(key=lambda row: (row[6], row[0]))
+        return rows
+
     def _set_status(self, params=None):
         '''
-        UPDATE alert_status
+        UPDATE alert
         SET status=%s
-        WHERE hash=UNHEX(%s)
+        WHERE hash=%s
         '''
         # Due to the SQL query, fields are reversed, hash is pri key
         # Turn it into a list and reverse it, so we can reuse our
@@ -537,15 +832,15 @@ class DbClient(BaseDbClient):
         params = list(params)
         params.reverse()
 
-        return self._new_alert_status(params)
+        return self._put_status(params)
 
     def _set_response(self, params=None):
         '''
-        UPDATE user_responses
+        UPDATE alert
         SET comment=%s,
             performed=%s,
             authenticated=%s
-        WHERE hash=UNHEX(%s)
+        WHERE hash=%s
         '''
         # Grab the hash from the end of the list and insert at the
         # start so we can reuse our existing function
@@ -553,85 +848,141 @@ class DbClient(BaseDbClient):
         hash = new_params.pop()
         new_params.insert(0, hash)
 
-        return self._new_alert_user_response(new_params)
+        return self._put_response(new_params)
 
-    def _delete_alert(self, params):
+    def _new_alert(self, params):
         '''
-        DELETE FROM alerts WHERE hash = %s
+        INSERT INTO alert (hash, ldap, title, description, reason, url, status,
+                           event_time, comment, performed, authenticated)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, NOW(), '', false, false)
+
+        The parts of the alert are written to their domains together, see
+        ALERT_DOMAINS.
         '''
-        entries = self._select(
-            fields='*',
-            table='alerts',
-            where="hash = '{}'".format(params[0])
-        )
-        items, attribs = self._dict_to_items(entries)
+        hsh, ldap, title, description, reason, url, status = params
+        with self.transaction():
+            self._put_details((hsh, ldap, title, description, reason, url))
+            self._put_response((hsh, '', 0, 0))
+            self._put_status((hsh, status))
+        return True
 
-        if self._delete(
-            items=items,
-            attribs=attribs,
-            table='alerts'
-        ) is True:
-            logging.debug('Removed {} items from alerts.'.format(
-                len(items)
-                )
-            )
-            return True
-        else:
-            logging.error('Could not remove {} items from alerts.'.format(
-                len(items))
-            )
-            return False        
+    def _get_existing_hashes(self, params):
+        '''
+        SELECT hash FROM alert WHERE hash IN %s
+        '''
+        found = self._select_by_name(
+            fields='itemName()', table='alerts', names=params[0]
+        )
+        return [(hsh,) for hsh in found]
 
-    def _delete_alert_status(self, params):
+    def _get_responses(self, params):
         '''
-        DELETE FROM alert_status WHERE hash = %s
+        SELECT hash, comment, performed, authenticated
+        FROM alert
+        WHERE hash IN %s
         '''
-        entries = self._select(
-            fields='*',
-            table='alert_status',
-            where="hash = '{}'".format(params[0])
+        return self._format_response(
+            dictofdict=self._select_by_name(
+                fields='*', table='user_responses', names=params[0]
+            ),
+            fields=['hash', 'comment', 'performed', 'authenticated']
         )
-        items, attribs = self._dict_to_items(entries)
 
-        if self._delete(
-            items=items,
-            attribs=attribs,
-            table='alert_status'
-        ) is True:
-            logging.debug('Removed {} items from alert status.'.format(
-                len(items)
+    def _claim_alerts(self, params):
+        '''
+        UPDATE alert
+        SET owner=%s,
+            lease_until=%s
+        WHERE hash IN %s
+          AND (owner IS NULL OR owner = %s OR lease_until < %s
+               OR owner NOT IN %s)
+
+        Each claim is a put conditional on the owner read just before, so
+        of two bots racing for an alert only one wins.
+        '''
+        owner, until, hashes, _, now, peers = params
+        current = self._select_by_name(
+            fields='*', table='alert_status', names=hashes
+        )
+        for hsh, status in current.items():
+            held_by = status.get('owner', None)
+            if held_by not in (None, owner) and held_by in peers:
+                lease = datetime.strptime(status['lease_until'], TIME_FORMAT)
+                if lease >= now:
+                    continue
+
+            if held_by is None:
+                expected = {'Name': 'owner', 'Exists': False}
+            else:
+                expected = {'Name': 'owner', 'Value': held_by, 'Exists': True}
+            try:
+                self._client.put_attributes(
+                    DomainName=self._domain('alert_status'),
+                    ItemName=hsh,
+                    Attributes=[
+                        {'Name': 'owner', 'Value': owner, 'Replace': True},
+                        {'Name': 'lease_until',
+                         'Value': until.strftime(TIME_FORMAT),
+                         'Replace': True},
+                    ],
+                    Expected=expected
                 )
-            )
-            return True
-        else:
-            logging.error('Could not remove {} items from alert status.'.format(
-                len(items))
-            )
-            return False
+            except ClientError as error:
+                if error.response['Error']['Code'] != \
+                        'ConditionalCheckFailed':
+                    raise
+                logging.debug('Lost claim on {}'.format(hsh))
+        return True
 
-    def _delete_user_response(self, params):
+    def _get_claimed(self, params):
         '''
-        DELETE FROM user_responses WHERE hash = %s
+        SELECT hash FROM alert WHERE hash IN %s AND owner = %s
         '''
-        entries = self._select(
-            fields='*',
-            table='user_responses',
-            where="hash = '{}'".format(params[0])
+        hashes, owner = params
+        current = self._select_by_name(
+            fields='*', table='alert_status', names=hashes
         )
-        items, attribs = self._dict_to_items(entries)
+        return [
+            (hsh,) for hsh, status in current.items()
+            if status.get('owner', None) == owner
+        ]
 
-        if self._delete(
-            items=items,
-            attribs=attribs,
-            table='user_responses'
-        ) is True:
-            logging.debug('Removed {} items from user responses.'.format(
-                len(items)
-                )
-            )
-            return True
-        else:
-            logging.error('Could not remove {} items from user responses.'.format(
-                len(items))
-            )
-            return False
+    def _renew_leases(self, params):
+        '''
+        UPDATE alert
+        SET lease_until=%s
+        WHERE owner=%s AND hash IN %s
+        '''
+        until, owner, hashes = params
+        held = [
+            hsh for hsh, status in self._select_by_name(
+                fields='*', table='alert_status', names=hashes
+            ).items()
+            if status.get('owner', None) == owner
+        ]
+        lease = [{
+            'Name': 'lease_until',
+            'Value': until.strftime(TIME_FORMAT),
+            'Replace': True
+        }]
+        return self._insert(
+            items=held, attribs=[lease] * len(held), table='alert_status'
+        )
+
+    def _finalise_alert(self, params):
+        '''
+        DELETE FROM alert WHERE hash = %s
+        '''
+        return self._finalise_alerts(([params[0]], ))
+
+    def _finalise_alerts(self, params):
+        '''
+        DELETE FROM alert WHERE hash IN %s
+        '''
+        hashes = list(params[0])
+        # Status first, so a partly deleted alert is never picked up
+        with self.transaction():
+            self._delete_items(hashes, table='alert_status')
+            self._delete_items(hashes, table='alerts')
+            self._delete_items(hashes, table='user_responses')
+        return True
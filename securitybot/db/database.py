@@ -5,8 +5,9 @@ An abstract to the db backend
 __author__ = 'Antoine Cardon, Bill Mahony'
 __email__ = 'antoine.cardon@algolia.com, xxx@xxx.xx'
 
-from typing import Any, List, Dict
+from typing import Any, Iterable, List, Dict
 from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
 
 
 class BaseDbClient(object, metaclass=ABCMeta):
@@ -32,3 +33,20 @@ class BaseDbClient(object, metaclass=ABCMeta):
         and return a list of results.
         '''
         raise NotImplementedError()
+
+    def execute_many(self, query: str, params_list: Iterable[List[Any]]):
+        '''
+        Runs a query once for each set of params. Backends override this
+        to send the whole batch at once.
+        '''
+        for params in params_list:
+            self.execute(query, params)
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Groups the statements executed inside the with block so they are
+        sent and committed together when it exits, and discarded if it
+        raises. Backends without support run each statement as it is made.
+        '''
+        yield self
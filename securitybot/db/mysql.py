@@ -6,28 +6,43 @@ __email__ = 'abertsch@dropbox.com, antoine.cardon@algolia.com'
 
 import MySQLdb
 import logging
+import threading
+import time
+
+from contextlib import contextmanager
 
 from typing import Any, Dict, Sequence
 
 from MySQLdb._exceptions import OperationalError
 from MySQLdb.constants.ER import NO_SUCH_TABLE, TABLE_EXISTS_ERROR, BAD_DB_ERROR
-from MySQLdb.constants.CR import CONNECTION_ERROR
+from MySQLdb.constants.ER import DUP_ENTRY
+from MySQLdb.constants.CR import (
+    CONNECTION_ERROR, CONN_HOST_ERROR, SERVER_GONE_ERROR, SERVER_LOST
+)
 
 from securitybot.db.database import BaseDbClient
 
-from securitybot.exceptions import DbException
+from securitybot.db.pool import ConnectionPool
+
+from securitybot.exceptions import DbException, DuplicateKeyError
+
+# Errors meaning the connection was lost, so the query can be retried on
+# a fresh one
+CONNECTION_LOST_ERRORS = (
+    CONNECTION_ERROR, CONN_HOST_ERROR, SERVER_GONE_ERROR, SERVER_LOST
+)
 
 
 class DbClient(BaseDbClient):
 
     def __init__(self, config, queries):
         '''
-        Initializes the SQL connection to be used for the bot.
+        Initializes the SQL connection pool to be used for the bot.
 
         Args:
             config (Dict): Configuration for this engine.
         '''
-        
+
         self._host = config.get('host', None)
         self._user = config.get('user', None)
         self._passwd = config.get('password', None)
@@ -35,41 +50,61 @@ class DbClient(BaseDbClient):
         self._tables = config.get('tables', None)
 
         self._db = config.get('db', None)
+        self._max_retries = int(config.get('max_retries', 3))
+        self._backoff = float(config.get('retry_backoff', 0.5))
+        # Each thread checks out its own connection, so the bot, the MFA
+        # poller and ingest workers don't queue on a single socket
+        self._pool = ConnectionPool(
+            connect=self._connect,
+            ping=lambda conn: conn.ping(),
+            close=lambda conn: conn.close(),
+            size=int(config.get('pool_size', 5)),
+            timeout=float(config.get('pool_timeout', 30)),
+            ping_interval=float(config.get('ping_interval', 30)),
+            max_retries=self._max_retries,
+            backoff=self._backoff
+        )
+        # Tracks whether each thread is inside a transaction
+        self._local = threading.local()
         self._create_engine()
         self._init_tables()
 
     def _create_engine(self):
-        # type: (str, str, str, str) -> None
+        # type: () -> None
         '''
-        Args:
-            host (str): The hostname of the SQL server.
-            user (str): The username to use.
-            passwd (str): Password for MySQL user.
-            db (str): The name of the database to connect to.
+        Opens a first connection, creating the database if needed.
+        '''
+        with self._pool.connection():
+            logging.info('Connected to database {}.'.format(self._db))
+
+    def _connect(self):
+        '''
+        Returns a new connection to the database, creating it if it does
+        not exist.
         '''
         try:
-            self._conn = MySQLdb.connect(
+            return MySQLdb.connect(
                 host=self._host,
                 user=self._user,
                 passwd=self._passwd,
                 db=self._db
             )
-            self._cursor = self._conn.cursor()
 
         except OperationalError as error:
+            if error.args[0] != BAD_DB_ERROR:
+                raise
             logging.info('Database {} does not exist, creating.'.format(self._db))
             db = MySQLdb.connect(
                 host=self._host,
                 user=self._user,
                 passwd=self._passwd
             )
-            self._cursor = db.cursor()
-            self._cursor.execute('CREATE DATABASE {}'.format(self._db))
-            logging.info('Database created.'.format(self._db))
-            self._create_engine()
-            return
-
-        logging.info('Connected to database {}.'.format(self._db))
+            try:
+                db.cursor().execute('CREATE DATABASE {}'.format(self._db))
+            finally:
+                db.close()
+            logging.info('Database created.')
+            return self._connect()
 
     def _init_tables(self):
         logging.debug('Checking tables are present')
@@ -81,9 +116,8 @@ class DbClient(BaseDbClient):
         if all(item in curr_list for item in self._tables) is not True:
             logging.info('All tables not present, creating.')
             self._create_tables(self._tables)
-        
+
         logging.info('Tables present.')
-        
 
     def execute(self, query_ref: str, params: Sequence = None):
         # type: (str, Sequence[Any]) -> Sequence[Sequence[Any]]
@@ -99,48 +133,137 @@ class DbClient(BaseDbClient):
         query = self.queries[query_ref]
         if params is None:
             params = ()
-        try:
-            logging.debug('Executing: ' + query + str(params))
-            print(query, params)
-            self._cursor.execute(query, params)
-            rows = self._cursor.fetchall()
-            self._conn.commit()
-            logging.debug('Result: ' + str(rows))
-            return rows
+        return self._with_retries(
+            lambda conn: self._run(conn, query, params)
+        )
 
-        except OperationalError as error:
-            # Handle specific errors
-            errcode = error.args[0]
-            if errcode == TABLE_EXISTS_ERROR:
-                # Ignore existing table error
-                return []
-            elif errcode == CONNECTION_ERROR:
-                # Recover from lost connection
-                logging.warn('Recovering from lost MySQL connection. {}'.format(error))
-                self._create_engine()
-                return self.execute(query, params)
-            elif errcode == NO_SUCH_TABLE:
-                # Somehow a table was deleted, fix and recover
-                self._init_tables()
-                return self.execute(query, params)
-            elif errcode == BAD_DB_ERROR:
-                # Ignore unknown DB, hanlded in _create_engine
-                return []
-            else:
+    def execute_many(self, query_ref: str, params_list: Sequence):
+        # type: (str, Sequence[Sequence[Any]]) -> None
+        '''
+        Executes a query for every set of params in one call. For inserts,
+        MySQLdb sends a single multi-row INSERT.
+
+        Args:
+            query (str): The query to perform.
+            params_list (List[Tuple[str]]): Parameters for each run.
+        '''
+        params_list = list(params_list)
+        if not params_list:
+            return
+        query = self.queries[query_ref]
+        self._with_retries(
+            lambda conn: self._run_many(conn, query, params_list)
+        )
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Runs every query in the with block on one connection, committing
+        once at the end, or rolling back if the block raises. Nested
+        transactions join the outer one.
+        '''
+        if self._in_transaction():
+            yield self
+            return
+
+        with self._pool.connection() as conn:
+            self._local.transaction = True
+            try:
+                yield self
+                conn.commit()
+            except Exception:
+                try:
+                    conn.rollback()
+                except MySQLdb.Error as error:
+                    logging.warning('Rollback failed: {}'.format(error))
                 raise
+            finally:
+                self._local.transaction = False
 
-        except MySQLdb.Error as e:
+    def _in_transaction(self):
+        return getattr(self._local, 'transaction', False)
+
+    def _with_retries(self, work):
+        '''
+        Calls `work` with a connection, handling and retrying MySQL errors.
+        '''
+        attempt = 0
+        recreated_tables = False
+        while True:
+            # A connection lost partway through an outer block can't be
+            # swapped for a new one, so only retry at the top level
+            can_retry = not self._pool.in_use()
             try:
-                if e.args[0] == TABLE_EXISTS_ERROR:
+                with self._pool.connection() as conn:
+                    return work(conn)
+
+            except OperationalError as error:
+                # Handle specific errors
+                errcode = error.args[0]
+                if errcode == TABLE_EXISTS_ERROR:
                     # Ignore existing table error
-                    pass
-                else:
-                    raise SQLEngineException(
-                        'MySQL error [{0}]: {1}'.format(e.args[0], e.args[1])
+                    return []
+                elif errcode in CONNECTION_LOST_ERRORS and can_retry and \
+                        attempt < self._max_retries:
+                    # Recover from lost connection, the pool drops it
+                    delay = self._backoff * 2 ** attempt
+                    attempt += 1
+                    logging.warning(
+                        'Lost MySQL connection, retrying in {}s. {}'.format(
+                            delay, error
+                        )
                     )
-            except IndexError:
-                raise SQLEngineException('MySQL1 error: {0}'.format(e))
+                    time.sleep(delay)
+                elif errcode == NO_SUCH_TABLE and not recreated_tables:
+                    # Somehow a table was deleted, fix and recover
+                    recreated_tables = True
+                    self._create_tables(self._tables)
+                elif errcode == BAD_DB_ERROR:
+                    # Ignore unknown DB, hanlded in _connect
+                    return []
+                else:
+                    raise
 
+            except MySQLdb.Error as e:
+                try:
+                    if e.args[0] == TABLE_EXISTS_ERROR:
+                        # Ignore existing table error
+                        return []
+                    elif e.args[0] == DUP_ENTRY:
+                        raise DuplicateKeyError(
+                            'MySQL error [{0}]: {1}'.format(e.args[0], e.args[1])
+                        )
+                    else:
+                        raise SQLEngineException(
+                            'MySQL error [{0}]: {1}'.format(e.args[0], e.args[1])
+                        )
+                except IndexError:
+                    raise SQLEngineException('MySQL1 error: {0}'.format(e))
+
+    def _run(self, conn, query, params):
+        logging.debug('Executing: ' + query + str(params))
+        cursor = conn.cursor()
+        try:
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+        if not self._in_transaction():
+            conn.commit()
+        logging.debug('Result: ' + str(rows))
+        return rows
+
+    def _run_many(self, conn, query, params_list):
+        logging.debug('Executing {} times: {}'.format(
+            len(params_list), query)
+        )
+        cursor = conn.cursor()
+        try:
+            cursor.executemany(query, params_list)
+        finally:
+            cursor.close()
+        if not self._in_transaction():
+            conn.commit()
 
     def _create_tables(self, tablelist):
         '''
@@ -160,15 +283,13 @@ class DbClient(BaseDbClient):
         Deletes a table
         '''
         try:
-            query = "DROP TABLE {}".format(table)
-            self._cursor.execute(query)
-            rows = self._cursor.fetchall()
-            self._conn.commit()
+            with self._pool.connection() as conn:
+                rows = self._run(conn, "DROP TABLE {}".format(table), ())
 
         except Exception as e:
             logging.error("Table '{}' deletion failed! ({})".format(table, e))
             return False, e
-        
+
         return True, rows
 
     def dump_table(self, table):
@@ -176,10 +297,8 @@ class DbClient(BaseDbClient):
         Dumps a table
         '''
         try:
-            self._cursor.execute('SELECT * FROM {}'.format(table))
-            rows = self._cursor.fetchall()
-            self._conn.commit()
-            return rows
+            with self._pool.connection() as conn:
+                return self._run(conn, 'SELECT * FROM {}'.format(table), ())
         except OperationalError as error:
             logging.debug('Table {} already exists'.format(table))
 
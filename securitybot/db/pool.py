@@ -0,0 +1,154 @@
+'''
+A small thread safe pool of database connections.
+'''
+__author__ = 'Alex Bertsch, Antoine Cardon'
+__email__ = 'abertsch@dropbox.com, antoine.cardon@algolia.com'
+
+import logging
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+
+from securitybot.exceptions import DbException
+
+
+class ConnectionPool(object):
+    '''
+    Hands out up to `size` connections, one per thread at a time. A thread
+    which checks out a connection while already holding one gets the same
+    connection back, so nested calls share a session. Idle connections are
+    pinged before reuse and replaced if dead, and new connections are made
+    with bounded retries and exponential backoff.
+    '''
+
+    def __init__(self, connect, ping, close, size=5, timeout=30,
+                 ping_interval=30, max_retries=3, backoff=0.5,
+                 timer=time.monotonic):
+        '''
+        Args:
+            connect (function): Returns a new connection.
+            ping (function): Given a connection, raises if it is dead.
+            close (function): Given a connection, closes it.
+            size (int): Max connections open at once.
+            timeout (float): Seconds to wait for a free connection.
+            ping_interval (float): Seconds a connection may sit idle before
+                                   it is pinged on checkout.
+            max_retries (int): Failed connection attempts to retry.
+            backoff (float): Seconds before the first retry, doubling after.
+            timer (function): Returns the current time in seconds.
+        '''
+        self._connect = connect
+        self._ping = ping
+        self._close = close
+        self._timeout = timeout
+        self._ping_interval = ping_interval
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._timer = timer
+
+        # (connection, time returned) pairs, most recently used last
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+        self._local = threading.local()
+
+    def in_use(self) -> bool:
+        '''Returns whether the calling thread holds a connection.'''
+        return getattr(self._local, 'conn', None) is not None
+
+    @contextmanager
+    def connection(self):
+        '''
+        Checks out a connection for the calling thread for the duration of
+        the with block. If the block raises, the connection is only
+        returned to the pool if it still answers a ping.
+        '''
+        if self.in_use():
+            self._local.depth += 1
+            try:
+                yield self._local.conn
+            finally:
+                self._local.depth -= 1
+            return
+
+        conn = self._checkout()
+        self._local.conn = conn
+        self._local.depth = 1
+        healthy = True
+        try:
+            yield conn
+        except Exception:
+            healthy = self._alive(conn)
+            raise
+        finally:
+            self._local.conn = None
+            self._checkin(conn, healthy)
+
+    def close(self) -> None:
+        '''Closes every idle connection.'''
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def _checkout(self):
+        if not self._slots.acquire(timeout=self._timeout):
+            raise DbException(
+                'No database connection free after {}s'.format(self._timeout)
+            )
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    conn, returned = self._idle.pop()
+                if self._timer() - returned < self._ping_interval or \
+                        self._alive(conn):
+                    return conn
+                logging.info('Replacing dead database connection.')
+                self._discard(conn)
+            return self._new_connection()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _checkin(self, conn, healthy):
+        if healthy:
+            with self._lock:
+                self._idle.append((conn, self._timer()))
+        else:
+            self._discard(conn)
+        self._slots.release()
+
+    def _new_connection(self):
+        attempt = 0
+        while True:
+            try:
+                return self._connect()
+            except Exception as error:
+                if attempt >= self._max_retries:
+                    raise
+                delay = self._backoff * 2 ** attempt
+                attempt += 1
+                logging.warning(
+                    'Database connection failed, retrying in {}s: {}'.format(
+                        delay, error
+                    )
+                )
+                time.sleep(delay)
+
+    def _alive(self, conn):
+        try:
+            self._ping(conn)
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, conn):
+        try:
+            self._close(conn)
+        except Exception:
+            pass
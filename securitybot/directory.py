@@ -0,0 +1,151 @@
+'''
+A local, on-disk directory of chat members, so the bot never needs to hold
+the whole workspace in memory or re-fetch it on every start.
+'''
+__author__ = 'Alex Bertsch, Antoine Cardon'
+__email__ = 'abertsch@dropbox.com, antoine.cardon@algolia.com'
+
+import json
+import sqlite3
+import threading
+import time
+
+from typing import Any, Dict, Iterable, Iterator
+
+# Members written per transaction when streaming in a full listing
+WRITE_BATCH_SIZE = 500
+
+# The parts of a chat member the bot actually uses
+PROFILE_FIELDS = ('first_name', 'email', 'display_name')
+
+
+def compact_member(member: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Strips a chat member down to the fields the rest of the bot expects,
+    see BaseChatClient.get_users.
+    '''
+    profile = member.get('profile', None) or {}
+    return {
+        'id': member['id'],
+        'name': member['name'],
+        'deleted': member.get('deleted', False),
+        'profile': {
+            field: profile[field] for field in PROFILE_FIELDS
+            if field in profile
+        },
+    }
+
+
+class UserDirectory(object):
+    '''
+    A SQLite backed index of chat members by ID and by name.
+    '''
+
+    def __init__(self, path=None):
+        '''
+        Args:
+            path (str): The database file, or None to keep it in memory.
+        '''
+        self._conn = sqlite3.connect(
+            path or ':memory:', check_same_thread=False
+        )
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS members ('
+                'id TEXT PRIMARY KEY, name TEXT NOT NULL, data TEXT NOT NULL)'
+            )
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS members_name ON members (name)'
+            )
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS meta ('
+                'key TEXT PRIMARY KEY, value REAL NOT NULL)'
+            )
+
+    def __len__(self):
+        # type: () -> int
+        with self._lock:
+            return self._conn.execute(
+                'SELECT COUNT(*) FROM members'
+            ).fetchone()[0]
+
+    def upsert(self, member: Dict[str, Any]) -> None:
+        '''Adds or updates a single member.'''
+        self._write([compact_member(member)])
+
+    def refresh(self, members: Iterable[Dict[str, Any]]) -> int:
+        '''
+        Streams a full member listing into the directory in batches, then
+        records the time of the refresh.
+
+        Returns:
+            int: The number of members written.
+        '''
+        count = 0
+        batch = []
+        for member in members:
+            batch.append(compact_member(member))
+            if len(batch) >= WRITE_BATCH_SIZE:
+                self._write(batch)
+                count += len(batch)
+                batch = []
+        self._write(batch)
+        count += len(batch)
+
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                ('last_refresh', time.time())
+            )
+        return count
+
+    def last_refresh(self) -> float:
+        '''Returns the time of the last full refresh, or 0 if never.'''
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value FROM meta WHERE key = ?', ('last_refresh',)
+            ).fetchone()
+        return row[0] if row else 0
+
+    def copy_to(self, path: str) -> None:
+        '''Replaces the directory at `path` with a copy of this one.'''
+        target = sqlite3.connect(path)
+        try:
+            with self._lock:
+                self._conn.backup(target)
+        finally:
+            target.close()
+
+    def by_id(self, id: str) -> Dict[str, Any]:
+        '''Returns the member with a given ID, or None.'''
+        return self._fetch_one('SELECT data FROM members WHERE id = ?', id)
+
+    def by_name(self, name: str) -> Dict[str, Any]:
+        '''Returns the member with a given username, or None.'''
+        return self._fetch_one('SELECT data FROM members WHERE name = ?', name)
+
+    def members(self) -> Iterator[Dict[str, Any]]:
+        '''Iterates over every member.'''
+        with self._lock:
+            rows = self._conn.execute('SELECT data FROM members').fetchall()
+        for row in rows:
+            yield json.loads(row[0])
+
+    def _fetch_one(self, query, param):
+        with self._lock:
+            row = self._conn.execute(query, (param,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _write(self, members):
+        if not members:
+            return
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO members (id, name, data) '
+                'VALUES (?, ?, ?)',
+                [
+                    (member['id'], member['name'], json.dumps(member))
+                    for member in members
+                ]
+            )
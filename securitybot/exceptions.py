@@ -30,5 +30,9 @@ class DbException(Exception):
     pass
 
 
+class DuplicateKeyError(DbException):
+    pass
+
+
 class SecretsException(Exception):
     pass
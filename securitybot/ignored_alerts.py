@@ -1,57 +1,227 @@
 '''
 A small file for keeping track of ignored alerts in the database.
 '''
+import heapq
+import logging
 import pytz
+import threading
 from datetime import timedelta, datetime
-from typing import Dict
+from typing import Dict, List, Optional
 
 TIME_FORMAT = '%Y-%m-%dT%H:%M:%S%z'
 
+# Expired ignores deleted from the database together
+PRUNE_BATCH_SIZE = 100
 
-def __update_ignored_list(dbclient) -> None:
-    # type: () -> None
-    '''
-    Prunes the ignored table of old ignored alerts.
-    '''
-    dbclient.execute('update_ignored_list')
+
+def _parse_time(value) -> datetime:
+    '''Reads an expiry time as stored, assuming UTC if it has no zone.'''
+    if isinstance(value, str):
+        try:
+            value = datetime.strptime(value, TIME_FORMAT)
+        except ValueError:
+            value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=pytz.utc)
+    return value
 
 
-def get_ignored(dbclient, username: str) -> Dict[str, str]:
+class IgnoredAlerts(object):
     '''
-    Returns a dictionary of ignored alerts to reasons why
-    the ignored are ignored.
-
-    Args:
-        username (str):
-            The username of the user to retrieve ignored alerts for.
-    Returns:
-        Dict[str, str]:
-            A mapping of ignored alert titles to reasons
+    An in-memory index of ignored alerts keyed by (ldap, title), so checking
+    a user's tasks doesn't touch the database. The index is loaded once,
+    updated on every `ignore`, and reloaded every `refresh_time` seconds to
+    pick up ignores made by other bot instances.
+
+    Expiry times are also kept in a heap, and a background thread sleeps
+    until the earliest one, then deletes whatever has expired in batches.
     '''
-    __update_ignored_list(dbclient)
-    rows = dbclient.execute('get_ignored', (username,))
-    return {row[0]: row[1] for row in rows}
 
+    def __init__(self, dbclient, refresh_time=300,
+                 clock=lambda: datetime.now(tz=pytz.utc)):
+        '''
+        Args:
+            dbclient (BaseDbClient): The database holding the ignored table.
+            refresh_time (float): Seconds between reloads.
+            clock (function): Returns the current time as an aware datetime.
+        '''
+        self._dbclient = dbclient
+        self._refresh_time = timedelta(seconds=refresh_time)
+        self._clock = clock
 
-def ignore_task(dbclient, username: str, title: str,
-                reason: str, ttl: timedelta) -> None:
-    '''
-    Adds a task with the given title to the ignore list for the given
-    amount of time. Additionally adds an optional message to specify the
-    reason that the alert was ignored.
-
-    Args:
-        username (str): The username of the user to ignore the given alert for.
-        title (str): The title of the alert to ignore.
-        ttl (Timedelta): The amount of time to ignore the alert for.
-        msg (str): An optional string specifying why an alert was ignored
-    '''
-    expiry_time = datetime.now(tz=pytz.utc) + ttl
+        # ldap -> title -> (reason, until, generation). The generation is
+        # that of the `ignore` call which wrote the entry, or 0 if loaded.
+        self._entries = {}  # type: Dict[str, Dict[str, tuple]]
+        self._generation = 0
+        # (until, ldap, title), stale once the entry is replaced or dropped
+        self._expiries = []  # type: List[tuple]
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+        self.reload()
+
+    def start(self) -> None:
+        '''Starts pruning and reloading in the background.'''
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def get(self, username: str) -> Dict[str, str]:
+        '''
+        Returns a dictionary of the alerts a user currently ignores to the
+        reasons why.
+
+        Args:
+            username (str):
+                The username of the user to retrieve ignored alerts for.
+        Returns:
+            Dict[str, str]:
+                A mapping of ignored alert titles to reasons
+        '''
+        now = self._clock()
+        with self._cond:
+            titles = self._entries.get(username, {})
+            return {
+                title: entry[0] for title, entry in titles.items()
+                if entry[1] > now
+            }
 
-    # NB: Non-standard MySQL specific query
-    dbclient.execute(
-        'ignore_task',
-        (
-            username, title, reason, expiry_time.strftime(TIME_FORMAT)
+    def next_expiry(self) -> Optional[datetime]:
+        '''Returns when the next ignored alert expires, if any.'''
+        with self._cond:
+            self._drop_stale()
+            return self._expiries[0][0] if self._expiries else None
+
+    def ignore(self, username: str, title: str, reason: str,
+               ttl: timedelta) -> None:
+        '''
+        Ignores the alert with the given title for a user for the given
+        amount of time, in the database and the index.
+
+        Args:
+            username (str): The username of the user to ignore the alert for.
+            title (str): The title of the alert to ignore.
+            reason (str): Why the alert was ignored.
+            ttl (Timedelta): The amount of time to ignore the alert for.
+        '''
+        until = self._clock() + ttl
+        # NB: Non-standard MySQL specific query
+        self._dbclient.execute(
+            'ignore_task',
+            (username, title, reason, until.strftime(TIME_FORMAT))
         )
-    )
+        with self._cond:
+            self._generation += 1
+            self._entries.setdefault(username, {})[title] = (
+                reason, until, self._generation
+            )
+            if not self._expiries or until < self._expiries[0][0]:
+                # The pruner may be asleep until a later expiry
+                self._cond.notify()
+            heapq.heappush(self._expiries, (until, username, title))
+
+    def reload(self) -> None:
+        '''
+        Replaces the index with the unexpired rows of the ignored table,
+        keeping any `ignore` made while the rows were being read.
+        '''
+        with self._cond:
+            generation = self._generation
+        rows = self._dbclient.execute('get_all_ignored')
+
+        entries = {}  # type: Dict[str, Dict[str, tuple]]
+        for ldap, title, reason, until in rows:
+            entries.setdefault(ldap, {})[title] = (
+                reason, _parse_time(until), 0
+            )
+        with self._cond:
+            for ldap, titles in self._entries.items():
+                for title, entry in titles.items():
+                    if entry[2] > generation:
+                        entries.setdefault(ldap, {})[title] = entry
+            self._entries = entries
+            self._expiries = [
+                (entry[1], ldap, title)
+                for ldap, titles in entries.items()
+                for title, entry in titles.items()
+            ]
+            heapq.heapify(self._expiries)
+            self._cond.notify()
+
+    def prune(self) -> int:
+        '''
+        Drops expired alerts from the index, then deletes them from the
+        ignored table PRUNE_BATCH_SIZE at a time.
+
+        Returns:
+            int: The number of expired alerts dropped.
+        '''
+        now = self._clock()
+        expired = []
+        with self._cond:
+            while self._expiries and self._expiries[0][0] <= now:
+                until, ldap, title = heapq.heappop(self._expiries)
+                titles = self._entries.get(ldap, {})
+                entry = titles.get(title, None)
+                if entry is None or entry[1] != until:
+                    # Stale, the alert was ignored again or reloaded
+                    continue
+                del titles[title]
+                if not titles:
+                    del self._entries[ldap]
+                expired.append((ldap, title, until.strftime(TIME_FORMAT)))
+
+        for start in range(0, len(expired), PRUNE_BATCH_SIZE):
+            with self._dbclient.transaction():
+                self._dbclient.execute_many(
+                    'delete_ignored', expired[start:start + PRUNE_BATCH_SIZE]
+                )
+        if expired:
+            logging.debug('Pruned {} expired ignored alerts.'.format(
+                len(expired))
+            )
+        return len(expired)
+
+    def _drop_stale(self):
+        while self._expiries:
+            until, ldap, title = self._expiries[0]
+            entry = self._entries.get(ldap, {}).get(title, None)
+            if entry is not None and entry[1] == until:
+                return
+            heapq.heappop(self._expiries)
+
+    def _run(self):
+        next_reload = self._clock() + self._refresh_time
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    self._drop_stale()
+                    wake = next_reload
+                    if self._expiries:
+                        wake = min(wake, self._expiries[0][0])
+                    timeout = (wake - self._clock()).total_seconds()
+                    if timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+                if self._stopped:
+                    return
+
+            try:
+                self.prune()
+                if self._clock() >= next_reload:
+                    # Also clears rows that expired before this instance
+                    # loaded them, e.g. ignores made by other instances
+                    self._dbclient.execute('update_ignored_list')
+                    self.reload()
+                    next_reload = self._clock() + self._refresh_time
+            except Exception as error:
+                logging.warning(
+                    'Failed to prune ignored alerts: {}'.format(error)
+                )
+                next_reload = self._clock() + self._refresh_time
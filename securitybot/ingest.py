@@ -0,0 +1,289 @@
+'''
+An HTTP service taking alerts in bulk, so sources firing thousands of alerts
+at once don't need a process and database connection per alert.
+
+POST /alerts takes a JSON object, a JSON list of objects, or NDJSON (one
+object per line, with an `application/x-ndjson` content type), and answers
+with the outcome of every item in the order given.
+'''
+__author__ = 'Alex Bertsch, Antoine Cardon'
+__email__ = 'abertsch@dropbox.com, antoine.cardon@algolia.com'
+
+import hashlib
+import hmac
+import json
+import logging
+
+from typing import Any, Dict, List
+
+from aiohttp import web
+
+from securitybot import intake
+from securitybot.exceptions import DuplicateKeyError
+from securitybot.tasker import StatusLevel
+from securitybot.util import run_blocking
+
+REQUIRED_FIELDS = ['ldap', 'title', 'description', 'reason']
+
+# Longest value of each field the alert table takes
+FIELD_LENGTHS = {
+    'hash': 64,
+    'ldap': 255,
+    'title': 255,
+    'description': 255,
+    'url': 511,
+}
+
+NDJSON_TYPES = ['application/x-ndjson', 'application/jsonl']
+
+# Outcomes reported per item
+CREATED = 'created'
+DUPLICATE = 'duplicate'
+INVALID = 'invalid'
+FAILED = 'failed'
+
+
+def alert_hash(alert: Dict[str, str]) -> str:
+    '''
+    Derives a hash for an alert sent without one from its content, so a
+    retried request doesn't create the alert twice.
+    '''
+    content = json.dumps(
+        [alert[field] for field in REQUIRED_FIELDS + ['url']]
+    )
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def validate_alert(item: Any) -> Dict[str, str]:
+    '''
+    Checks an incoming alert and fills in its defaults.
+
+    Args:
+        item: One decoded item of a request.
+    Returns:
+        Dict[str, str]: The alert's hash, ldap, title, description, reason
+                        and url.
+    Raises:
+        ValueError: If the item isn't a valid alert.
+    '''
+    if not isinstance(item, dict):
+        raise ValueError('Alert must be an object')
+
+    alert = {}
+    for field in REQUIRED_FIELDS:
+        value = item.get(field, None)
+        if not isinstance(value, str) or not value.strip():
+            raise ValueError('Missing field {}'.format(field))
+        alert[field] = value
+    alert['url'] = item.get('url', None) or 'N/A'
+
+    if item.get('hash', None) is not None:
+        alert['hash'] = str(item['hash']).lower()
+    else:
+        alert['hash'] = alert_hash(alert)
+
+    for field, length in FIELD_LENGTHS.items():
+        if not isinstance(alert[field], str):
+            raise ValueError('Field {} must be a string'.format(field))
+        if len(alert[field]) > length:
+            raise ValueError(
+                'Field {} is longer than {} characters'.format(field, length)
+            )
+    return alert
+
+
+def parse_body(body: bytes, content_type: str) -> List[Any]:
+    '''
+    Decodes a request body into its items.
+
+    Raises:
+        ValueError: If the body can't be decoded.
+    '''
+    text = body.decode('utf-8')
+    if content_type in NDJSON_TYPES:
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    items = json.loads(text)
+    if isinstance(items, dict):
+        return [items]
+    if not isinstance(items, list):
+        raise ValueError('Expected an alert or a list of alerts')
+    return items
+
+
+class AlertIngester(object):
+    '''
+    Validates alerts, drops those already known by hash, and writes the rest
+    a batch at a time: one collision query and one transaction per batch.
+    '''
+
+    def __init__(self, dbclient, batch_size=500,
+                 notify_path=intake.DEFAULT_PATH):
+        '''
+        Args:
+            dbclient (BaseDbClient): The database to write alerts to.
+            batch_size (int): Alerts checked and written together.
+            notify_path (str): Socket a bot listens on for new alerts, or
+                               None not to announce them.
+        '''
+        self._dbclient = dbclient
+        self._batch_size = batch_size
+        self._notify_path = notify_path
+
+    def ingest(self, items: List[Any]) -> List[Dict[str, Any]]:
+        '''
+        Creates alerts from the given items.
+
+        Returns:
+            List[Dict[str, Any]]: For each item, in order, its index, hash if
+                                  known, status and, if not created, why.
+        '''
+        results = []  # type: List[Dict[str, Any]]
+        pending = []  # type: List[Dict[str, str]]
+        seen = set()
+        for index, item in enumerate(items):
+            try:
+                alert = validate_alert(item)
+            except ValueError as error:
+                results.append(
+                    {'index': index, 'status': INVALID, 'error': str(error)}
+                )
+                continue
+
+            result = {'index': index, 'hash': alert['hash']}
+            results.append(result)
+            if alert['hash'] in seen:
+                result.update(status=DUPLICATE, error='Repeated in request')
+                continue
+            seen.add(alert['hash'])
+            alert['result'] = result
+            pending.append(alert)
+
+        created = 0
+        for start in range(0, len(pending), self._batch_size):
+            created += self._store(pending[start:start + self._batch_size])
+
+        if created and self._notify_path is not None:
+            intake.notify(self._notify_path)
+        return results
+
+    def _store(self, batch):
+        '''
+        Writes a batch of new alerts, setting each one's result.
+
+        Returns:
+            int: The number of alerts created.
+        '''
+        try:
+            existing = set(row[0] for row in self._dbclient.execute(
+                'get_existing_hashes', ([alert['hash'] for alert in batch],)
+            ))
+        except Exception as error:
+            logging.error('Collision check failed: {}'.format(error))
+            for alert in batch:
+                alert['result'].update(status=FAILED, error=str(error))
+            return 0
+
+        new = []
+        for alert in batch:
+            if alert['hash'] in existing:
+                alert['result'].update(
+                    status=DUPLICATE, error='Alert already exists'
+                )
+            else:
+                new.append(alert)
+        if not new:
+            return 0
+
+        try:
+            with self._dbclient.transaction():
+                self._dbclient.execute_many(
+                    'new_alert', [self._params(alert) for alert in new]
+                )
+        except Exception as error:
+            # Find out which alerts are to blame, so the rest still get in
+            logging.warning(
+                'Batch of {} alerts failed, inserting one by one: {}'.format(
+                    len(new), error
+                )
+            )
+            return self._store_each(new)
+
+        for alert in new:
+            alert['result']['status'] = CREATED
+        return len(new)
+
+    def _store_each(self, alerts):
+        created = 0
+        for alert in alerts:
+            try:
+                self._dbclient.execute('new_alert', self._params(alert))
+            except DuplicateKeyError:
+                # Written by a concurrent request since the collision check
+                alert['result'].update(
+                    status=DUPLICATE, error='Alert already exists'
+                )
+                continue
+            except Exception as error:
+                alert['result'].update(status=FAILED, error=str(error))
+                continue
+            alert['result']['status'] = CREATED
+            created += 1
+        return created
+
+    def _params(self, alert):
+        return (
+            alert['hash'], alert['ldap'], alert['title'],
+            alert['description'], alert['reason'], alert['url'],
+            StatusLevel.OPEN.value
+        )
+
+
+def build_app(ingester, executor=None, max_items=10000, token=None,
+              max_body=16 * 1024 * 1024):
+    # type: (AlertIngester, Any, int, str, int) -> web.Application
+    '''
+    Builds the HTTP application.
+
+    Args:
+        ingester (AlertIngester): Handles the alerts received.
+        executor (Executor): Pool database writes are run in, or None for
+                             the default one.
+        max_items (int): Most alerts taken in one request.
+        token (str): If set, requests need an `Authorization: Bearer` header
+                     carrying it.
+        max_body (int): Largest request body accepted, in bytes.
+    '''
+    async def post_alerts(request):
+        if token is not None:
+            given = request.headers.get('Authorization', '')
+            if not hmac.compare_digest(given, 'Bearer {}'.format(token)):
+                raise web.HTTPUnauthorized()
+
+        try:
+            items = parse_body(await request.read(), request.content_type)
+        except ValueError as error:
+            return web.json_response({'error': str(error)}, status=400)
+        if len(items) > max_items:
+            return web.json_response(
+                {'error': 'At most {} alerts per request'.format(max_items)},
+                status=413
+            )
+
+        results = await run_blocking(executor, ingester.ingest, items)
+        counts = {CREATED: 0, DUPLICATE: 0, INVALID: 0, FAILED: 0}
+        for result in results:
+            counts[result['status']] += 1
+        logging.info('Ingested {} alerts: {}'.format(len(results), counts))
+
+        body = dict(counts)
+        body['results'] = results
+        return web.json_response(body)
+
+    async def health(request):
+        return web.json_response({'status': 'ok'})
+
+    app = web.Application(client_max_size=max_body)
+    app.router.add_post('/alerts', post_alerts)
+    app.router.add_get('/health', health)
+    return app
@@ -0,0 +1,134 @@
+'''
+Lets processes adding alerts tell a running bot straight away, instead of
+the bot only finding them on its next timed poll.
+'''
+__author__ = 'Alex Bertsch, Antoine Cardon'
+__email__ = 'abertsch@dropbox.com, antoine.cardon@algolia.com'
+
+import logging
+import os
+import socket
+import stat
+import threading
+
+# The UNIX datagram socket the bot listens on unless configured otherwise.
+# It is absolute so alert writers find it whatever their working directory.
+DEFAULT_PATH = '/tmp/securitybot.sock'
+
+
+def notify(path: str = DEFAULT_PATH) -> bool:
+    '''
+    Tells a bot listening on `path` that new alerts were added. Never
+    blocks or raises; if no bot is listening it finds them on its next
+    poll.
+
+    Returns:
+        bool: Whether the notification was delivered.
+    '''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.setblocking(False)
+        sock.sendto(b'1', path)
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+class IntakeListener(object):
+    '''
+    Listens on a UNIX datagram socket from a background thread, calling
+    `on_notify` for every notification received.
+    '''
+
+    def __init__(self, path=DEFAULT_PATH, on_notify=None):
+        '''
+        Args:
+            path (str): The socket file to listen on.
+            on_notify (function): Called, from the listening thread, each
+                                  time new alerts are announced.
+        '''
+        self._path = path
+        self._on_notify = on_notify
+        self._sock = None
+        self._thread = None
+
+    def start(self) -> bool:
+        '''
+        Binds the socket and starts listening.
+
+        Returns:
+            bool: False if the socket could not be bound, e.g. because
+                  another bot is listening on it, in which case this bot
+                  relies on polling alone.
+        '''
+        if self._thread is not None:
+            return True
+        if not os.path.isabs(self._path):
+            logging.warning(
+                'Intake socket {} is relative, alert writers running from '
+                'other directories will not find it'.format(self._path)
+            )
+        try:
+            # A socket left behind by an earlier run would block the bind,
+            # but one still in use belongs to another bot
+            if os.path.lexists(self._path):
+                self._remove_stale()
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._sock.bind(self._path)
+            # Wake up now and then to notice `close`
+            self._sock.settimeout(1)
+        except OSError as error:
+            logging.warning(
+                'Unable to listen for new alerts on {}, polling only: {}'
+                .format(self._path, error)
+            )
+            self._sock = None
+            return False
+
+        logging.info('Listening for new alerts on {}'.format(self._path))
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return True
+
+    def _remove_stale(self):
+        '''
+        Removes the socket file at the path if nothing is listening on it.
+        Raises OSError if another bot is, or the file isn't a socket.
+        '''
+        if not stat.S_ISSOCK(os.lstat(self._path).st_mode):
+            raise OSError('{} is not a socket'.format(self._path))
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            probe.connect(self._path)
+        except ConnectionRefusedError:
+            os.unlink(self._path)
+            return
+        finally:
+            probe.close()
+        raise OSError('another bot is listening on {}'.format(self._path))
+
+    def close(self) -> None:
+        '''Stops listening and removes the socket file.'''
+        sock, self._sock = self._sock, None
+        if sock is None:
+            return
+        sock.close()
+        try:
+            os.unlink(self._path)
+        except OSError:
+            pass
+
+    def _run(self):
+        sock = self._sock
+        while self._sock is sock:
+            try:
+                sock.recv(64)
+            except socket.timeout:
+                continue
+            except OSError:
+                # Closed
+                break
+            if self._on_notify is not None:
+                self._on_notify()
@@ -146,8 +146,8 @@ def build_chat_client(chat_provider, connection_config):
     )
 
 
-def build_tasker(dbclient):
-    return Tasker(dbclient)
+def build_tasker(dbclient, reconcile_time=600):
+    return Tasker(dbclient, reconcile_time=reconcile_time)
 
 
 def load_db_client(db_provider):
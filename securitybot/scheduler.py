@@ -0,0 +1,149 @@
+'''
+A small wakeup primitive for the bot's main loop.
+Rather than spinning on a fixed tick, the bot sleeps until either another
+thread signals that there is work to do (e.g. a chat message arrived) or the
+earliest known deadline passes.
+'''
+__author__ = 'Alex Bertsch, Antoine Cardon'
+__email__ = 'abertsch@dropbox.com, antoine.cardon@algolia.com'
+
+import heapq
+import itertools
+import pytz
+import threading
+
+from datetime import datetime
+from typing import Any, List
+
+
+class Scheduler(object):
+    '''
+    Blocks the caller until woken or until a deadline is reached.
+    Wakeups which happen while nobody is waiting are remembered, so a signal
+    sent just before `wait` is called is never lost.
+    '''
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._woken = False
+
+    def wake(self):
+        # type: () -> None
+        '''
+        Wakes up the waiting thread. Safe to call from any thread.
+        '''
+        with self._cond:
+            self._woken = True
+            self._cond.notify_all()
+
+    def wait(self, until=None):
+        # type: (datetime) -> bool
+        '''
+        Sleeps until woken or until a deadline passes.
+
+        Args:
+            until (Datetime): The time to wake up at regardless of any signal.
+                              If None, sleeps until woken.
+        Returns:
+            bool: True if woken by a signal, False if the deadline passed.
+        '''
+        with self._cond:
+            if not self._woken:
+                timeout = None
+                if until is not None:
+                    timeout = max(
+                        0,
+                        (until - datetime.now(tz=pytz.utc)).total_seconds()
+                    )
+                self._cond.wait(timeout)
+            woken = self._woken
+            self._woken = False
+        return woken
+
+
+class DeadlineHeap(object):
+    '''
+    A min-heap of deadlines, each belonging to a key such as a user ID.
+    A key holds at most one deadline. Rescheduling or cancelling a key leaves
+    its old entry in the heap, which is skipped once it reaches the top, so
+    every operation is logarithmic in the number of deadlines.
+    '''
+
+    def __init__(self):
+        self._heap = []
+        self._deadlines = {}
+        self._counter = itertools.count()
+
+    def __len__(self):
+        # type: () -> int
+        return len(self._deadlines)
+
+    def __contains__(self, key):
+        # type: (Any) -> bool
+        return key in self._deadlines
+
+    def schedule(self, key, when):
+        # type: (Any, datetime) -> None
+        '''
+        Sets the deadline for a key, replacing any previous one.
+
+        Args:
+            key (Any): The key to schedule.
+            when (Datetime): The deadline. None cancels the key instead.
+        '''
+        if when is None:
+            self.cancel(key)
+            return
+        if self._deadlines.get(key, None) == when:
+            return
+        self._deadlines[key] = when
+        heapq.heappush(self._heap, (when, next(self._counter), key))
+        # Stop stale entries from piling up when keys are often rescheduled
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._compact()
+
+    def cancel(self, key):
+        # type: (Any) -> None
+        '''Removes the deadline for a key, if there is one.'''
+        self._deadlines.pop(key, None)
+
+    def peek(self):
+        # type: () -> datetime
+        '''
+        Returns:
+            Datetime: The earliest deadline, or None if there are none.
+        '''
+        self._discard_stale()
+        if self._heap:
+            return self._heap[0][0]
+        return None
+
+    def pop_due(self, now):
+        # type: (datetime) -> List[Any]
+        '''
+        Removes and returns every key whose deadline is at or before `now`.
+        '''
+        due = []
+        self._discard_stale()
+        while self._heap and self._heap[0][0] <= now:
+            _, _, key = heapq.heappop(self._heap)
+            del self._deadlines[key]
+            due.append(key)
+            self._discard_stale()
+        return due
+
+    def _discard_stale(self):
+        # type: () -> None
+        while self._heap:
+            when, _, key = self._heap[0]
+            if self._deadlines.get(key, None) == when:
+                return
+            heapq.heappop(self._heap)
+
+    def _compact(self):
+        # type: () -> None
+        self._heap = [
+            entry for entry in self._heap
+            if self._deadlines.get(entry[2], None) == entry[0]
+        ]
+        heapq.heapify(self._heap)
@@ -0,0 +1,373 @@
+'''
+Runs the bot as several worker processes, each owning a share of the users.
+
+Users are spread over workers by consistent hashing of their chat ID. A
+single ingress process holds the chat connection and routes each incoming
+message to the worker owning its sender. Workers fetch alerts themselves,
+keep only those for their own users, and claim them in the database with a
+lease, so an alert is never handled by two workers even while workers are
+being restarted.
+'''
+__author__ = 'Alex Bertsch, Antoine Cardon'
+__email__ = 'abertsch@dropbox.com, antoine.cardon@algolia.com'
+
+import bisect
+import copy
+import hashlib
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+
+from typing import Any, Callable, Dict, Iterable, List
+
+from securitybot import intake
+from securitybot import loader
+from securitybot.chat.chat import BaseChatClient
+from securitybot.chat.inbox import Inbox
+from securitybot.directory import UserDirectory
+from securitybot.user import User
+
+# Kinds of event sent from the ingress to workers
+MESSAGE = 'message'
+USER_UPDATE = 'user_update'
+NEW_ALERTS = 'new_alerts'
+
+
+def _hash(key: str) -> int:
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+def owner_name(index: int, count: int) -> str:
+    '''Returns the name a worker claims alerts under.'''
+    return 'shard-{}-of-{}'.format(index, count)
+
+
+class HashRing(object):
+    '''
+    A consistent hash ring. Each node is placed at `replicas` points on the
+    ring and a key belongs to the node at the next point after its hash, so
+    adding or removing a node only moves the keys of that node.
+    '''
+
+    def __init__(self, nodes: Iterable[Any], replicas: int = 100) -> None:
+        '''
+        Args:
+            nodes (Iterable): The nodes, e.g. worker indices.
+            replicas (int): Points per node, more spreads keys more evenly.
+        '''
+        points = sorted(
+            (_hash('{}-{}'.format(node, replica)), node)
+            for node in nodes for replica in range(replicas)
+        )
+        if not points:
+            raise ValueError('A hash ring needs at least one node')
+        self._hashes = [point[0] for point in points]
+        self._nodes = [point[1] for point in points]
+
+    def node_for(self, key: str) -> Any:
+        '''Returns the node owning a key.'''
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._nodes[index]
+
+
+class Shard(object):
+    '''
+    A worker's view of the sharding: which users it owns, the name it
+    claims alerts under, and the queue of events routed to it.
+
+    Owner names include the number of workers, so a lease held under a
+    different layout of the ring, whose holder may no longer own the user,
+    can be told apart from one held by a current peer.
+    '''
+
+    def __init__(self, index, count, events, replicas=100, lease_time=300):
+        '''
+        Args:
+            index (int): This worker's index.
+            count (int): The number of workers.
+            events (Queue): Events routed to this worker by the ingress.
+            replicas (int): Points per worker on the hash ring.
+            lease_time (float): Seconds a claim on an alert lasts unless
+                                renewed.
+        '''
+        self.index = index
+        self.count = count
+        self.events = events
+        self.lease_time = lease_time
+        self.owner = owner_name(index, count)
+        self.peers = tuple(owner_name(peer, count) for peer in range(count))
+        self._ring = HashRing(range(count), replicas)
+
+    def owns(self, key: str) -> bool:
+        '''
+        Checks if a key, usually a user's chat ID, belongs to this worker.
+        '''
+        return self._ring.node_for(key) == self.index
+
+
+class ShardChatClient(BaseChatClient):
+    '''
+    The chat client of a worker. Messages are sent through the wrapped
+    client directly, while incoming events are read from the queue the
+    ingress routes them to.
+    '''
+
+    def __init__(self, client: BaseChatClient, events: Any,
+                 inbox_size: int = 1000) -> None:
+        '''
+        Args:
+            client (BaseChatClient): The client to send messages through.
+            events (Queue): Events routed to this worker.
+            inbox_size (int): Max events held before new ones are dropped.
+        '''
+        self._client = client
+        self._events = events
+        self.reporting_channel = client.reporting_channel
+        self._messages = Inbox(maxsize=inbox_size, on_put=self._notify_wakeup)
+        self._user_updates = Inbox(
+            maxsize=inbox_size, on_put=self._notify_wakeup
+        )
+        self._on_new_alerts = None
+
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def connect(self) -> None:
+        pass
+
+    def get_users(self) -> Iterable[Dict[str, Any]]:
+        return self._client.get_users()
+
+    def get_messages(self) -> List[Dict[str, Any]]:
+        return self._messages.get_all()
+
+    def get_user_updates(self) -> List[Dict[str, Any]]:
+        return self._user_updates.get_all()
+
+    def send_message(self, channel: Any, message: str) -> None:
+        self._client.send_message(channel, message)
+
+    def message_user(self, user: User, message: str) -> None:
+        self._client.message_user(user, message)
+
+    def outbox_stats(self) -> Dict[str, Any]:
+        return self._client.outbox_stats()
+
+    def inbox_stats(self) -> Dict[str, Any]:
+        return self._messages.stats()
+
+    def set_new_alerts_callback(self, callback: Callable[[], None]) -> None:
+        '''
+        Registers a function to call when the ingress announces new alerts.
+        '''
+        self._on_new_alerts = callback
+
+    def _run(self):
+        while True:
+            kind, event = self._events.get()
+            if kind == MESSAGE:
+                self._messages.put(event)
+            elif kind == USER_UPDATE:
+                self._user_updates.put(event)
+            elif kind == NEW_ALERTS and self._on_new_alerts is not None:
+                self._on_new_alerts()
+
+
+class ShardRouter(object):
+    '''
+    Hands the events received by the ingress to the workers: each message
+    to the worker owning its sender, and user updates and new alert
+    announcements to all of them.
+    '''
+
+    def __init__(self, chatclient, queues, replicas=100):
+        '''
+        Args:
+            chatclient (BaseChatClient): The client receiving chat events.
+            queues (List[Queue]): Each worker's event queue, by index.
+            replicas (int): Points per worker on the hash ring.
+        '''
+        self._chatclient = chatclient
+        self._queues = queues
+        self._ring = HashRing(range(len(queues)), replicas)
+        self.dropped = 0
+
+    def route(self) -> int:
+        '''
+        Routes every event received since the last call.
+
+        Returns:
+            int: The number of events routed.
+        '''
+        routed = 0
+        for message in self._chatclient.get_messages():
+            self._put(self._ring.node_for(message['user']), MESSAGE, message)
+            routed += 1
+        for member in self._chatclient.get_user_updates():
+            for index in range(len(self._queues)):
+                self._put(index, USER_UPDATE, member)
+            routed += 1
+        return routed
+
+    def announce_new_alerts(self) -> None:
+        '''Tells every worker to look for new alerts now.'''
+        for index in range(len(self._queues)):
+            self._put(index, NEW_ALERTS, None)
+
+    def _put(self, index, kind, event):
+        try:
+            self._queues[index].put_nowait((kind, event))
+        except queue.Full:
+            self.dropped += 1
+            logging.warning(
+                'Worker {} is not keeping up, dropped {} ({} so far)'.format(
+                    index, kind, self.dropped
+                )
+            )
+
+
+def worker_config(config, index, count):
+    # type: (Dict[str, Any], int, int) -> Dict[str, Any]
+    '''
+    Returns the configuration for one worker: no chat events or new alert
+    announcements of its own, a share of the chat rate limits, and its own
+    copies of the files bots write to.
+    '''
+    config = copy.deepcopy(config)
+    config['bot']['intake'] = {'enabled': False}
+
+    chat_config = config['chat'][config['chat']['provider']]
+    chat_config['rtm'] = False
+    outbox = dict(chat_config.get('outbox', None) or {})
+    outbox['rate'] = max(1, outbox.get('rate', 20) / count)
+    outbox['burst'] = max(1, outbox.get('burst', 20) // count)
+    # Every worker may post to the same channel, e.g. the reporting one
+    outbox['channel_rate'] = outbox.get('channel_rate', 1) / count
+    outbox['channel_burst'] = max(1, outbox.get('channel_burst', 3) // count)
+    chat_config['outbox'] = outbox
+    if chat_config.get('dm_cache_path', None):
+        chat_config['dm_cache_path'] = '{}.{}'.format(
+            chat_config['dm_cache_path'], index
+        )
+
+    # SQLite allows a single writer, and every worker applies user updates
+    directory = config['bot'].get('directory', None) or {}
+    if directory.get('path', None):
+        directory['path'] = '{}.{}'.format(directory['path'], index)
+
+    capabilities = config['auth'].get('capabilities', None) or {}
+    if capabilities.get('cache_path', None):
+        capabilities['cache_path'] = '{}.{}'.format(
+            capabilities['cache_path'], index
+        )
+    return config
+
+
+def run_worker(config, index, count, events):
+    # type: (Dict[str, Any], int, int, Any) -> None
+    '''
+    Entry point of a worker process.
+    '''
+    # Imported here so the ingress doesn't load the bot
+    from securitybot.async_bot import AsyncSecurityBot
+    from securitybot.bot import SecurityBot
+
+    logging.basicConfig(
+        level=config['logging']['level'],
+        format='[%(asctime)s %(levelname)s shard-{}] %(message)s'.format(index)
+    )
+    shards = config['bot'].get('shards', None) or {}
+    shard = Shard(
+        index, count, events,
+        replicas=int(shards.get('replicas', 100)),
+        lease_time=int(shards.get('lease_time', 300))
+    )
+    if shards.get('worker_mode', 'event') == 'async':
+        bot = AsyncSecurityBot(config=config, shard=shard)
+    else:
+        bot = SecurityBot(config=config, shard=shard)
+    bot.run()
+
+
+def run_sharded(config):
+    # type: (Dict[str, Any]) -> None
+    '''
+    Runs the ingress, starting a worker process per shard and restarting
+    any which exit.
+    '''
+    shards = config['bot'].get('shards', None) or {}
+    count = int(shards.get('workers', 4))
+    replicas = int(shards.get('replicas', 100))
+    chat_provider = config['chat']['provider']
+    chat_config = config['chat'][chat_provider]
+    configs = [worker_config(config, index, count) for index in range(count)]
+
+    # Workers load their own secrets
+    secrets_provider = config['secretsmgmt']['provider']
+    loader.add_secrets_to_config(
+        smclient=loader.build_secrets_client(
+            secrets_provider=secrets_provider,
+            connection_config=config['secretsmgmt'][secrets_provider]
+        ),
+        secrets=config['secretsmgmt']['secrets'],
+        config=config
+    )
+    chatclient = loader.build_chat_client(
+        chat_provider=chat_provider, connection_config=chat_config
+    )
+
+    # Fill the directory once here, rather than in every worker
+    directory_config = config['bot'].get('directory', None) or {}
+    directory = UserDirectory(directory_config.get('path', None))
+    age = time.time() - directory.last_refresh()
+    if len(directory) == 0 or \
+            age > int(directory_config.get('refresh_time', 86400)):
+        logging.info('Gathering information about all team members...')
+        directory.refresh(chatclient.get_users())
+    for worker in configs:
+        worker_path = worker['bot'].get('directory', {}).get('path', None)
+        if worker_path:
+            directory.copy_to(worker_path)
+
+    context = multiprocessing.get_context('spawn')
+    queues = [
+        context.Queue(maxsize=chat_config.get('inbox_size', 1000))
+        for _ in range(count)
+    ]
+
+    def start(index):
+        process = context.Process(
+            target=run_worker,
+            args=(configs[index], index, count, queues[index]),
+            name='securitybot-shard-{}'.format(index),
+            daemon=True
+        )
+        process.start()
+        return process
+
+    processes = [start(index) for index in range(count)]
+    logging.info('Started {} workers.'.format(count))
+
+    router = ShardRouter(chatclient, queues, replicas)
+    wakeup = threading.Event()
+    chatclient.set_wakeup(wakeup.set)
+
+    intake_config = config['bot'].get('intake', None) or {}
+    if intake_config.get('enabled', True):
+        intake.IntakeListener(
+            path=intake_config.get('path', intake.DEFAULT_PATH),
+            on_notify=router.announce_new_alerts
+        ).start()
+
+    while True:
+        # Wake at least every second to check on the workers
+        wakeup.wait(1)
+        wakeup.clear()
+        router.route()
+        for index, process in enumerate(processes):
+            if not process.is_alive():
+                logging.error('Worker {} exited with {}, restarting.'.format(
+                    index, process.exitcode)
+                )
+                processes[index] = start(index)
@@ -106,13 +106,16 @@ class StateMachine(object):
             )
 
     def step(self):
-        # type: () -> None
+        # type: () -> bool
         '''
         Performs a step in the state machine.
         Each step iterates over the current state's `during` function then
         checks all possible transition paths, evaluates their condition, and
         transitions if possible. The next state is which transition condition
         was true first or the current state if no conditions were true.
+
+        Returns:
+            bool: Whether a transition occurred.
         '''
         self.state.during()
 
@@ -123,7 +126,8 @@ class StateMachine(object):
                 self.state.on_exit()
                 self.state = transition.dest
                 self.state.on_enter()
-                break
+                return True
+        return False
 
 
 class State(object):
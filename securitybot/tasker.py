@@ -9,10 +9,23 @@ __email__ = 'abertsch@dropbox.com, antoine.cardon@algolia.com'
 
 import pytz
 import logging
+import time
 
+from datetime import datetime, timedelta
 from enum import Enum, unique
 
-from typing import List
+from typing import Dict, Iterable, List
+
+# Tasks removed per group of delete queries in Tasker.finalise_many
+FINALISE_BATCH_SIZE = 500
+
+# New alerts fetched per query when polling from the cursor
+POLL_PAGE_SIZE = 500
+
+# Seconds before the cursor each poll starts from. Event times are only
+# precise to the second and don't follow commit order, so alerts committed
+# late within the same second would otherwise be behind the cursor
+CURSOR_LAG = 5
 
 
 @unique
@@ -93,31 +106,41 @@ class Task(object):
         self._set_status(StatusLevel.INPROGRESS.value)
 
     def set_verifying(self):
-        self._set_status(StatusLevel.VERIFICATION.value)
-        self._set_response()
+        with self._dbclient.transaction():
+            self._set_status(StatusLevel.VERIFICATION.value)
+            self._set_response()
 
     def finalise(self):
-        self._set_status(StatusLevel.DONE.value)
         logging.debug('Deleting task {} from database.'.format(
             self.hash)
         )
-        self._dbclient.execute(
-            'delete_alert', (self.hash, )
-        )
-        self._dbclient.execute(
-            'delete_alert_status', (self.hash, )
-        )
-        self._dbclient.execute(
-            'delete_user_response', (self.hash, )
-        )
+        self._dbclient.execute('finalise_alert', (self.hash, ))
+
 
 class Tasker(object):
     '''
     A simple class to retrieve tasks on which the bot should act upon.
     '''
 
-    def __init__(self, dbclient):
+    def __init__(self, dbclient, reconcile_time=600, timer=time.monotonic):
+        '''
+        Args:
+            dbclient (BaseDbClient): The database holding alerts.
+            reconcile_time (int): Seconds between full polls of new alerts,
+                                  catching any the cursor skipped over.
+            timer (function): Returns the current time in seconds.
+        '''
         self._dbclient = dbclient
+        self._reconcile_time = reconcile_time
+        self._timer = timer
+        self._last_reconcile = None
+
+        # Event time of the newest alert fetched so far, new alerts are
+        # fetched from `CURSOR_LAG` seconds before it
+        self._cursor = None
+        # Event times of the new alerts returned which are still open, by
+        # hash, so they aren't handed out again while they are in flight
+        self._seen = {}  # type: Dict[str, datetime]
 
     def _get_tasks(self, level) -> List[Task]:
         # type: (int) -> List[Task]
@@ -132,9 +155,123 @@ class Tasker(object):
         alerts = self._dbclient.execute('get_alerts', (level,))
         return [Task(*alert, dbclient=self._dbclient) for alert in alerts]
 
+    def finalise_many(self, tasks):
+        # type: (Iterable[Task]) -> None
+        '''
+        Deletes a group of finished tasks from the database, with one
+        query for each batch rather than per task.
+
+        Args:
+            tasks (Iterable[Task]): The finished tasks.
+        '''
+        hashes = [task.hash for task in tasks]
+        for start in range(0, len(hashes), FINALISE_BATCH_SIZE):
+            batch = tuple(hashes[start:start + FINALISE_BATCH_SIZE])
+            logging.debug('Deleting {} tasks from database.'.format(
+                len(batch))
+            )
+            self._dbclient.execute('finalise_alerts', (batch, ))
+
     def get_new_tasks(self):
         # type: () -> List[Task]
-        return self._get_tasks(StatusLevel.OPEN.value)
+        '''
+        Gets the tasks for alerts added since the last call. Each poll
+        starts a little before the newest alert seen and skips alerts it
+        already returned, and every `reconcile_time` seconds all new alerts
+        are fetched instead, in case one was committed even later.
+        '''
+        now = self._timer()
+        if self._cursor is None or self._last_reconcile is None or \
+                now - self._last_reconcile >= self._reconcile_time:
+            self._last_reconcile = now
+            return self._reconcile()
+
+        since = self._cursor - timedelta(seconds=CURSOR_LAG)
+        position = (since, '')
+        alerts = []
+        while True:
+            page = self._dbclient.execute(
+                'get_alerts_since',
+                (
+                    StatusLevel.OPEN.value,
+                    position[0], position[0], position[1],
+                    POLL_PAGE_SIZE
+                )
+            )
+            page = list(page)
+            alerts.extend(
+                alert for alert in page if alert[0] not in self._seen
+            )
+            if len(page) < POLL_PAGE_SIZE:
+                break
+            position = (page[-1][6], page[-1][0])
+
+        self._advance(alerts)
+        return [Task(*alert, dbclient=self._dbclient) for alert in alerts]
+
+    def _reconcile(self):
+        # type: () -> List[Task]
+        alerts = list(
+            self._dbclient.execute('get_alerts', (StatusLevel.OPEN.value,))
+        )
+        new = [alert for alert in alerts if alert[0] not in self._seen]
+        # Forget alerts which are no longer open
+        self._seen = {}
+        self._advance(alerts)
+        return [Task(*alert, dbclient=self._dbclient) for alert in new]
+
+    def _advance(self, alerts):
+        '''Marks alert rows as seen, moving the cursor past them.'''
+        for alert in alerts:
+            self._seen[alert[0]] = alert[6]
+            if self._cursor is None or alert[6] > self._cursor:
+                self._cursor = alert[6]
+
+    def claim(self, tasks, owner, lease_time, peers):
+        # type: (Iterable[Task], str, float, Iterable[str]) -> List[Task]
+        '''
+        Claims tasks for `owner` for `lease_time` seconds, so that several
+        bots never handle the same task. Unexpired leases held by one of
+        `peers` are left alone, while those held by anyone else are taken
+        over, as they are left from a previous layout of the bots.
+
+        Args:
+            tasks (Iterable[Task]): The tasks to claim.
+            owner (str): The name to claim them under.
+            lease_time (float): Seconds the claims last unless renewed.
+            peers (Iterable[str]): The owners whose leases are honoured.
+        Returns:
+            List[Task]: The tasks now leased to `owner`.
+        '''
+        tasks = list(tasks)
+        peers = tuple(peers)
+        now = datetime.now(tz=pytz.utc)
+        until = now + timedelta(seconds=lease_time)
+        claimed = set()
+        for start in range(0, len(tasks), POLL_PAGE_SIZE):
+            hashes = tuple(
+                task.hash for task in tasks[start:start + POLL_PAGE_SIZE]
+            )
+            self._dbclient.execute(
+                'claim_alerts', (owner, until, hashes, owner, now, peers)
+            )
+            claimed.update(row[0] for row in self._dbclient.execute(
+                'get_claimed', (hashes, owner)
+            ))
+        return [task for task in tasks if task.hash in claimed]
+
+    def renew_leases(self, tasks, owner, lease_time):
+        # type: (Iterable[Task], str, float) -> None
+        '''
+        Extends the leases `owner` holds on the given tasks, those it is
+        still handling, by `lease_time` seconds. Its other leases are left
+        to expire so another bot can take the tasks over.
+        '''
+        hashes = [task.hash for task in tasks]
+        until = datetime.now(tz=pytz.utc) + timedelta(seconds=lease_time)
+        for start in range(0, len(hashes), POLL_PAGE_SIZE):
+            batch = tuple(hashes[start:start + POLL_PAGE_SIZE])
+            self._dbclient.execute('renew_leases', (until, owner, batch))
 
     def get_active_tasks(self):
         # type: () -> List[Task]
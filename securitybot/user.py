@@ -9,8 +9,8 @@ __email__ = 'abertsch@dropbox.com'
 import logging
 import pytz
 from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
 
-import securitybot.ignored_alerts as ignored_alerts
 from securitybot.auth.auth import AuthStates
 from securitybot.state_machine import StateMachine
 from securitybot.util import tuple_builder, get_expiration_time
@@ -48,16 +48,14 @@ class User(object):
         self._last_auth_state = AuthStates.NONE
         self._last_auth_time = datetime.min
 
+        # Result of the outstanding MFA request, updated by the bot's poller
+        self._last_auth = AuthStates.NONE
+
         # Task auto-escalation time
         self._escalation_time = datetime.max.replace(tzinfo=pytz.utc)
 
-        # If user is enrolled in MFA
-        self._can_auth = self._authclient.can_auth(self)
-
-        # Factor to be used for MFA
-        if self._can_auth is not False:
-            self._factor_id = self._can_auth
-            self._can_auth = True
+        # The MFA factor to use, set by `can_auth`
+        self._factor_id = None
 
         # Build state hierarchy
         states = ['need_task',
@@ -88,11 +86,13 @@ class User(object):
                 'condition': self._cannot_2fa,
                 'action': lambda: self.send_message('no_2fa')
             },
-            # Ask for 2FA if user says action was performed and can do 2FA
+            # Ask for 2FA if user says action was performed and can do 2FA.
+            # While that is unknown the user waits, and is escalated if it
+            # stays unknown
             {
                 'source': 'action_performed_check',
                 'dest': 'auth_permission_check',
-                'condition': self._performed_action,
+                'condition': self._can_2fa,
             },
             # Finish task if user says action wasn't performed
             {
@@ -141,9 +141,6 @@ class User(object):
                 'dest': 'need_task',
             },
         ]
-        during = {
-            'waiting_on_auth': self._update_auth,
-        }
         on_enter = {
             'auth_permission_check': lambda: self.send_message('2fa'),
             'waiting_on_auth': lambda: self.begin_auth(),
@@ -160,7 +157,6 @@ class User(object):
             states,
             transitions,
             'need_task',
-            during=during,
             on_enter=on_enter,
             on_exit=on_exit
         )
@@ -171,13 +167,45 @@ class User(object):
         '''
         return self._user.get(key, None)
 
+    def update_info(self, user):
+        # type: (Dict[str, Any]) -> None
+        '''
+        Replaces the chat information held for this user, e.g. after they
+        change their profile.
+        '''
+        self._user = user
+
     def step(self):
-        # type: () -> None
-        self._fsm.step()
+        # type: () -> bool
+        '''
+        Steps this user's state machine.
 
-    def _update_auth(self):
-        # type: () -> None
-        self._last_auth = self.auth_status()
+        Returns:
+            bool: Whether the user changed state.
+        '''
+        return self._fsm.step()
+
+    def next_wakeup(self):
+        # type: () -> datetime
+        '''
+        Returns the next time this user needs to be stepped even if nothing
+        else happens, or None if the user is only waiting on a message.
+        '''
+        state = self._fsm.state.name
+        if state in ('action_performed_check', 'auth_permission_check'):
+            return self._escalation_time
+        return None
+
+    def auth_polled(self, state):
+        # type: (int) -> None
+        '''
+        Records the final state of this user's MFA request, as reported by
+        the bot's MFA poller.
+
+        Args:
+            state (AuthStates): AUTHORIZED or DENIED.
+        '''
+        self._last_auth = state
 
     # State conditions
 
@@ -199,7 +227,11 @@ class User(object):
 
     def _cannot_2fa(self):
         # type: () -> bool
-        return self._performed_action() and not self._can_auth
+        return self._performed_action() and self.can_auth() is False
+
+    def _can_2fa(self):
+        # type: () -> bool
+        return self._performed_action() and self.can_auth() is True
 
     def _performed_action(self):
         # type: () -> bool
@@ -213,14 +245,12 @@ class User(object):
 
     def _slow_response_time(self):
         # type: () -> bool
-        '''Returns true if the user has taken a long time to respond.'''
-        return (
-            datetime.now(tz=pytz.utc) > (
-                self.pending_task.event_time + timedelta(
-                    minutes=self._bot._escalation_time_mins
-                )
-            )
-        )
+        '''
+        Returns true if the user has taken a long time to respond.
+        The bot only steps a waiting user once their escalation deadline has
+        passed or they send a message, so this is rarely evaluated.
+        '''
+        return datetime.now(tz=pytz.utc) >= self._escalation_time
 
     def _allows_authorization(self):
         # type: () -> bool
@@ -250,8 +280,8 @@ class User(object):
         # Alert bot's reporting channel
         if self._bot._chatclient.reporting_channel is not None:
             # Format message
-            self._bot._chatclient.send_message(
-                self._bot._chatclient.reporting_channel,
+            self._bot._chatclient.report(
+                self,
                 self._bot.messages['report_noresponse'].format(
                     username=self['name'],
                     title=self.pending_task.title,
@@ -282,8 +312,8 @@ class User(object):
             else:
                 comment = 'No comment provided.'
             comment = '\n'.join('> ' + s for s in comment.split('\n'))
-            self._bot._chatclient.send_message(
-                self._bot._chatclient.reporting_channel,
+            self._bot._chatclient.report(
+                self,
                 self._bot.messages['report'].format(
                     username=self['name'],
                     title=self.pending_task.title,
@@ -306,8 +336,8 @@ class User(object):
             # Format message
             comment = 'User not comfortable performing MFA check.'
             comment = '\n'.join('> ' + s for s in comment.split('\n'))
-            self._bot._chatclient.send_message(
-                self._bot._chatclient.reporting_channel,
+            self._bot._chatclient.report(
+                self,
                 self._bot.messages['report'].format(
                     username=self['name'],
                     title=self.pending_task.title,
@@ -358,6 +388,8 @@ class User(object):
         '''
         self.tasks.append(task)
         self._update_tasks()
+        # Find out whether MFA is possible before the user can answer
+        self.can_auth()
 
     def _next_task(self):
         # type: () -> None
@@ -385,14 +417,13 @@ class User(object):
         print("here ################################################################################### {}".format(self.pending_task))
         # Ignore an alert if they did it
         if self.pending_task.performed:
-            ignored_alerts.ignore_task(
-                dbclient=self._dbclient,
+            self._bot.ignored.ignore(
                 username=self['name'],
                 title=self.pending_task.title,
                 reason='auto backoff after confirmation',
                 ttl=timedelta(hours=self._bot._backoff_time_hrs)
             )
-        self.pending_task.finalise()
+        self._bot.finish_task(self.pending_task)
         self.pending_task = None
         self._reset_message()
         self._update_tasks()
@@ -408,7 +439,7 @@ class User(object):
         Updates the user's stored list of tasks, removing
         all of those that should be ignored.
         '''
-        ignored = ignored_alerts.get_ignored(self._dbclient, self['name'])
+        ignored = self._bot.ignored.get(self['name'])
         cleaned_tasks = []
         for task in self.tasks:
             if task.title in ignored:
@@ -458,6 +489,19 @@ class User(object):
 
     # Authorization methods
 
+    def can_auth(self):
+        # type: () -> Optional[bool]
+        '''
+        Returns whether this user can perform MFA, as known by the bot's
+        capability store, or None if the lookup failed. Failed lookups
+        aren't remembered, so they are retried on the next call.
+        '''
+        result = self._bot._capabilities.get(self)
+        if result is None or result is False:
+            return result
+        self._factor_id = result
+        return True
+
     def begin_auth(self):
         # type: () -> None
         '''
@@ -465,7 +509,9 @@ class User(object):
         WAITING_ON_AUTH.
         '''
         self.send_message('sending_push')
+        self._last_auth = AuthStates.PENDING
         self._authclient.auth(self, self.pending_task.description)
+        self._bot._mfa_poller.add(self)
 
     def auth_status(self):
         # type: () -> int
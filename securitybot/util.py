@@ -1,11 +1,15 @@
 __author__ = 'Alex Bertsch, Antoine Cardon'
 __email__ = 'abertsch@dropbox.com, antoine.cardon@algolia.com'
 
+import asyncio
 import pytz
 import secrets
 import os
 from datetime import datetime, timedelta
 from collections import namedtuple
+from functools import partial
+
+from securitybot import intake
 
 from securitybot.tasker import StatusLevel
 
@@ -17,6 +21,20 @@ def tuple_builder(answer=None, text=None):
     return tup
 
 
+async def run_blocking(executor, fn, *args, **kwargs):
+    '''
+    Runs a blocking function in a thread pool from a coroutine.
+
+    Args:
+        executor (Executor): The pool to run in, or None for the default.
+        fn (function): The blocking function to call.
+    Returns:
+        The return value of `fn`.
+    '''
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, partial(fn, *args, **kwargs))
+
+
 def during_business_hours(time, bot):
     '''
     Checks if a given time is within business hours. Currently is true
@@ -69,10 +87,12 @@ def get_expiration_time(start, ttl, bot):
 
 
 def create_new_alert(dbclient, title, ldap, description,
-                     reason, url='N/A', key=None):
-    # type: (str, str, str, str, str, str) -> None
+                     reason, url='N/A', key=None,
+                     notify_path=intake.DEFAULT_PATH):
+    # type: (str, str, str, str, str, str, str) -> None
     '''
-    Creates a new alert in the SQL DB with an optionally random hash.
+    Creates a new alert in the SQL DB with an optionally random hash, then
+    tells a bot listening on `notify_path`, if any, to pick it up.
     '''
     # Generate random key if none provided
     if key is None:
@@ -80,12 +100,12 @@ def create_new_alert(dbclient, title, ldap, description,
 
     # Insert that into the database as a new alert
     dbclient.execute(
-        'new_alert_alerts',
+        'new_alert',
         (
-            key, ldap, title, description, reason, url
+            key, ldap, title, description, reason, url,
+            StatusLevel.OPEN.value
         )
     )
-    # key, comment, performed, authenticated
-    dbclient.execute('new_alert_user_response', (key, '', 0, 0))
 
-    dbclient.execute('new_alert_status', (key, StatusLevel.OPEN.value))
+    if notify_path is not None:
+        intake.notify(notify_path)
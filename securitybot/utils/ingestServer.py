@@ -0,0 +1,65 @@
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+from securitybot import intake
+from securitybot import loader
+from securitybot.ingest import AlertIngester, build_app
+
+
+def main():
+    config = loader.load_yaml('config/bot.yaml')
+    logging.basicConfig(level=config['logging']['level'],
+                        format='[%(asctime)s %(levelname)s] %(message)s')
+
+    ingest_config = config.get('ingest', None) or {}
+    intake_config = config['bot'].get('intake', None) or {}
+
+    # Load our secrets
+    secrets_provider = config['secretsmgmt']['provider']
+
+    secretsclient = loader.build_secrets_client(
+        secrets_provider=secrets_provider,
+        connection_config=config['secretsmgmt'][secrets_provider]
+    )
+    loader.add_secrets_to_config(
+        smclient=secretsclient,
+        secrets=config['secretsmgmt']['secrets'],
+        config=config
+    )
+
+    db_provider = config['database']['provider']
+    dbclient = loader.build_db_client(
+        db_provider=db_provider,
+        connection_config=config['database'][db_provider],
+        tables=config['database']['tables']
+    )
+
+    notify_path = None
+    if intake_config.get('enabled', True):
+        notify_path = intake_config.get('path', intake.DEFAULT_PATH)
+
+    ingester = AlertIngester(
+        dbclient,
+        batch_size=ingest_config.get('batch_size', 500),
+        notify_path=notify_path
+    )
+    app = build_app(
+        ingester,
+        executor=ThreadPoolExecutor(
+            max_workers=ingest_config.get('workers', 4)
+        ),
+        max_items=ingest_config.get('max_items', 10000),
+        token=ingest_config.get('token', None)
+    )
+    web.run_app(
+        app,
+        host=ingest_config.get('host', '127.0.0.1'),
+        port=ingest_config.get('port', 8080)
+    )
+
+
+if __name__ == '__main__':
+    main()
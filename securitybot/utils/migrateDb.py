@@ -0,0 +1,70 @@
+import sys
+
+from securitybot import loader
+
+# The MySQL tables alerts were split over before being merged into `alert`
+OLD_ALERT_TABLES = ['alert_status', 'alerts', 'user_responses']
+
+
+def main():
+    config = loader.load_yaml('config/bot.yaml')
+
+    db_provider = config['database']['provider']
+    if db_provider != 'mysql':
+        print("Nothing to migrate for provider '{}'.".format(db_provider))
+        return
+
+    tablelist = config['database']['tables']
+    drop_old = '--drop-old' in sys.argv[1:]
+
+    # Load our secrets
+    secrets_provider = config['secretsmgmt']['provider']
+
+    secretsclient = loader.build_secrets_client(
+        secrets_provider=secrets_provider,
+        connection_config=config['secretsmgmt'][secrets_provider]
+    )
+    try:
+        loader.add_secrets_to_config(
+            smclient=secretsclient,
+            secrets=config['secretsmgmt']['secrets'],
+            config=config
+        )
+    except Exception as error:
+        print('Failed to load secrets! {}'.format(error))
+
+    # Creates the `alert` table if it is missing
+    dbclient = loader.build_db_client(
+        db_provider=db_provider,
+        connection_config=config['database'][db_provider],
+        tables=tablelist
+    )
+
+    columns = [column[0] for column in dbclient.execute('get_alert_columns')]
+    if 'owner' not in columns:
+        dbclient.execute('add_alert_lease')
+        print('Lease columns added to table alert.')
+
+    present = [table[0] for table in dbclient.execute('get_tables')]
+    if not all(table in present for table in OLD_ALERT_TABLES):
+        print('Old alert tables not found, nothing to migrate.')
+        return
+
+    with dbclient.transaction():
+        dbclient.execute('migrate_alerts')
+    print('Alerts copied to table alert.')
+
+    if not drop_old:
+        print('Run again with --drop-old to delete the old tables.')
+        return
+
+    for table in OLD_ALERT_TABLES:
+        result, reason = dbclient.delete_table(table=table)
+        if result is True:
+            print("Table '{}' deleted ({})".format(table, reason))
+        else:
+            print("Table '{}' deletion failed! ({})".format(table, reason))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,23 @@
+import pytz
+
+from datetime import datetime
+
+
+class FakeTimer(object):
+    '''A monotonic timer which only moves when `now` is set.'''
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeClock(object):
+    '''A wall clock, in UTC, which only moves when `now` is set.'''
+
+    def __init__(self):
+        self.now = datetime(2020, 1, 1, tzinfo=pytz.utc)
+
+    def __call__(self):
+        return self.now
@@ -0,0 +1,107 @@
+import asyncio
+import pytz
+import threading
+import time
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from unittest.mock import MagicMock
+
+from securitybot.async_bot import AsyncSecurityBot
+from securitybot.scheduler import DeadlineHeap
+
+
+def make_bot():
+    # Skips SecurityBot's setup, which connects to every provider
+    bot = AsyncSecurityBot.__new__(AsyncSecurityBot)
+    bot._executor = ThreadPoolExecutor(max_workers=4)
+    bot._jobs = {}
+    bot._workers = {}
+    bot.active_users = {}
+    bot._active_lock = threading.RLock()
+    bot._deadlines = DeadlineHeap()
+    bot._settle_user = MagicMock()
+    bot.flush_messages = MagicMock()
+    bot.flush_finished_tasks = MagicMock()
+    return bot
+
+
+class TestAsyncSecurityBot(unittest.TestCase):
+    def test__runs_user_jobs_in_order(self):
+        bot = make_bot()
+        done = []
+
+        def job(key, index):
+            def run():
+                # Later jobs would overtake a slow one if run concurrently
+                time.sleep(0.01 * (3 - index))
+                done.append((key, index))
+            return run
+
+        async def main():
+            for index in range(3):
+                bot._submit('U1', job('U1', index))
+                bot._submit('U2', job('U2', index))
+            self.assertEqual(set(bot._workers), {'U1', 'U2'})
+            await asyncio.gather(*bot._workers.values())
+
+        asyncio.run(main())
+
+        self.assertEqual([i for key, i in done if key == 'U1'], [0, 1, 2])
+        self.assertEqual([i for key, i in done if key == 'U2'], [0, 1, 2])
+        # Each job is followed by a flush of that user's messages
+        self.assertEqual(bot.flush_messages.call_count, 6)
+        self.assertEqual(bot._workers, {})
+        self.assertEqual(bot._jobs, {})
+
+    def test__users_run_concurrently(self):
+        bot = make_bot()
+        started = threading.Barrier(2, timeout=5)
+
+        async def main():
+            # Both jobs must be running at once for the barrier to pass
+            bot._submit('U1', started.wait)
+            bot._submit('U2', started.wait)
+            await asyncio.gather(*bot._workers.values())
+
+        asyncio.run(main())
+
+        self.assertFalse(started.broken)
+
+    def test__worker_survives_failed_job(self):
+        bot = make_bot()
+        done = []
+
+        def fail():
+            raise Exception('boom')
+
+        async def main():
+            bot._submit('U1', fail)
+            bot._submit('U1', lambda: done.append(True))
+            await asyncio.gather(*bot._workers.values())
+
+        with self.assertLogs(level='ERROR'):
+            asyncio.run(main())
+
+        self.assertEqual(done, [True])
+
+    def test__cleanup_from_pool_thread(self):
+        bot = make_bot()
+        user = MagicMock()
+        user.__getitem__.side_effect = {'id': 'U1', 'name': 'alice'}.get
+        user.next_wakeup.return_value = None
+        bot.active_users['U1'] = user
+        bot._deadlines.schedule('U1', datetime.now(tz=pytz.utc))
+
+        async def main():
+            # The last task finishing removes the user from a pool thread
+            bot._submit('U1', lambda: bot.cleanup_user(user))
+            await asyncio.gather(*bot._workers.values())
+
+        asyncio.run(main())
+
+        self.assertIsNone(bot.get_active_user('U1'))
+        self.assertEqual(bot.active_user_ids(), [])
+        self.assertIsNone(bot._deadlines.peek())
+        self.assertEqual(bot._workers, {})
@@ -0,0 +1,61 @@
+import os
+import tempfile
+import unittest
+
+from unittest.mock import MagicMock
+
+from securitybot.auth.capabilities import CapabilityStore
+
+
+USER = {'id': 'U1', 'name': 'bill'}
+
+
+class TestCapabilityStore(unittest.TestCase):
+    def test__get_is_lazy_and_cached(self):
+        auth = MagicMock()
+        auth.can_auth.return_value = 'factor1'
+        store = CapabilityStore(authclient=auth)
+
+        auth.can_auth.assert_not_called()
+        self.assertEqual(store.get(USER), 'factor1')
+        self.assertEqual(store.get(USER), 'factor1')
+        auth.can_auth.assert_called_once_with(USER)
+
+    def test__lookup_error_not_cached(self):
+        auth = MagicMock()
+        auth.can_auth.side_effect = Exception('boom!')
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'caps.json')
+            store = CapabilityStore(authclient=auth, path=path)
+
+            self.assertIsNone(store.get(USER))
+            store.get(USER)
+            self.assertEqual(auth.can_auth.call_count, 2)
+            store.save(force=True)
+            self.assertFalse(os.path.exists(path))
+
+    def test__persisted_across_instances(self):
+        auth = MagicMock()
+        auth.can_auth.return_value = False
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'caps.json')
+            store = CapabilityStore(authclient=auth, path=path)
+            store.get(USER)
+            store.save(force=True)
+
+            auth.can_auth.reset_mock()
+            store = CapabilityStore(authclient=auth, path=path)
+
+            self.assertFalse(store.get(USER))
+            auth.can_auth.assert_not_called()
+
+    def test__prefetch(self):
+        auth = MagicMock()
+        auth.can_auth.return_value = 'factor1'
+        store = CapabilityStore(authclient=auth, workers=2)
+        users = [{'id': str(i), 'name': str(i)} for i in range(10)]
+
+        store.prefetch(users)
+        store._executor.shutdown(wait=True)
+
+        self.assertEqual(auth.can_auth.call_count, 10)
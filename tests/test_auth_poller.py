@@ -0,0 +1,60 @@
+import unittest
+
+from datetime import timedelta
+from unittest.mock import MagicMock
+
+from securitybot.auth.auth import AuthStates
+from securitybot.auth.poller import MfaPoller
+
+
+class TestMfaPoller(unittest.TestCase):
+    def _poller(self, states):
+        auth = MagicMock()
+        auth.auth_status.side_effect = lambda user: states[user['id']]
+        on_result = MagicMock()
+        poller = MfaPoller(
+            authclient=auth,
+            poll_time=timedelta(seconds=1),
+            concurrency=2,
+            on_result=on_result
+        )
+        return poller, auth, on_result
+
+    def test__poll_reports_finished(self):
+        states = {
+            'a': AuthStates.AUTHORIZED,
+            'b': AuthStates.PENDING,
+            'c': AuthStates.DENIED,
+        }
+        poller, auth, on_result = self._poller(states)
+        users = {k: {'id': k, 'name': k} for k in states}
+        for user in users.values():
+            poller.add(user)
+
+        poller.poll()
+
+        self.assertEqual(auth.auth_status.call_count, 3)
+        on_result.assert_any_call(users['a'], AuthStates.AUTHORIZED)
+        on_result.assert_any_call(users['c'], AuthStates.DENIED)
+        self.assertEqual(on_result.call_count, 2)
+        self.assertEqual(poller.pending(), 1)
+
+    def test__poll_error_stays_pending(self):
+        poller, auth, on_result = self._poller({})
+        auth.auth_status.side_effect = Exception('boom!')
+        poller.add({'id': 'a', 'name': 'a'})
+
+        poller.poll()
+
+        on_result.assert_not_called()
+        self.assertEqual(poller.pending(), 1)
+
+    def test__remove(self):
+        poller, auth, on_result = self._poller({'a': AuthStates.PENDING})
+        user = {'id': 'a', 'name': 'a'}
+        poller.add(user)
+        poller.remove(user)
+
+        poller.poll()
+
+        auth.auth_status.assert_not_called()
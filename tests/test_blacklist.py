@@ -0,0 +1,87 @@
+import unittest
+
+from unittest.mock import MagicMock
+
+from securitybot.blacklist import Blacklist
+
+from tests.helpers import FakeTimer
+
+
+class FakeDb(object):
+    def __init__(self, names):
+        self.names = set(names)
+        self.version = 0
+        self.execute = MagicMock(side_effect=self._execute)
+
+    def _execute(self, query, params=None):
+        if query == 'blacklist_version':
+            return [(len(self.names), self.version)]
+        if query == 'blacklist_list':
+            return [(name,) for name in self.names]
+        if query == 'blacklist_add':
+            self.change(self.names | {params[0]})
+        if query == 'blacklist_remove':
+            self.change(self.names - {params[0]})
+
+    def change(self, names):
+        self.names = set(names)
+        self.version += 1
+
+
+def queries(db):
+    return [c[0][0] for c in db.execute.call_args_list]
+
+
+class TestBlacklist(unittest.TestCase):
+    def test__caches_between_checks(self):
+        timer = FakeTimer()
+        db = FakeDb(['a'])
+        blacklist = Blacklist(db, refresh_time=60, timer=timer)
+        db.change(['b'])
+        db.execute.reset_mock()
+
+        self.assertTrue(blacklist.is_present('a'))
+        self.assertEqual(queries(db), [])
+
+        timer.now = 61
+        self.assertTrue(blacklist.is_present('b'))
+        self.assertFalse(blacklist.is_present('a'))
+        self.assertEqual(queries(db), ['blacklist_version', 'blacklist_list'])
+
+    def test__unchanged_version_skips_reload(self):
+        timer = FakeTimer()
+        db = FakeDb(['a'])
+        blacklist = Blacklist(db, refresh_time=60, timer=timer)
+        db.execute.reset_mock()
+
+        timer.now = 61
+        self.assertTrue(blacklist.is_present('a'))
+        self.assertEqual(queries(db), ['blacklist_version'])
+
+    def test__reloads_without_version(self):
+        db = MagicMock()
+        db.execute.side_effect = lambda query, params=None: (
+            [('a',)] if query == 'blacklist_list' else 1 / 0
+        )
+        blacklist = Blacklist(db)
+
+        self.assertTrue(blacklist.is_present('a'))
+        self.assertTrue(blacklist.refresh(force=True))
+
+    def test__add_checks_fingerprint_on_next_lookup(self):
+        timer = FakeTimer()
+        db = FakeDb(['a'])
+        blacklist = Blacklist(db, refresh_time=60, timer=timer)
+        blacklist.add('b')
+        # A change made by another instance
+        db.change(db.names | {'c'})
+        db.execute.reset_mock()
+
+        self.assertTrue(blacklist.is_present('b'))
+        self.assertTrue(blacklist.is_present('c'))
+        self.assertEqual(queries(db), ['blacklist_version', 'blacklist_list'])
+
+        blacklist.remove('a')
+        db.execute.reset_mock()
+        self.assertFalse(blacklist.is_present('a'))
+        self.assertEqual(queries(db), ['blacklist_version', 'blacklist_list'])
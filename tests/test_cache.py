@@ -0,0 +1,68 @@
+import unittest
+
+from unittest.mock import MagicMock
+
+from securitybot.cache import TTLCache
+
+from tests.helpers import FakeTimer
+
+
+class TestTTLCache(unittest.TestCase):
+    def test__get_set(self):
+        cache = TTLCache(maxsize=10, ttl=60)
+        cache.set('a', 1)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b', 'nope'), 'nope')
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'size': 1})
+
+    def test__expiry(self):
+        timer = FakeTimer()
+        cache = TTLCache(maxsize=10, ttl=60, timer=timer)
+        cache.set('a', 1)
+
+        timer.now = 59
+        self.assertIn('a', cache)
+        timer.now = 60
+        self.assertNotIn('a', cache)
+        self.assertEqual(len(cache), 0)
+
+    def test__lru_eviction(self):
+        cache = TTLCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+
+    def test__get_or_load(self):
+        cache = TTLCache(maxsize=10, ttl=60)
+        loader = MagicMock(return_value='id1')
+
+        self.assertEqual(cache.get_or_load('a', loader), 'id1')
+        self.assertEqual(cache.get_or_load('a', loader), 'id1')
+        loader.assert_called_once_with('a')
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+
+    def test__get_or_load_skips_none(self):
+        cache = TTLCache(maxsize=10, ttl=60)
+        loader = MagicMock(return_value=None)
+
+        cache.get_or_load('a', loader)
+        cache.get_or_load('a', loader)
+
+        self.assertEqual(loader.call_count, 2)
+
+    def test__invalidate(self):
+        cache = TTLCache(maxsize=10)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.invalidate('a')
+
+        self.assertNotIn('a', cache)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
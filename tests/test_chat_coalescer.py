@@ -0,0 +1,84 @@
+import unittest
+
+from unittest.mock import MagicMock, call
+
+from securitybot.chat import chat
+from securitybot.chat.chat import CoalescingChatClient
+
+
+class TestCoalescingChatClient(unittest.TestCase):
+    def setUp(self):
+        self.client = MagicMock()
+        self.client.reporting_channel = 'C1'
+        self.coalescer = CoalescingChatClient(self.client)
+
+    def test__holds_until_flush(self):
+        self.coalescer.message_user({'id': 'U1'}, 'hi')
+        self.client.message_user.assert_not_called()
+
+        self.coalescer.flush()
+        self.client.message_user.assert_called_once_with({'id': 'U1'}, 'hi')
+
+    def test__merges_per_recipient(self):
+        alice = {'id': 'U1'}
+        bob = {'id': 'U2'}
+        self.coalescer.message_user(alice, 'hi')
+        self.coalescer.message_user(bob, 'hey')
+        self.coalescer.message_user(alice, 'alert')
+        self.coalescer.send_message('C1', 'one')
+        self.coalescer.send_message('C1', 'two')
+        self.coalescer.flush()
+
+        self.client.message_user.assert_has_calls(
+            [call(alice, 'hi\nalert'), call(bob, 'hey')]
+        )
+        self.client.send_message.assert_called_once_with('C1', 'one\ntwo')
+
+    def test__flush_single_user(self):
+        self.coalescer.message_user({'id': 'U1'}, 'hi')
+        self.coalescer.message_user({'id': 'U2'}, 'hey')
+        self.coalescer.send_message('C1', 'report')
+        self.coalescer.flush('U1')
+
+        self.client.message_user.assert_called_once_with({'id': 'U1'}, 'hi')
+        self.client.send_message.assert_called_once_with('C1', 'report')
+
+        self.coalescer.flush()
+        self.client.message_user.assert_called_with({'id': 'U2'}, 'hey')
+
+    def test__splits_long_messages(self):
+        text = 'x' * (chat.MAX_COALESCED_LENGTH // 2 - 1)
+        for _ in range(3):
+            self.coalescer.send_message('C1', text)
+        self.coalescer.flush()
+
+        self.assertEqual(self.client.send_message.call_count, 2)
+
+    def test__failed_send_keeps_going(self):
+        self.client.message_user.side_effect = [Exception('boom'), None]
+        self.coalescer.message_user({'id': 'U1'}, 'hi')
+        self.coalescer.message_user({'id': 'U2'}, 'hey')
+        self.coalescer.flush()
+
+        self.assertEqual(self.client.message_user.call_count, 2)
+        self.assertEqual(self.coalescer.failed, 1)
+        self.assertEqual(self.coalescer.outbox_stats()['coalesced_failed'], 1)
+
+    def test__reports_per_user(self):
+        self.coalescer.report({'id': 'U1'}, 'one')
+        self.coalescer.report({'id': 'U2'}, 'two')
+        self.coalescer.report({'id': 'U1'}, 'three')
+        self.coalescer.flush('U2')
+
+        self.client.send_message.assert_called_once_with('C1', 'two')
+
+        self.coalescer.flush()
+        self.client.send_message.assert_called_with('C1', 'one\nthree')
+
+    def test__forwards_stats(self):
+        self.client.outbox_stats.return_value = {'sent': 3}
+        self.client.inbox_stats.return_value = {'depth': 1}
+
+        self.assertEqual(self.coalescer.outbox_stats(),
+                         {'sent': 3, 'coalesced_failed': 0})
+        self.assertEqual(self.coalescer.inbox_stats(), {'depth': 1})
@@ -0,0 +1,65 @@
+import threading
+import unittest
+
+from unittest.mock import MagicMock
+
+from securitybot.chat.inbox import Inbox
+
+from tests.helpers import FakeTimer
+
+
+class TestInbox(unittest.TestCase):
+    def test__put_get_all(self):
+        wake = MagicMock()
+        inbox = Inbox(on_put=wake)
+        inbox.put('a')
+        inbox.put('b')
+
+        self.assertEqual(inbox.get_all(), ['a', 'b'])
+        self.assertEqual(inbox.get_all(), [])
+        self.assertEqual(wake.call_count, 2)
+
+    def test__drops_when_full(self):
+        inbox = Inbox(maxsize=1)
+
+        self.assertTrue(inbox.put('a'))
+        self.assertFalse(inbox.put('b'))
+        self.assertEqual(inbox.get_all(), ['a'])
+        self.assertEqual(inbox.stats()['dropped'], 1)
+
+    def test__lag(self):
+        timer = FakeTimer()
+        inbox = Inbox(timer=timer)
+        inbox.put('a')
+        timer.now = 2
+        inbox.put('b')
+        timer.now = 3
+        inbox.get_all()
+
+        stats = inbox.stats()
+        self.assertEqual(stats['lag_max'], 3)
+        self.assertEqual(stats['lag_avg'], 2)
+
+    def test__concurrent_puts(self):
+        inbox = Inbox(maxsize=10000)
+
+        def produce():
+            for i in range(1000):
+                inbox.put(i)
+
+        threads = [threading.Thread(target=produce) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        taken = []
+        while any(thread.is_alive() for thread in threads):
+            taken.extend(inbox.get_all())
+        for thread in threads:
+            thread.join()
+        taken.extend(inbox.get_all())
+
+        self.assertEqual(len(taken), 4000)
+        self.assertEqual(inbox.stats()['received'], 4000)
+
+    def test__get_timeout(self):
+        inbox = Inbox()
+        self.assertIsNone(inbox.get(timeout=0.01))
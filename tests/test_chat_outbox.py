@@ -0,0 +1,90 @@
+import unittest
+
+from unittest.mock import MagicMock
+
+from securitybot.chat.outbox import Outbox, TokenBucket, PRIORITY_HIGH
+
+from tests.helpers import FakeTimer
+
+
+class RateLimited(Exception):
+    pass
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test__burst_then_rate(self):
+        timer = FakeTimer()
+        bucket = TokenBucket(rate=2, burst=2, timer=timer)
+
+        bucket.consume()
+        bucket.consume()
+        self.assertEqual(bucket.wait_time(), 0.5)
+
+        timer.now = 0.5
+        self.assertEqual(bucket.wait_time(), 0)
+        self.assertFalse(bucket.full())
+        timer.now = 5
+        self.assertTrue(bucket.full())
+
+
+class TestOutbox(unittest.TestCase):
+    def test__priority_order(self):
+        outbox = Outbox()
+        sent = []
+        outbox.put('D1', lambda: sent.append('greeting'))
+        outbox.put('C1', lambda: sent.append('escalation'), PRIORITY_HIGH)
+        outbox.start()
+
+        self.assertTrue(outbox.join(1))
+        self.assertEqual(sent, ['escalation', 'greeting'])
+        self.assertEqual(outbox.stats()['sent'], 2)
+
+    def test__retries_rate_limit(self):
+        job = MagicMock(side_effect=[RateLimited(), None])
+        outbox = Outbox(
+            retry_after=lambda e: 0.01 if isinstance(e, RateLimited) else None
+        )
+        outbox.put('C1', job)
+        outbox.start()
+
+        self.assertTrue(outbox.join(1))
+        self.assertEqual(job.call_count, 2)
+        self.assertEqual(outbox.retried, 1)
+        self.assertEqual(outbox.dropped, 0)
+
+    def test__retry_keeps_channel_order(self):
+        sent = []
+        failures = [Exception('boom')]
+
+        def flaky():
+            if failures:
+                raise failures.pop()
+            sent.append('first')
+
+        outbox = Outbox(backoff=0.01, key_rate=100, key_burst=10)
+        outbox.put('C1', flaky)
+        outbox.put('C1', lambda: sent.append('second'))
+        outbox.start()
+
+        self.assertTrue(outbox.join(1))
+        self.assertEqual(sent, ['first', 'second'])
+
+    def test__drops_after_max_retries(self):
+        job = MagicMock(side_effect=Exception('boom'))
+        outbox = Outbox(max_retries=2, backoff=0.01)
+        outbox.put('C1', job)
+        outbox.start()
+
+        self.assertTrue(outbox.join(1))
+        self.assertEqual(job.call_count, 3)
+        self.assertEqual(outbox.stats()['dropped'], 1)
+
+    def test__drops_unretryable(self):
+        job = MagicMock(side_effect=Exception('boom'))
+        outbox = Outbox(retryable=lambda e: False)
+        outbox.put('C1', job)
+        outbox.start()
+
+        self.assertTrue(outbox.join(1))
+        job.assert_called_once_with()
+        self.assertEqual(outbox.dropped, 1)
@@ -1,8 +1,14 @@
+import asyncio
+import json
+import os
+import tempfile
 import unittest
 
 from unittest.mock import MagicMock
 from unittest.mock import patch
 
+from slack.errors import SlackApiError
+
 from securitybot.chat.slack import ChatClient
 
 from securitybot.exceptions import ChatException
@@ -33,6 +39,7 @@ class TestChatProviderSlack(unittest.TestCase):
 
         cli._slack_web.conversations_open.return_value = {'channel': {'id': '11'}}
         cli.message_user(user={'id': 'test'}, message='what?')
+        cli._outbox.join(1)
 
         cli._slack_web.chat_postMessage.assert_called_once_with(
             as_user=False,
@@ -42,6 +49,99 @@ class TestChatProviderSlack(unittest.TestCase):
             username='CyberBot'
         )
 
+    @patch('securitybot.chat.slack.RTMClient')
+    @patch('securitybot.chat.slack.WebClient')
+    def test__message_user_caches_channel(self, mk_web, mk_rtm):
+        ChatClient.connect = MagicMock()
+        cli = ChatClient(connection_config=SLACK_CFG)
+
+        cli._slack_web.conversations_open.return_value = {'channel': {'id': '11'}}
+        cli.message_user(user={'id': 'test'}, message='what?')
+        cli.message_user(user={'id': 'test'}, message='again?')
+        cli._outbox.join(1)
+
+        cli._slack_web.conversations_open.assert_called_once_with(users=['test'])
+        self.assertEqual(cli._slack_web.chat_postMessage.call_count, 2)
+
+    @patch('securitybot.chat.slack.RTMClient')
+    @patch('securitybot.chat.slack.WebClient')
+    def test__message_user_reopens_stale_channel(self, mk_web, mk_rtm):
+        ChatClient.connect = MagicMock()
+        cli = ChatClient(connection_config=SLACK_CFG)
+        cli._dm_channels['test'] = 'old'
+
+        cli._slack_web.conversations_open.return_value = {'channel': {'id': '11'}}
+        cli._slack_web.chat_postMessage.side_effect = [
+            SlackApiError('gone', {'error': 'channel_not_found'}),
+            {'ok': True},
+        ]
+        cli.message_user(user={'id': 'test'}, message='what?')
+        cli._outbox.join(1)
+
+        cli._slack_web.chat_postMessage.assert_called_with(
+            as_user=False,
+            channel='11',
+            icon_url='http://test.com/1.png',
+            text='what?',
+            username='CyberBot'
+        )
+
+    @patch('securitybot.chat.slack.RTMClient')
+    @patch('securitybot.chat.slack.WebClient')
+    def test__dm_channel_events(self, mk_web, mk_rtm):
+        ChatClient.connect = MagicMock()
+        cli = ChatClient(connection_config=SLACK_CFG)
+
+        asyncio.run(cli.get_dm_opened(
+            data={'user': 'test', 'channel': {'id': 'D1'}}
+        ))
+        self.assertEqual(cli._dm_channel('test'), 'D1')
+
+        asyncio.run(cli.get_dm_closed(data={'user': 'test', 'channel': 'D1'}))
+        self.assertNotIn('test', cli._dm_channels)
+
+    @patch('securitybot.chat.slack.RTMClient')
+    @patch('securitybot.chat.slack.WebClient')
+    def test__dm_cache_saves_are_throttled(self, mk_web, mk_rtm):
+        ChatClient.connect = MagicMock()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'dms.json')
+            cli = ChatClient(connection_config=dict(
+                SLACK_CFG, dm_cache_path=path, dm_cache_save_interval=60
+            ))
+
+            cli._remember_dm('U1', 'D1')
+            cli._remember_dm('U2', 'D2')
+            with open(path) as cache_file:
+                self.assertEqual(json.load(cache_file), {'U1': 'D1'})
+
+            cli._save_dm_channels(force=True)
+            with open(path) as cache_file:
+                self.assertEqual(
+                    json.load(cache_file), {'U1': 'D1', 'U2': 'D2'}
+                )
+            # No temporary files are left behind
+            self.assertEqual(os.listdir(tmp), ['dms.json'])
+
+    @patch('securitybot.chat.slack.RTMClient')
+    @patch('securitybot.chat.slack.WebClient')
+    def test__get_messages(self, mk_web, mk_rtm):
+        ChatClient.connect = MagicMock()
+        cli = ChatClient(connection_config=SLACK_CFG)
+        wake = MagicMock()
+        cli.set_wakeup(wake)
+
+        asyncio.run(cli.get_message(
+            data={'user': 'test', 'channel': 'D1', 'text': 'hi'}
+        ))
+        asyncio.run(cli.get_message(
+            data={'user': 'test', 'channel': 'C1', 'text': 'not a DM'}
+        ))
+
+        self.assertEqual(cli.get_messages(), [{'user': 'test', 'text': 'hi'}])
+        self.assertEqual(cli.get_messages(), [])
+        wake.assert_called_once_with()
+
     @patch('securitybot.chat.slack.RTMClient')
     @patch('securitybot.chat.slack.WebClient')
     def test__validate_fail(self, mk_web, mk_rtm):
@@ -61,7 +161,23 @@ class TestChatProviderSlack(unittest.TestCase):
         cli._slack_web.users_list.return_value = {'members': users}
         u_result = cli.get_users()
 
-        self.assertEqual(u_result, (users))
+        self.assertEqual(list(u_result), (users))
+
+    @patch('securitybot.chat.slack.RTMClient')
+    @patch('securitybot.chat.slack.WebClient')
+    def test__get_users_paginated(self, mk_web, mk_rtm):
+        cli = ChatClient(connection_config=SLACK_CFG)
+
+        cli._slack_web.users_list.side_effect = [
+            {'members': ['bill'],
+             'response_metadata': {'next_cursor': 'abc'}},
+            {'members': ['sally'],
+             'response_metadata': {'next_cursor': ''}},
+        ]
+        u_result = list(cli.get_users())
+
+        self.assertEqual(u_result, ['bill', 'sally'])
+        cli._slack_web.users_list.assert_called_with(cursor='abc', limit=200)
 
     @patch('securitybot.chat.slack.RTMClient')
     @patch('securitybot.chat.slack.WebClient')
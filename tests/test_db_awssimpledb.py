@@ -3,7 +3,7 @@ import unittest
 from unittest.mock import MagicMock
 from unittest.mock import patch
 
-from securitybot.db.awssimpledb import DbClient
+from securitybot.db.awssimpledb import DbClient, TIME_FORMAT
 
 from securitybot.exceptions import DbException
 
@@ -50,6 +50,111 @@ class TestChatProviderSlack(unittest.TestCase):
 
         self.assertEqual(e_result, True)
 
+    @patch('securitybot.db.awssimpledb.client')
+    def test__ignore_task_keyed_on_user_and_title(self, mk_boto):
+        cli = DbClient(config=SDB_CFG, queries=None)
+
+        cli.execute('ignore_task', ('user', 'a', 'r', '2020-01-01T00:00:00+0000'))
+        cli.execute('ignore_task', ('user', 'b', 'r', '2020-01-01T00:00:00+0000'))
+
+        names = [
+            c[1]['Items'][0]['Name']
+            for c in cli._client.batch_put_attributes.call_args_list
+        ]
+        self.assertEqual(names, ['user/a', 'user/b'])
+
+    @patch('securitybot.db.awssimpledb.client')
+    def test__blacklist_version(self, mk_boto):
+        cli = DbClient(config=SDB_CFG, queries=None)
+        cli._client.select.side_effect = [
+            {'Items': [{'Name': 'Domain', 'Attributes': [
+                {'Name': 'Count', 'Value': '2'}
+            ]}]},
+            {'Items': [{'Name': 'user', 'Attributes': [
+                {'Name': 'blacklist_time',
+                 'Value': '2020-01-01T00:00:00+0000'}
+            ]}], 'NextToken': 'x'},
+        ]
+
+        rows = cli.execute('blacklist_version')
+
+        self.assertEqual(rows, [(2, '2020-01-01T00:00:00+0000')])
+        self.assertEqual(cli._client.select.call_count, 2)
+
+    @patch('securitybot.db.awssimpledb.client')
+    def test__delete_ignored_if_unchanged(self, mk_boto):
+        from botocore.exceptions import ClientError
+
+        cli = DbClient(config=SDB_CFG, queries=None)
+        cli._client.delete_attributes.side_effect = [
+            None,
+            ClientError(
+                {'Error': {'Code': 'ConditionalCheckFailed'}},
+                'DeleteAttributes'
+            ),
+        ]
+
+        cli.execute_many('delete_ignored', [
+            ('user', 'a', '2020-01-01T01:00:00+0000'),
+            # Ignored again since it was read
+            ('user', 'b', '2020-01-01T01:00:00+0000'),
+        ])
+
+        calls = cli._client.delete_attributes.call_args_list
+        self.assertEqual([c[1]['ItemName'] for c in calls],
+                         ['user/a', 'user/b'])
+        self.assertEqual(calls[0][1]['Expected'], {
+            'Name': 'until', 'Value': '2020-01-01T01:00:00+0000',
+            'Exists': True
+        })
+        cli._client.batch_delete_attributes.assert_not_called()
+
+    @patch('securitybot.db.awssimpledb.client')
+    def test__claim_alerts(self, mk_boto):
+        from datetime import datetime
+        from botocore.exceptions import ClientError
+
+        def item(name, **attribs):
+            return {'Name': name, 'Attributes': [
+                {'Name': k, 'Value': v} for k, v in attribs.items()
+            ]}
+
+        cli = DbClient(config=SDB_CFG, queries=None)
+        cli._client.select.return_value = {'Items': [
+            item('free', status='0'),
+            item('held', status='1', owner='shard-1-of-2',
+                 lease_until='2020-01-01T01:00:00+0000'),
+            item('expired', status='1', owner='shard-1-of-2',
+                 lease_until='2019-12-31T23:00:00+0000'),
+            # Held under a previous layout of the ring
+            item('stale', status='1', owner='shard-1-of-3',
+                 lease_until='2020-01-01T01:00:00+0000'),
+        ]}
+        cli._client.put_attributes.side_effect = [
+            None,
+            ClientError(
+                {'Error': {'Code': 'ConditionalCheckFailed'}}, 'PutAttributes'
+            ),
+            None,
+        ]
+        now = datetime.strptime('2020-01-01T00:00:00+0000', TIME_FORMAT)
+        until = datetime.strptime('2020-01-01T00:05:00+0000', TIME_FORMAT)
+
+        cli.execute(
+            'claim_alerts',
+            ('shard-0-of-2', until, ('free', 'held', 'expired', 'stale'),
+             'shard-0-of-2', now, ('shard-0-of-2', 'shard-1-of-2'))
+        )
+
+        calls = cli._client.put_attributes.call_args_list
+        self.assertEqual([c[1]['ItemName'] for c in calls],
+                         ['free', 'expired', 'stale'])
+        self.assertEqual(calls[0][1]['Expected'],
+                         {'Name': 'owner', 'Exists': False})
+        self.assertEqual(calls[1][1]['Expected'],
+                         {'Name': 'owner', 'Value': 'shard-1-of-2',
+                          'Exists': True})
+
     @patch('securitybot.db.awssimpledb.client')
     def test__set_response_success(self, mk_boto):
         cli = DbClient(config=SDB_CFG, queries="test")
@@ -57,7 +162,7 @@ class TestChatProviderSlack(unittest.TestCase):
         params = ('comment', 0, 0, 'hash')
         e_result = cli.execute('set_response', params=params)
 
-        cli._new_alert_user_response = MagicMock()
+        cli._put_response = MagicMock()
         self.assertEqual(e_result, True)
 
     @patch('securitybot.db.awssimpledb.client')
@@ -65,10 +170,10 @@ class TestChatProviderSlack(unittest.TestCase):
         cli = DbClient(config=SDB_CFG, queries="test")
 
         params = ('comment', 0, 0, 'hash')
-        cli._new_alert_user_response = MagicMock()
+        cli._put_response = MagicMock()
         cli.execute('set_response', params=params)
 
-        cli._new_alert_user_response.assert_called_once_with(['hash', 'comment', 0, 0])
+        cli._put_response.assert_called_once_with(['hash', 'comment', 0, 0])
 
     @patch('securitybot.db.awssimpledb.client')
     def test__set_response_params_missing(self, mk_boto):
@@ -104,3 +209,242 @@ class TestChatProviderSlack(unittest.TestCase):
         }
 
         cli.execute('get_alerts', params = ('0'))
+
+    @patch('securitybot.db.awssimpledb.client')
+    def test__select_follows_next_token(self, mk_boto):
+        cli = DbClient(config=SDB_CFG, queries=None)
+        cli._client.select.side_effect = [
+            {'Items': [{'Name': 'a', 'Attributes': []}], 'NextToken': 'x'},
+            {'Items': [{'Name': 'b', 'Attributes': []}]},
+        ]
+
+        rows = cli._select(fields='*', table='alerts')
+
+        self.assertEqual(sorted(rows), ['a', 'b'])
+        self.assertEqual(
+            cli._client.select.call_args[1]['NextToken'], 'x'
+        )
+
+    @patch('securitybot.db.awssimpledb.client')
+    def test__get_alerts_selects_by_item_name(self, mk_boto):
+        def item(name, **attribs):
+            return {
+                'Name': name,
+                'Attributes': [
+                    {'Name': k, 'Value': v} for k, v in attribs.items()
+                ]
+            }
+
+        cli = DbClient(config=SDB_CFG, queries=None)
+        cli._client.select.side_effect = [
+            {'Items': [item('h1', status='0'), item('h2', status='0')]},
+            {'Items': [item(
+                'h1', title='test', ldap='user', reason='because',
+                description='hi', url='n/a',
+                event_time='2020-01-01T00:00:00+0000'
+            )]},
+            {'Items': [
+                item('h1', performed='0', comment='', authenticated='0'),
+                item('h2', performed='0', comment='', authenticated='0'),
+            ]},
+        ]
+
+        rows = cli.execute('get_alerts', params=('0',))
+
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0][:3], ['h1', 'test', 'user'])
+        expression = cli._client.select.call_args[1]['SelectExpression']
+        self.assertIn("itemName() in ('h1', 'h2')", expression)
+
+    @patch('securitybot.db.awssimpledb.client')
+    def test__insert_batches(self, mk_boto):
+        cli = DbClient(config=SDB_CFG, queries=None)
+        items = ['h{}'.format(i) for i in range(30)]
+
+        cli._insert(items=items, attribs=[[]] * 30, table='alerts')
+
+        calls = cli._client.batch_put_attributes.call_args_list
+        self.assertEqual([len(c[1]['Items']) for c in calls], [25, 5])
+        self.assertEqual(calls[0][1]['DomainName'], 'secbot.alerts')
+
+    @patch('securitybot.db.awssimpledb.client')
+    def test__alert_table_domains(self, mk_boto):
+        config = dict(SDB_CFG, tables=['blacklist', 'alert'])
+        cli = DbClient(config=config, queries=None)
+
+        self.assertEqual(
+            [c[1]['DomainName'] for c in
+             cli._client.create_domain.call_args_list],
+            ['secbot.blacklist', 'secbot.alert_status', 'secbot.alerts',
+             'secbot.user_responses']
+        )
+
+    @patch('securitybot.db.awssimpledb.client')
+    def test__finalise_alerts_by_name(self, mk_boto):
+        cli = DbClient(config=SDB_CFG, queries=None)
+
+        cli.execute('finalise_alerts', params=(('h1', 'h2'),))
+
+        cli._client.select.assert_not_called()
+        calls = cli._client.batch_delete_attributes.call_args_list
+        self.assertEqual(
+            [c[1]['DomainName'] for c in calls],
+            ['secbot.alert_status', 'secbot.alerts', 'secbot.user_responses']
+        )
+        self.assertEqual(
+            calls[0][1]['Items'], [{'Name': 'h1'}, {'Name': 'h2'}]
+        )
+
+    @patch('securitybot.db.awssimpledb.client')
+    def test__new_alert(self, mk_boto):
+        cli = DbClient(config=SDB_CFG, queries=None)
+
+        cli.execute(
+            'new_alert', params=('h1', 'user', 't', 'd', 'r', 'u', 0)
+        )
+
+        calls = cli._client.batch_put_attributes.call_args_list
+        self.assertEqual(
+            [c[1]['DomainName'] for c in calls],
+            ['secbot.alerts', 'secbot.user_responses', 'secbot.alert_status']
+        )
+
+    @patch('securitybot.db.awssimpledb.client')
+    def test__transaction_batches_writes(self, mk_boto):
+        cli = DbClient(config=SDB_CFG, queries=None)
+
+        with cli.transaction():
+            for hsh in ('h1', 'h2'):
+                cli._put_status((hsh, 0))
+                cli._put_response((hsh, '', 0, 0))
+            cli.execute('set_status', (1, 'h1'))
+            cli._client.batch_put_attributes.assert_not_called()
+
+        calls = cli._client.batch_put_attributes.call_args_list
+        self.assertEqual(
+            [c[1]['DomainName'] for c in calls],
+            ['secbot.alert_status', 'secbot.user_responses']
+        )
+        self.assertEqual(
+            [i['Name'] for i in calls[0][1]['Items']], ['h1', 'h2']
+        )
+
+    @patch('securitybot.db.awssimpledb.client')
+    def test__execute_many_new_alert(self, mk_boto):
+        cli = DbClient(config=SDB_CFG, queries=None)
+
+        cli.execute_many('new_alert', [
+            ('h{}'.format(i), 'user', 't', 'd', 'r', 'u', 0)
+            for i in range(30)
+        ])
+
+        calls = cli._client.batch_put_attributes.call_args_list
+        self.assertEqual(
+            [(c[1]['DomainName'], len(c[1]['Items'])) for c in calls],
+            [('secbot.alerts', 25), ('secbot.alerts', 5),
+             ('secbot.user_responses', 25), ('secbot.user_responses', 5),
+             ('secbot.alert_status', 25), ('secbot.alert_status', 5)]
+        )
+
+    @patch('securitybot.db.awssimpledb.client')
+    def test__get_existing_hashes(self, mk_boto):
+        cli = DbClient(config=SDB_CFG, queries=None)
+        cli._client.select.return_value = {
+            'Items': [{'Name': 'h1', 'Attributes': []}]
+        }
+
+        rows = cli.execute(
+            'get_existing_hashes',
+            (['h{}'.format(i) for i in range(25)],)
+        )
+
+        self.assertEqual(rows, [('h1',)])
+        self.assertEqual(cli._client.select.call_count, 2)
+
+    @patch('securitybot.db.awssimpledb.client')
+    def test__get_responses(self, mk_boto):
+        cli = DbClient(config=SDB_CFG, queries=None)
+        cli._client.select.return_value = {
+            'Items': [{'Name': 'h1', 'Attributes': [
+                {'Name': 'comment', 'Value': 'c'},
+                {'Name': 'performed', 'Value': '1'},
+                {'Name': 'authenticated', 'Value': '0'},
+            ]}]
+        }
+
+        rows = cli.execute('get_responses', (['h1', 'h2'],))
+
+        self.assertEqual(rows, [['h1', 'c', '1', '0']])
+        expression = cli._client.select.call_args[1]['SelectExpression']
+        self.assertIn("`secbot.user_responses`", expression)
+        self.assertIn("itemName() in ('h1', 'h2')", expression)
+
+    @patch('securitybot.db.awssimpledb.client')
+    def test__transaction_merges_runs(self, mk_boto):
+        cli = DbClient(config=SDB_CFG, queries=None)
+
+        with cli.transaction():
+            cli._put_status(('h1', 0))
+            cli.execute('set_status', (1, 'h1'))
+            cli._put_status(('h2', 0))
+
+        cli._client.batch_put_attributes.assert_called_once_with(
+            DomainName='secbot.alert_status',
+            Items=[
+                {'Name': 'h1', 'Attributes': [
+                    {'Name': 'status', 'Value': '1', 'Replace': True}
+                ]},
+                {'Name': 'h2', 'Attributes': [
+                    {'Name': 'status', 'Value': '0', 'Replace': True}
+                ]},
+            ]
+        )
+
+    @patch('securitybot.db.awssimpledb.client')
+    def test__transaction_discarded_on_error(self, mk_boto):
+        cli = DbClient(config=SDB_CFG, queries=None)
+
+        with self.assertRaises(ValueError):
+            with cli.transaction():
+                cli.execute('finalise_alert', ('h1',))
+                raise ValueError()
+
+        cli._client.batch_delete_attributes.assert_not_called()
+
+    @patch('securitybot.db.awssimpledb.client')
+    def test__get_alerts_since(self, mk_boto):
+        def item(name, **attribs):
+            return {
+                'Name': name,
+                'Attributes': [
+                    {'Name': k, 'Value': v} for k, v in attribs.items()
+                ]
+            }
+
+        def alert(name, time):
+            return item(
+                name, title='t', ldap='user', reason='r', description='d',
+                url='u', event_time=time
+            )
+
+        cli = DbClient(config=SDB_CFG, queries=None)
+        cli._client.select.side_effect = [
+            {'Items': [
+                alert('h1', '2020-01-01T00:00:00+0000'),
+                alert('h3', '2020-01-01T00:01:00+0000'),
+                alert('h2', '2020-01-01T00:00:00+0000'),
+            ]},
+            {'Items': [item('h2', status='0'), item('h3', status='0')]},
+            {'Items': [
+                item(h, performed='0', comment='', authenticated='0')
+                for h in ('h2', 'h3')
+            ]},
+        ]
+
+        rows = cli.execute('get_alerts_since', params=(
+            0, '2020-01-01T00:00:00+0000', '2020-01-01T00:00:00+0000',
+            'h1', 500
+        ))
+
+        self.assertEqual([row[0] for row in rows], ['h2', 'h3'])
+        self.assertEqual(rows[0][-1], 0)
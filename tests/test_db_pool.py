@@ -0,0 +1,109 @@
+import threading
+import unittest
+
+from unittest.mock import MagicMock
+
+from securitybot.db.pool import ConnectionPool
+
+from securitybot.exceptions import DbException
+
+from tests.helpers import FakeTimer
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.connect = MagicMock(side_effect=lambda: MagicMock())
+        self.ping = MagicMock()
+        self.close = MagicMock()
+        self.timer = FakeTimer()
+
+    def _pool(self, **kwargs):
+        return ConnectionPool(
+            connect=self.connect, ping=self.ping, close=self.close,
+            timer=self.timer, backoff=0, **kwargs
+        )
+
+    def test__reuses_connection(self):
+        pool = self._pool()
+        with pool.connection() as first:
+            pass
+        with pool.connection() as second:
+            pass
+
+        self.assertIs(first, second)
+        self.connect.assert_called_once_with()
+        self.ping.assert_not_called()
+
+    def test__nested_checkout_shares_connection(self):
+        pool = self._pool()
+        with pool.connection() as outer:
+            self.assertTrue(pool.in_use())
+            with pool.connection() as inner:
+                self.assertIs(outer, inner)
+            self.assertTrue(pool.in_use())
+        self.assertFalse(pool.in_use())
+
+    def test__threads_get_own_connections(self):
+        pool = self._pool(size=2)
+        seen = []
+        barrier = threading.Barrier(2)
+
+        def work():
+            with pool.connection() as conn:
+                seen.append(conn)
+                barrier.wait(1)
+
+        threads = [threading.Thread(target=work) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertIsNot(seen[0], seen[1])
+
+    def test__pings_idle_connection(self):
+        pool = self._pool(ping_interval=30)
+        with pool.connection() as first:
+            pass
+        self.timer.now = 60
+        self.ping.side_effect = Exception('gone')
+        with pool.connection() as second:
+            pass
+
+        self.assertIsNot(first, second)
+        self.close.assert_called_once_with(first)
+
+    def test__drops_broken_connection(self):
+        pool = self._pool()
+        self.ping.side_effect = Exception('gone')
+        with self.assertRaises(ValueError):
+            with pool.connection() as conn:
+                raise ValueError()
+
+        self.close.assert_called_once_with(conn)
+
+    def test__retries_connect(self):
+        conn = MagicMock()
+        self.connect.side_effect = [Exception('refused'), conn]
+        pool = self._pool(max_retries=1)
+
+        with pool.connection() as got:
+            self.assertIs(got, conn)
+
+    def test__checkout_timeout(self):
+        pool = self._pool(size=1, timeout=0.01)
+        with pool.connection():
+            result = []
+
+            def other():
+                try:
+                    with pool.connection():
+                        pass
+                except DbException:
+                    result.append('timeout')
+
+            thread = threading.Thread(target=other)
+            thread.start()
+            thread.join()
+
+        self.assertEqual(result, ['timeout'])
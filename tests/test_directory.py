@@ -0,0 +1,65 @@
+import os
+import tempfile
+import unittest
+
+from securitybot.directory import UserDirectory
+
+
+def member(id, name, first_name='', **extra):
+    return {
+        'id': id,
+        'name': name,
+        'profile': {'first_name': first_name, 'image_512': 'http://x'},
+        **extra
+    }
+
+
+class TestUserDirectory(unittest.TestCase):
+    def test__refresh_and_lookup(self):
+        directory = UserDirectory()
+        count = directory.refresh(
+            member('U{}'.format(i), 'user{}'.format(i)) for i in range(1234)
+        )
+
+        self.assertEqual(count, 1234)
+        self.assertEqual(len(directory), 1234)
+        self.assertEqual(directory.by_name('user42')['id'], 'U42')
+        self.assertEqual(directory.by_id('U42')['name'], 'user42')
+        self.assertIsNone(directory.by_id('U9999'))
+        self.assertGreater(directory.last_refresh(), 0)
+
+    def test__compacts_members(self):
+        directory = UserDirectory()
+        directory.upsert(member('U1', 'bill', 'Bill', color='red'))
+
+        self.assertEqual(directory.by_id('U1'), {
+            'id': 'U1',
+            'name': 'bill',
+            'deleted': False,
+            'profile': {'first_name': 'Bill'},
+        })
+
+    def test__upsert_replaces(self):
+        directory = UserDirectory()
+        directory.upsert(member('U1', 'bill'))
+        directory.upsert(member('U1', 'william'))
+
+        self.assertIsNone(directory.by_name('bill'))
+        self.assertEqual(directory.by_name('william')['id'], 'U1')
+        self.assertEqual(directory.last_refresh(), 0)
+
+    def test__copy_to(self):
+        directory = UserDirectory()
+        directory.refresh([member('U1', 'bill'), member('U2', 'ted')])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'users.db.0')
+            stale = UserDirectory(path)
+            stale.upsert(member('U3', 'rufus'))
+            directory.copy_to(path)
+            copy = UserDirectory(path)
+
+            self.assertEqual(len(copy), 2)
+            self.assertEqual(copy.by_name('ted')['id'], 'U2')
+            self.assertIsNone(copy.by_id('U3'))
+            self.assertEqual(copy.last_refresh(), directory.last_refresh())
@@ -0,0 +1,98 @@
+import pytz
+import threading
+import unittest
+
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock
+
+from securitybot.ignored_alerts import IgnoredAlerts
+
+from tests.helpers import FakeClock
+
+
+def make_db(rows=()):
+    db = MagicMock()
+    db.execute.return_value = list(rows)
+    return db
+
+
+class TestIgnoredAlerts(unittest.TestCase):
+    def test__loads_and_expires(self):
+        clock = FakeClock()
+        db = make_db([
+            ('user', 'a', 'ignored', '2020-01-01T01:00:00+0000'),
+            ('user', 'b', 'ignored', datetime(2020, 1, 1, 2)),
+        ])
+        ignored = IgnoredAlerts(db, clock=clock)
+
+        self.assertEqual(ignored.get('user'), {'a': 'ignored', 'b': 'ignored'})
+        clock.now += timedelta(minutes=90)
+        self.assertEqual(ignored.get('user'), {'b': 'ignored'})
+        self.assertEqual(ignored.get('other'), {})
+        # Loaded once, then served from memory
+        db.execute.assert_called_once_with('get_all_ignored')
+
+    def test__ignore_writes_through(self):
+        clock = FakeClock()
+        db = make_db()
+        ignored = IgnoredAlerts(db, clock=clock)
+
+        ignored.ignore('user', 'a', 'backoff', timedelta(hours=1))
+
+        self.assertEqual(ignored.get('user'), {'a': 'backoff'})
+        db.execute.assert_called_with(
+            'ignore_task', ('user', 'a', 'backoff', '2020-01-01T01:00:00+0000')
+        )
+
+    def test__reload_keeps_concurrent_ignores(self):
+        clock = FakeClock()
+        db = make_db([('other', 'x', 'ignored', '2020-01-02T00:00:00+0000')])
+        ignored = IgnoredAlerts(db, clock=clock)
+        ignored.ignore('user', 'gone', 'backoff', timedelta(hours=1))
+
+        def get_all_ignored(query, params=None):
+            # An ignore lands while the table is being read
+            db.execute.side_effect = None
+            ignored.ignore('user', 'a', 'backoff', timedelta(hours=1))
+            return []
+        db.execute.side_effect = get_all_ignored
+        ignored.reload()
+
+        self.assertEqual(ignored.get('user'), {'a': 'backoff'})
+        self.assertEqual(ignored.get('other'), {})
+
+    def test__prune_in_expiry_order(self):
+        clock = FakeClock()
+        db = make_db([
+            ('user', 'a', 'ignored', '2020-01-01T01:00:00+0000'),
+            ('user', 'b', 'ignored', '2020-01-01T03:00:00+0000'),
+        ])
+        ignored = IgnoredAlerts(db, clock=clock)
+        # Ignored again, so its first expiry is stale
+        ignored.ignore('user', 'a', 'backoff', timedelta(hours=2))
+
+        self.assertEqual(ignored.next_expiry(),
+                         datetime(2020, 1, 1, 2, tzinfo=pytz.utc))
+        self.assertEqual(ignored.prune(), 0)
+        db.execute_many.assert_not_called()
+
+        clock.now += timedelta(hours=4)
+        self.assertEqual(ignored.prune(), 2)
+        db.execute_many.assert_called_once_with('delete_ignored', [
+            ('user', 'a', '2020-01-01T02:00:00+0000'),
+            ('user', 'b', '2020-01-01T03:00:00+0000'),
+        ])
+        self.assertIsNone(ignored.next_expiry())
+
+    def test__prunes_at_expiry(self):
+        db = make_db()
+        pruned = threading.Event()
+        db.execute_many.side_effect = lambda *args: pruned.set()
+        ignored = IgnoredAlerts(db)
+        ignored.start()
+        try:
+            ignored.ignore('user', 'a', 'backoff', timedelta(seconds=0.05))
+            self.assertTrue(pruned.wait(5))
+        finally:
+            ignored.stop()
+        self.assertEqual(ignored.get('user'), {})
@@ -0,0 +1,146 @@
+import json
+import unittest
+
+from unittest.mock import MagicMock
+
+from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
+
+from securitybot.exceptions import DuplicateKeyError
+from securitybot.ingest import (
+    AlertIngester, build_app, parse_body, validate_alert, alert_hash
+)
+
+
+def make_alert(**fields):
+    alert = {
+        'ldap': 'user', 'title': 't', 'description': 'd', 'reason': 'r'
+    }
+    alert.update(fields)
+    return alert
+
+
+def make_db(existing=()):
+    db = MagicMock()
+    db.execute.return_value = [(hsh,) for hsh in existing]
+    return db
+
+
+class TestIngest(unittest.TestCase):
+    def test__validate_alert(self):
+        alert = validate_alert(make_alert())
+
+        self.assertEqual(alert['url'], 'N/A')
+        self.assertEqual(alert['hash'], alert_hash(alert))
+        with self.assertRaises(ValueError):
+            validate_alert(make_alert(ldap=''))
+        with self.assertRaises(ValueError):
+            validate_alert(make_alert(hash='a' * 65))
+        with self.assertRaises(ValueError):
+            validate_alert(['not', 'an', 'alert'])
+
+    def test__parse_body(self):
+        self.assertEqual(parse_body(b'{"a": 1}', 'application/json'),
+                         [{'a': 1}])
+        self.assertEqual(
+            parse_body(b'{"a": 1}\n\n{"a": 2}\n', 'application/x-ndjson'),
+            [{'a': 1}, {'a': 2}]
+        )
+        with self.assertRaises(ValueError):
+            parse_body(b'{"a": ', 'application/json')
+
+    def test__ingest_batches(self):
+        db = make_db(existing=['h1'])
+        ingester = AlertIngester(db, batch_size=2, notify_path=None)
+
+        results = ingester.ingest([
+            make_alert(hash='h1'), make_alert(hash='h2'), {'title': 't'},
+            make_alert(hash='h2'), make_alert(hash='h3'),
+        ])
+
+        self.assertEqual(
+            [r['status'] for r in results],
+            ['duplicate', 'created', 'invalid', 'duplicate', 'created']
+        )
+        self.assertEqual(db.execute.call_count, 2)
+        self.assertEqual(db.execute.call_args_list[0][0],
+                         ('get_existing_hashes', (['h1', 'h2'],)))
+        self.assertEqual(db.execute_many.call_count, 2)
+        self.assertEqual(db.execute_many.call_args_list[0][0][1][0][0], 'h2')
+
+    def test__ingest_isolates_failures(self):
+        db = make_db()
+        db.execute_many.side_effect = Exception('batch failed')
+
+        def execute(query, params):
+            if query == 'new_alert' and params[0] == 'bad':
+                raise Exception('row failed')
+            return []
+        db.execute.side_effect = execute
+        ingester = AlertIngester(db, notify_path=None)
+
+        results = ingester.ingest([
+            make_alert(hash='good'), make_alert(hash='bad')
+        ])
+
+        self.assertEqual(results[0]['status'], 'created')
+        self.assertEqual(results[1]['status'], 'failed')
+        self.assertEqual(results[1]['error'], 'row failed')
+
+    def test__ingest_concurrent_duplicate(self):
+        db = make_db()
+        db.execute_many.side_effect = Exception('batch failed')
+
+        def execute(query, params):
+            # Inserted by another request after the collision check
+            if query == 'new_alert' and params[0] == 'raced':
+                raise DuplicateKeyError('Duplicate entry')
+            return []
+        db.execute.side_effect = execute
+        ingester = AlertIngester(db, notify_path=None)
+
+        results = ingester.ingest([
+            make_alert(hash='good'), make_alert(hash='raced')
+        ])
+
+        self.assertEqual(results[0]['status'], 'created')
+        self.assertEqual(results[1]['status'], 'duplicate')
+
+
+class TestIngestApp(AioHTTPTestCase):
+    async def get_application(self):
+        self.db = make_db()
+        return build_app(
+            AlertIngester(self.db, notify_path=None), max_items=2,
+            token='secret'
+        )
+
+    @unittest_run_loop
+    async def test__post_ndjson(self):
+        body = '\n'.join(json.dumps(make_alert(hash=h)) for h in 'ab')
+        resp = await self.client.post(
+            '/alerts', data=body,
+            headers={
+                'Content-Type': 'application/x-ndjson',
+                'Authorization': 'Bearer secret',
+            }
+        )
+
+        self.assertEqual(resp.status, 200)
+        data = await resp.json()
+        self.assertEqual(data['created'], 2)
+        self.assertEqual([r['hash'] for r in data['results']], ['a', 'b'])
+
+    @unittest_run_loop
+    async def test__rejects_requests(self):
+        headers = {'Authorization': 'Bearer secret'}
+        resp = await self.client.post('/alerts', data='{}')
+        self.assertEqual(resp.status, 401)
+
+        resp = await self.client.post('/alerts', data='[', headers=headers)
+        self.assertEqual(resp.status, 400)
+
+        resp = await self.client.post(
+            '/alerts', data=json.dumps([make_alert()] * 3), headers=headers
+        )
+        self.assertEqual(resp.status, 413)
+        self.db.execute_many.assert_not_called()
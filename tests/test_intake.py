@@ -0,0 +1,65 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from securitybot.intake import IntakeListener, notify
+
+
+class TestIntake(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'bot.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test__notify_calls_listener(self):
+        notified = threading.Event()
+        listener = IntakeListener(path=self.path, on_notify=notified.set)
+        self.assertTrue(listener.start())
+        try:
+            self.assertTrue(notify(self.path))
+            self.assertTrue(notified.wait(5))
+        finally:
+            listener.close()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test__notify_without_listener(self):
+        self.assertFalse(notify(self.path))
+
+    def test__start_replaces_stale_socket(self):
+        # Bound then closed, as left behind by a bot which crashed
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        stale.bind(self.path)
+        stale.close()
+        listener = IntakeListener(path=self.path)
+        self.assertTrue(listener.start())
+        listener.close()
+
+    def test__start_keeps_live_socket(self):
+        notified = threading.Event()
+        live = IntakeListener(path=self.path, on_notify=notified.set)
+        self.assertTrue(live.start())
+        try:
+            other = IntakeListener(path=self.path)
+            self.assertFalse(other.start())
+            other.close()
+            # The first bot still gets notifications
+            self.assertTrue(notify(self.path))
+            self.assertTrue(notified.wait(5))
+        finally:
+            live.close()
+
+    def test__start_keeps_other_files(self):
+        open(self.path, 'w').close()
+        listener = IntakeListener(path=self.path)
+        self.assertFalse(listener.start())
+        self.assertTrue(os.path.exists(self.path))
+
+    def test__start_fails_quietly(self):
+        listener = IntakeListener(path=os.path.join(self.dir, 'no', 'sock'))
+        self.assertFalse(listener.start())
+        listener.close()
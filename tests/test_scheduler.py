@@ -0,0 +1,48 @@
+import unittest
+
+from datetime import datetime, timedelta
+
+from securitybot.scheduler import DeadlineHeap
+
+
+BASE = datetime(2020, 1, 1)
+
+
+class TestDeadlineHeap(unittest.TestCase):
+    def test__pop_due_in_order(self):
+        heap = DeadlineHeap()
+        heap.schedule('b', BASE + timedelta(minutes=2))
+        heap.schedule('a', BASE + timedelta(minutes=1))
+        heap.schedule('c', BASE + timedelta(minutes=3))
+
+        due = heap.pop_due(BASE + timedelta(minutes=2))
+
+        self.assertEqual(due, ['a', 'b'])
+        self.assertEqual(len(heap), 1)
+        self.assertEqual(heap.peek(), BASE + timedelta(minutes=3))
+
+    def test__reschedule_replaces_deadline(self):
+        heap = DeadlineHeap()
+        heap.schedule('a', BASE + timedelta(minutes=1))
+        heap.schedule('a', BASE + timedelta(minutes=5))
+
+        self.assertEqual(heap.pop_due(BASE + timedelta(minutes=2)), [])
+        self.assertEqual(heap.peek(), BASE + timedelta(minutes=5))
+
+    def test__cancel(self):
+        heap = DeadlineHeap()
+        heap.schedule('a', BASE)
+        heap.schedule('b', None)
+        heap.cancel('a')
+
+        self.assertIsNone(heap.peek())
+        self.assertEqual(heap.pop_due(BASE + timedelta(days=1)), [])
+        self.assertNotIn('a', heap)
+
+    def test__compacts_stale_entries(self):
+        heap = DeadlineHeap()
+        for i in range(1000):
+            heap.schedule('a', BASE + timedelta(seconds=i))
+
+        self.assertLess(len(heap._heap), 100)
+        self.assertEqual(heap.peek(), BASE + timedelta(seconds=999))
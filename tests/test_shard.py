@@ -0,0 +1,148 @@
+import queue
+import threading
+import unittest
+
+from unittest.mock import MagicMock
+
+from securitybot.shard import (
+    HashRing, Shard, ShardChatClient, ShardRouter, worker_config,
+    MESSAGE, NEW_ALERTS
+)
+from securitybot.tasker import Tasker
+
+
+class TestHashRing(unittest.TestCase):
+    def test__spreads_and_is_stable(self):
+        keys = ['U{:08d}'.format(i) for i in range(2000)]
+        ring = HashRing(range(4))
+        owners = {key: ring.node_for(key) for key in keys}
+
+        for node in range(4):
+            self.assertGreater(list(owners.values()).count(node), 300)
+
+        # Dropping a node only moves that node's keys
+        smaller = HashRing(range(3))
+        for key, node in owners.items():
+            if node != 3:
+                self.assertEqual(smaller.node_for(key), node)
+
+    def test__shard_owns(self):
+        shards = [Shard(i, 3, None) for i in range(3)]
+        for key in ('U1', 'U2', 'someone'):
+            self.assertEqual(sum(s.owns(key) for s in shards), 1)
+
+
+class TestShardRouter(unittest.TestCase):
+    def test__routes_by_sender(self):
+        chat = MagicMock()
+        chat.get_messages.return_value = [
+            {'user': 'U1', 'text': 'a'}, {'user': 'U2', 'text': 'b'}
+        ]
+        chat.get_user_updates.return_value = [{'id': 'U3'}]
+        queues = [queue.Queue() for _ in range(2)]
+        router = ShardRouter(chat, queues)
+
+        self.assertEqual(router.route(), 3)
+
+        ring = HashRing(range(2))
+        owner = queues[ring.node_for('U1')]
+        self.assertIn((MESSAGE, {'user': 'U1', 'text': 'a'}), owner.queue)
+        for q in queues:
+            self.assertIn(('user_update', {'id': 'U3'}), q.queue)
+
+    def test__drops_when_full(self):
+        chat = MagicMock()
+        chat.get_messages.return_value = [{'user': 'U1'}] * 2
+        chat.get_user_updates.return_value = []
+        router = ShardRouter(chat, [queue.Queue(maxsize=1)])
+
+        router.route()
+
+        self.assertEqual(router.dropped, 1)
+
+
+class TestShardChatClient(unittest.TestCase):
+    def test__receives_routed_events(self):
+        events = queue.Queue()
+        client = MagicMock()
+        woken = threading.Event()
+        announced = threading.Event()
+        chat = ShardChatClient(client, events)
+        chat.set_wakeup(woken.set)
+        chat.set_new_alerts_callback(announced.set)
+
+        events.put((MESSAGE, {'user': 'U1', 'text': 'hi'}))
+        events.put((NEW_ALERTS, None))
+
+        self.assertTrue(announced.wait(5))
+        self.assertTrue(woken.is_set())
+        self.assertEqual(chat.get_messages(), [{'user': 'U1', 'text': 'hi'}])
+        chat.send_message('C1', 'hello')
+        client.send_message.assert_called_once_with('C1', 'hello')
+        self.assertEqual(chat.inbox_stats()['received'], 1)
+
+
+class TestShardConfig(unittest.TestCase):
+    def test__worker_config(self):
+        config = {
+            'bot': {
+                'intake': {'path': 'bot.sock'},
+                'directory': {'path': 'users.db'},
+            },
+            'auth': {'capabilities': {'cache_path': 'caps.json'}},
+            'chat': {'provider': 'slack', 'slack': {
+                'dm_cache_path': 'dms.json',
+                'outbox': {'rate': 20, 'channel_rate': 1, 'channel_burst': 8}
+            }},
+        }
+
+        worker = worker_config(config, 1, 4)
+
+        slack = worker['chat']['slack']
+        self.assertFalse(slack['rtm'])
+        self.assertEqual(slack['outbox']['rate'], 5)
+        self.assertEqual(slack['outbox']['channel_rate'], 0.25)
+        self.assertEqual(slack['outbox']['channel_burst'], 2)
+        self.assertEqual(worker['bot']['directory']['path'], 'users.db.1')
+        # The original is left alone for the ingress
+        self.assertEqual(config['bot']['directory']['path'], 'users.db')
+        self.assertEqual(slack['dm_cache_path'], 'dms.json.1')
+        self.assertEqual(
+            worker['auth']['capabilities']['cache_path'], 'caps.json.1'
+        )
+        self.assertFalse(worker['bot']['intake']['enabled'])
+        # The original is untouched
+        self.assertNotIn('rtm', config['chat']['slack'])
+
+
+class TestTaskerClaim(unittest.TestCase):
+    def test__claim(self):
+        db = MagicMock()
+        db.execute.side_effect = lambda query, params: (
+            [('h1',)] if query == 'get_claimed' else True
+        )
+        tasks = [MagicMock(hash='h1'), MagicMock(hash='h2')]
+
+        shard = Shard(0, 2, None)
+        claimed = Tasker(db).claim(
+            tasks, shard.owner, 300, shard.peers
+        )
+
+        self.assertEqual(claimed, tasks[:1])
+        query, params = db.execute.call_args_list[0][0]
+        self.assertEqual(query, 'claim_alerts')
+        self.assertEqual(params[0], 'shard-0-of-2')
+        self.assertEqual(params[2], ('h1', 'h2'))
+        self.assertEqual(params[5], ('shard-0-of-2', 'shard-1-of-2'))
+
+    def test__renews_only_given_tasks(self):
+        db = MagicMock()
+        tasks = [MagicMock(hash='h1'), MagicMock(hash='h2')]
+
+        Tasker(db).renew_leases(tasks, 'shard-0-of-2', 300)
+        Tasker(db).renew_leases([], 'shard-0-of-2', 300)
+
+        query, params = db.execute.call_args[0]
+        self.assertEqual(query, 'renew_leases')
+        self.assertEqual(params[1:], ('shard-0-of-2', ('h1', 'h2')))
+        db.execute.assert_called_once()
@@ -0,0 +1,143 @@
+import pytz
+import unittest
+
+from datetime import datetime, timedelta
+
+from unittest.mock import MagicMock, patch
+
+from securitybot.tasker import Tasker
+
+from tests.helpers import FakeTimer
+
+
+def alert(hsh, minute):
+    return [
+        hsh, 'title', 'user', 'reason', 'desc', 'url',
+        datetime(2020, 1, 1, 0, minute, tzinfo=pytz.utc),
+        False, '', False, 0
+    ]
+
+
+class TestTasker(unittest.TestCase):
+    def test__finalise_many(self):
+        db = MagicMock()
+        tasks = [MagicMock(hash='h1'), MagicMock(hash='h2')]
+
+        Tasker(db).finalise_many(tasks)
+
+        db.execute.assert_called_once_with(
+            'finalise_alerts', (('h1', 'h2'), )
+        )
+
+    @patch('securitybot.tasker.FINALISE_BATCH_SIZE', 2)
+    def test__finalise_many_batches(self):
+        db = MagicMock()
+        tasks = [MagicMock(hash=h) for h in ('h1', 'h2', 'h3')]
+
+        Tasker(db).finalise_many(tasks)
+
+        self.assertEqual(db.execute.call_count, 2)
+        db.execute.assert_called_with('finalise_alerts', (('h3', ), ))
+
+    def test__finalise_many_empty(self):
+        db = MagicMock()
+
+        Tasker(db).finalise_many([])
+
+        db.execute.assert_not_called()
+
+    def test__get_new_tasks_from_cursor(self):
+        timer = FakeTimer()
+        db = MagicMock()
+        db.execute.side_effect = [
+            [alert('h1', 1), alert('h2', 2)],
+            # The poll starts before the cursor, so h2 is fetched again
+            [alert('h2', 2), alert('h3', 3)],
+        ]
+        tasker = Tasker(db, reconcile_time=600, timer=timer)
+
+        first = tasker.get_new_tasks()
+        timer.now = 60
+        second = tasker.get_new_tasks()
+
+        self.assertEqual([t.hash for t in first], ['h1', 'h2'])
+        self.assertEqual([t.hash for t in second], ['h3'])
+        since = alert('h2', 2)[6] - timedelta(seconds=5)
+        db.execute.assert_called_with(
+            'get_alerts_since', (0, since, since, '', 500)
+        )
+
+    def test__get_new_tasks_late_commit(self):
+        timer = FakeTimer()
+        db = MagicMock()
+        db.execute.side_effect = [
+            [alert('h2', 2)],
+            # Committed after h2 within the same second, with a lower hash
+            [alert('h1', 2), alert('h2', 2)],
+        ]
+        tasker = Tasker(db, reconcile_time=600, timer=timer)
+
+        tasker.get_new_tasks()
+        timer.now = 60
+        late = tasker.get_new_tasks()
+
+        self.assertEqual([t.hash for t in late], ['h1'])
+
+    @patch('securitybot.tasker.POLL_PAGE_SIZE', 2)
+    def test__get_new_tasks_pages(self):
+        timer = FakeTimer()
+        db = MagicMock()
+        db.execute.side_effect = [
+            [alert('h1', 1)],
+            [alert('h1', 1), alert('h2', 2)],
+            [alert('h3', 3)],
+        ]
+        tasker = Tasker(db, reconcile_time=600, timer=timer)
+
+        tasker.get_new_tasks()
+        timer.now = 60
+        polled = tasker.get_new_tasks()
+
+        self.assertEqual([t.hash for t in polled], ['h2', 'h3'])
+        db.execute.assert_called_with(
+            'get_alerts_since',
+            (0, alert('h2', 2)[6], alert('h2', 2)[6], 'h2', 2)
+        )
+
+    def test__get_new_tasks_reconciles(self):
+        timer = FakeTimer()
+        db = MagicMock()
+        db.execute.side_effect = [
+            [alert('h1', 1)],
+            [alert('h2', 2)],
+            # h2 is still in flight, h0 was committed behind the cursor
+            [alert('h0', 0), alert('h2', 2)],
+        ]
+        tasker = Tasker(db, reconcile_time=600, timer=timer)
+
+        tasker.get_new_tasks()
+        timer.now = 60
+        tasker.get_new_tasks()
+        timer.now = 600
+        reconciled = tasker.get_new_tasks()
+
+        self.assertEqual([t.hash for t in reconciled], ['h0'])
+        db.execute.assert_called_with('get_alerts', (0, ))
+
+    def test__reconcile_keeps_open_alerts_seen(self):
+        timer = FakeTimer()
+        db = MagicMock()
+        db.execute.side_effect = [
+            [alert('h1', 1)],
+            [alert('h1', 1), alert('h2', 2)],
+            # h1 and h2 are still open, h2 was handed out by the previous
+            # reconcile and h1 by the one before
+            [alert('h1', 1), alert('h2', 2)],
+        ]
+        tasker = Tasker(db, reconcile_time=600, timer=timer)
+
+        tasker.get_new_tasks()
+        timer.now = 600
+        self.assertEqual([t.hash for t in tasker.get_new_tasks()], ['h2'])
+        timer.now = 1200
+        self.assertEqual(tasker.get_new_tasks(), [])
@@ -0,0 +1,35 @@
+import unittest
+
+from unittest.mock import MagicMock
+
+from securitybot.auth.capabilities import CapabilityStore
+from securitybot.exceptions import AuthException
+from securitybot.user import User
+
+
+class FlakyAuth(object):
+    '''Fails the first lookup, as Okta does when rate limited.'''
+
+    def __init__(self):
+        self.calls = 0
+
+    def can_auth(self, user):
+        self.calls += 1
+        if self.calls == 1:
+            raise AuthException('429 Too Many Requests')
+        return 'factor1'
+
+
+class TestUser(unittest.TestCase):
+    def test__can_auth_retries_failed_lookup(self):
+        auth = FlakyAuth()
+        bot = MagicMock()
+        bot._capabilities = CapabilityStore(authclient=auth)
+        user = User({'id': 'U1', 'name': 'user'}, auth, MagicMock(), bot)
+
+        # Unknown rather than unable, so the alert isn't closed as no_2fa
+        self.assertIsNone(user.can_auth())
+        self.assertTrue(user.can_auth())
+        self.assertTrue(user.can_auth())
+        self.assertEqual(user._factor_id, 'factor1')
+        self.assertEqual(auth.calls, 2)